@@ -0,0 +1,158 @@
+"""
+Controllo di ammissione delle chiamate di sveglia verso il centralino PBX
+"""
+import heapq
+import itertools
+import threading
+import time
+
+class AdmissionTicket:
+    """Una sveglia in attesa di un canale PBX"""
+
+    def __init__(self, alarm_id, due_ts, attempt=0, not_before=None):
+        self.alarm_id = alarm_id
+        self.due_ts = due_ts                          # orario previsto della sveglia
+        self.attempt = attempt                        # 0 = primo tentativo, >0 = retry
+        self.not_before = not_before or due_ts        # non ammessa prima di questo istante
+        self.enqueued_at = time.time()
+        self.admitted_at = None
+
+    def sort_key(self):
+        """Prima le sveglie al primo tentativo (per orario), poi i retry"""
+        if self.attempt == 0:
+            return (0, self.due_ts)
+        return (1, self.not_before)
+
+
+class AdmissionController:
+    """
+    Limita le chiamate contemporanee e la frequenza di originate verso il PBX.
+
+    Le sveglie in eccesso restano in coda con ordine deterministico:
+    prima le più vecchie al primo tentativo, poi i retry. Le originate
+    vengono distanziate di almeno 1/max_rate secondi per smussare i picchi
+    (es. 120 camere alle 07:00).
+    """
+
+    def __init__(self, max_concurrent=4, max_rate=2.0):
+        """
+        Args:
+            max_concurrent: chiamate di sveglia contemporanee ammesse
+            max_rate: originate massime al secondo (0 = nessun limite)
+        """
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_rate = float(max_rate or 0)
+
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._next_originate_ts = 0
+        self._closed = False
+
+        # Statistiche per il dimensionamento
+        self._avg_call_duration = 35.0  # stima iniziale (secondi), aggiornata con media mobile
+        self._max_lateness = 0.0
+        self._admitted_total = 0
+        self._peak_in_flight = 0
+
+    def submit(self, ticket):
+        """Accoda una sveglia"""
+        with self._cond:
+            heapq.heappush(self._heap, (ticket.sort_key(), next(self._seq), ticket))
+            self._cond.notify()
+
+    def acquire(self):
+        """
+        Attende che ci siano un canale libero, uno slot di originate e una
+        sveglia ammissibile in coda.
+
+        Returns:
+            AdmissionTicket, oppure None se il controller è stato chiuso
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+
+                now = time.time()
+                wait = None
+
+                if self._in_flight < self.max_concurrent and self._heap:
+                    ticket = self._heap[0][2]
+                    ready_at = max(ticket.not_before, self._next_originate_ts)
+                    if ready_at <= now:
+                        heapq.heappop(self._heap)
+                        self._admit(ticket, now)
+                        return ticket
+                    wait = ready_at - now
+
+                self._cond.wait(wait)
+
+    def _admit(self, ticket, now):
+        """Registra l'ammissione (chiamato con il lock acquisito)"""
+        self._in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        self._admitted_total += 1
+        if self.max_rate > 0:
+            self._next_originate_ts = now + 1.0 / self.max_rate
+
+        ticket.admitted_at = now
+        if ticket.attempt == 0:
+            self._max_lateness = max(self._max_lateness, now - ticket.due_ts)
+
+    def release(self, ticket):
+        """Libera il canale occupato da una sveglia terminata"""
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if ticket.admitted_at:
+                duration = time.time() - ticket.admitted_at
+                self._avg_call_duration = 0.8 * self._avg_call_duration + 0.2 * duration
+            self._cond.notify()
+
+    def close(self):
+        """Sblocca tutti i worker in attesa"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self):
+        """Riattiva il controller dopo close()"""
+        with self._cond:
+            self._closed = False
+
+    def throughput(self):
+        """Chiamate al secondo sostenibili con i limiti attuali"""
+        capacity = self.max_concurrent / max(self._avg_call_duration, 0.1)
+        if self.max_rate > 0:
+            capacity = min(capacity, self.max_rate)
+        return capacity
+
+    def get_stats(self):
+        """
+        Statistiche per il dimensionamento del sistema
+
+        Returns:
+            dict con queue_depth, retry_depth, in_flight, max_concurrent, max_rate,
+            avg_call_duration, expected_lateness (secondi per l'ultima sveglia in coda),
+            oldest_wait, max_lateness, peak_in_flight, admitted_total
+        """
+        with self._cond:
+            now = time.time()
+            queue_depth = len(self._heap)
+            retry_depth = sum(1 for _, _, t in self._heap if t.attempt > 0)
+            oldest_wait = max((now - t.due_ts for _, _, t in self._heap if t.attempt == 0), default=0.0)
+
+            return {
+                'queue_depth': queue_depth,
+                'retry_depth': retry_depth,
+                'in_flight': self._in_flight,
+                'max_concurrent': self.max_concurrent,
+                'max_rate': self.max_rate,
+                'avg_call_duration': self._avg_call_duration,
+                'expected_lateness': queue_depth / self.throughput() if queue_depth else 0.0,
+                'oldest_wait': max(0.0, oldest_wait),
+                'max_lateness': self._max_lateness,
+                'peak_in_flight': self._peak_in_flight,
+                'admitted_total': self._admitted_total
+            }
@@ -3,24 +3,68 @@ Gestore delle sveglie e chiamate automatiche
 """
 import threading
 import time
+import heapq
 import logging
 from datetime import datetime, timedelta
 from database import DatabaseManager
 from pbx_connection import PBXManager
+from call_dispatcher import CallDispatcher
+from audio_catalog import AudioCatalog
+from room_cache import RoomCache
+from extension_status import get_extension_status_service
+from db_writer import DatabaseWriter
+from fastagi_server import get_fastagi_server, stop_fastagi_server
+from config import ALARM_CONFIG, PBX_CONFIG
 from logger import get_logger
 
 class AlarmManager:
     def __init__(self, db_manager=None, pbx_manager=None):
         self.db = db_manager or DatabaseManager()
         self.pbx = pbx_manager or PBXManager()
+        self.audio_catalog = AudioCatalog(self.db)
+        self.room_cache = RoomCache(self.db)
+        # Stato interni condiviso con le finestre: controllo prima di ogni chiamata
+        self.extension_status = get_extension_status_service()
+        # Log chiamate e status scritti in background: i worker non attendono SQLite
+        self.writer = DatabaseWriter(self.db)
         self.running = False
         self.alarm_thread = None
         self.logger = get_logger('alarm_manager')
         
         # Configurazione
-        self.check_interval = 30  # secondi
-        self.call_duration = 60   # secondi per chiamata
-        self.max_retries = 3      # tentativi massimi
+        self.resync_interval = 300  # secondi tra due riallineamenti completi col database
+        self.fire_tolerance = 60    # ritardo massimo (secondi) oltre il quale una sveglia è considerata persa
+        self.max_retries = 3        # tentativi massimi
+        
+        # Pool di worker per le chiamate: ognuno con la propria sessione PBX
+        self.dispatcher = CallDispatcher(
+            self._run_alarm,
+            max_workers=ALARM_CONFIG.get('max_concurrent_calls', 4),
+            max_rate=ALARM_CONFIG.get('max_originate_rate', 2.0),
+            max_retries=self.max_retries,
+            retry_delay=ALARM_CONFIG.get('retry_delay', 60),
+            # Squillo + messaggio + attesa esito, come play_audio_with_dtmf
+            call_timeout=PBX_CONFIG.get('ring_timeout', 30) + ALARM_CONFIG.get('call_timeout', 30) + 30
+        )
+        
+        # Scheduler: min-heap di (timestamp, alarm_id) con cancellazione "lazy".
+        # _scheduled_times contiene l'unico timestamp valido per ogni sveglia:
+        # le voci dell'heap che non corrispondono sono obsolete e vengono scartate.
+        self._alarm_heap = []
+        self._scheduled_times = {}
+        self._heap_lock = threading.Lock()
+        self._wakeup_event = threading.Event()
+        self._last_resync = 0
+        # Durante un resync: alarm_id -> timestamp (None = rimossa) delle modifiche
+        # arrivate dopo la lettura dal database, riapplicate al nuovo heap
+        self._load_changes = None
+        
+        # Piani di chiamata precalcolati alla programmazione della sveglia:
+        # (room_number, audio_message_id) -> interno, lingua e audio da usare.
+        # Vanno invalidati quando cambiano camere o messaggi audio.
+        self._call_plans = {}
+        self._plans_version = None   # (versione audio, versione camere) dei piani
+        self._plans_lock = threading.Lock()
     
     def start(self):
         """Avvia il gestore delle sveglie"""
@@ -29,10 +73,29 @@ class AlarmManager:
             return
         
         self.running = True
+        # Al riavvio (es. dopo un ripristino backup) la coda va riletta dal database
+        self._last_resync = 0
+        self.writer.start()
+        
+        # Server FastAGI in ascolto prima delle chiamate che lo usano
+        if PBX_CONFIG.get('fastagi_enabled'):
+            try:
+                get_fastagi_server(PBX_CONFIG)
+            except OSError as e:
+                self.logger.error(f"Impossibile avviare il server FastAGI: {e}")
+        
+        # Fotografia stato interni aggiornata in background per i controlli pre-chiamata
+        self.extension_status.start()
+        
+        self._recover_stale_alarms()
+        self.dispatcher.start()
         self.logger.info("Creazione thread alarm_loop...")
         self.alarm_thread = threading.Thread(target=self._alarm_loop, daemon=True)
         self.alarm_thread.start()
         
+        # Carica in anticipo sul PBX gli audio mancanti: le chiamate non fanno upload
+        threading.Thread(target=self._sync_audio_files, name="audio-sync", daemon=True).start()
+        
         # Verifica che il thread sia partito
         time.sleep(0.1)  # Breve pausa per permettere al thread di inizializzare
         self.logger.info("Gestore sveglie avviato - Thread alive: {}".format(self.alarm_thread.is_alive()))
@@ -40,150 +103,314 @@ class AlarmManager:
     def stop(self):
         """Ferma il gestore delle sveglie"""
         self.running = False
+        self._wakeup_event.set()
         if self.alarm_thread and self.alarm_thread.is_alive():
             # Timeout ridotto per chiusura rapida (daemon thread)
             self.alarm_thread.join(timeout=0.5)
+        # Attende le chiamate in corso: i loro esiti vanno accodati prima dello stop del writer
+        self.dispatcher.stop()
+        self.extension_status.stop()
+        self.writer.stop()
+        stop_fastagi_server()
         self.logger.info("Gestore sveglie fermato")
     
+    def _recover_stale_alarms(self):
+        """
+        Sveglie rimaste 'executing' da un'esecuzione interrotta: nessun worker
+        le concluderà più. Oltre la durata massima di tutti i tentativi passano
+        a 'failed', così non restano nel conteggio delle chiamate in corso e
+        l'archiviatore le raccoglie
+        """
+        try:
+            max_duration = ALARM_CONFIG.get('call_timeout', 30) * self.max_retries
+            recovered = self.db.fail_stale_alarms(time.time() - max_duration)
+            if recovered:
+                self.logger.warning(f"{recovered} sveglie rimaste in esecuzione segnate come fallite")
+        except Exception as e:
+            self.logger.error(f"Errore nel recupero sveglie in esecuzione: {e}")
+    
+    def _sync_audio_files(self):
+        """Allinea tutti gli audio registrati con il PBX (cache upload)"""
+        try:
+            paths = [audio.file_path for audio in self.audio_catalog.get_all()]
+            success, message = self.pbx.pbx.sync_audio_files(paths)
+            if not success:
+                self.logger.warning(f"Sincronizzazione audio non riuscita: {message}")
+        except Exception as e:
+            self.logger.error(f"Errore sincronizzazione audio: {e}")
+    
     def _alarm_loop(self):
-        """Loop principale per il controllo delle sveglie"""
-        self.logger.info("Loop sveglie avviato - check_interval: {}s".format(self.check_interval))
+        """Loop principale: dorme fino alla prossima sveglia o a una modifica della coda"""
+        self.logger.info("Loop sveglie avviato - resync_interval: {}s".format(self.resync_interval))
         
         while self.running:
             try:
-                self.logger.debug("Controllo sveglie in corso...")
+                # Azzera l'evento PRIMA del controllo: una notifica che arriva
+                # durante il controllo fa ripartire subito il ciclo
+                self._wakeup_event.clear()
+                
+                if time.time() - self._last_resync >= self.resync_interval:
+                    self._load_schedule()
+                
                 self._check_pending_alarms()
                 self._cleanup_completed_calls()
                 
-                # Sleep a blocchi per rispondere rapidamente alla chiusura
-                for _ in range(int(self.check_interval)):
-                    if not self.running:
-                        break
-                    time.sleep(1)
+                self._wakeup_event.wait(self._seconds_until_next_alarm())
             except Exception as e:
                 self.logger.error(f"Errore nel loop sveglie: {e}")
                 import traceback
                 self.logger.error(traceback.format_exc())
                 # Attesa più lunga in caso di errore, ma interrompibile
-                for _ in range(10):
-                    if not self.running:
-                        break
-                    time.sleep(1)
+                self._wakeup_event.wait(10)
         
         self.logger.info("Loop sveglie terminato")
     
-    def _check_pending_alarms(self):
-        """Controlla le sveglie in attesa"""
+    def _load_schedule(self):
+        """
+        Ricostruisce l'heap con le sveglie programmate che scadono prima dei
+        prossimi due riallineamenti (range query su alarm_epoch): quelle più
+        lontane entrano nell'heap a un resync successivo
+        """
+        now_ts = time.time()
+        scheduled_times = {}
+        plan_keys = set()
+        
+        with self._heap_lock:
+            known_ids = set(self._scheduled_times)
+            # Le sveglie già in coda restano anche se in ritardo oltre la tolleranza
+            since_ts = min(self._scheduled_times.values(), default=now_ts)
+            # Da qui schedule/unschedule vengono registrati anche per il nuovo heap
+            self._load_changes = {}
+        since_ts = min(since_ts, now_ts - self.fire_tolerance)
+        until_ts = now_ts + 2 * self.resync_interval
+        
         try:
-            # Ottiene le sveglie programmate per ora
-            now = datetime.now()
-            alarms = self.db.get_alarms('scheduled')
-            
-            for alarm in alarms:
-                alarm_time = datetime.fromisoformat(alarm[2])
+            for alarm in self.db.get_due_alarms(until_ts, since_ts):
+                alarm_id = alarm.id
+                due_ts = alarm.alarm_time.timestamp()
                 
-                # Verifica se è il momento della sveglia (con tolleranza di 1 minuto)
-                time_diff = abs((alarm_time - now).total_seconds())
+                # Già consegnata al dispatcher: non va riprogrammata
+                if self.dispatcher.is_pending(alarm_id):
+                    continue
                 
-                if time_diff <= 60:  # Entro 1 minuto
-                    self._execute_alarm(alarm)
+                # Una sveglia già scaduta da oltre la tolleranza quando lo scheduler
+                # la vede per la prima volta (es. all'avvio) è considerata persa
+                if alarm_id not in known_ids and now_ts - due_ts > self.fire_tolerance:
+                    self.logger.warning(f"Sveglia {alarm_id} scaduta da {int(now_ts - due_ts)}s, non eseguita")
+                    continue
+                
+                scheduled_times[alarm_id] = due_ts
+                plan_keys.add((alarm.room_number, alarm.audio_message_id))
+            
+            self._prepare_call_plans(plan_keys)
+        except Exception:
+            with self._heap_lock:
+                self._load_changes = None
+            raise
+        
+        with self._heap_lock:
+            # Sveglie programmate, riprogrammate o rimosse durante la lettura:
+            # valgono sul risultato della query, che può non vederle
+            for alarm_id, due_ts in self._load_changes.items():
+                if due_ts is None:
+                    scheduled_times.pop(alarm_id, None)
+                else:
+                    scheduled_times[alarm_id] = due_ts
+            self._load_changes = None
+            
+            heap = [(due_ts, alarm_id) for alarm_id, due_ts in scheduled_times.items()]
+            heapq.heapify(heap)
+            self._alarm_heap = heap
+            self._scheduled_times = scheduled_times
+        
+        self._last_resync = time.time()
+        self.logger.debug(f"Scheduler riallineato: {len(heap)} sveglie programmate")
+    
+    def _seconds_until_next_alarm(self):
+        """Secondi di attesa fino alla prossima sveglia (al massimo fino al prossimo resync)"""
+        now = time.time()
+        timeout = self.resync_interval - (now - self._last_resync)
+        with self._heap_lock:
+            if self._alarm_heap:
+                timeout = min(timeout, self._alarm_heap[0][0] - now)
+        return max(0, timeout)
+    
+    def schedule_alarm(self, alarm_id, alarm_time):
+        """
+        Inserisce o riprogramma una sveglia nello scheduler
+        
+        Args:
+            alarm_id: ID sveglia nel database
+            alarm_time: datetime o stringa ISO dell'orario sveglia
+        """
+        self.schedule_alarms([(alarm_id, alarm_time)])
+    
+    def schedule_alarms(self, alarms):
+        """
+        Inserisce o riprogramma più sveglie con una sola notifica allo scheduler
+        
+        Args:
+            alarms: iterabile di (alarm_id, alarm_time)
+        """
+        entries = []
+        for alarm_id, alarm_time in alarms:
+            if isinstance(alarm_time, str):
+                alarm_time = datetime.fromisoformat(alarm_time)
+            entries.append((alarm_time.timestamp(), alarm_id))
+        
+        with self._heap_lock:
+            for due_ts, alarm_id in entries:
+                self._scheduled_times[alarm_id] = due_ts
+                heapq.heappush(self._alarm_heap, (due_ts, alarm_id))
+                if self._load_changes is not None:
+                    self._load_changes[alarm_id] = due_ts
+            
+            # Compatta l'heap se le voci obsolete superano quelle valide
+            if len(self._alarm_heap) > 2 * len(self._scheduled_times) + 64:
+                self._alarm_heap = [(ts, a_id) for a_id, ts in self._scheduled_times.items()]
+                heapq.heapify(self._alarm_heap)
+        
+        self._wakeup_event.set()
+    
+    def unschedule_alarm(self, alarm_id):
+        """Rimuove una sveglia dallo scheduler (la voce nell'heap diventa obsoleta)"""
+        with self._heap_lock:
+            self._scheduled_times.pop(alarm_id, None)
+            if self._load_changes is not None:
+                self._load_changes[alarm_id] = None
+        self._wakeup_event.set()
+    
+    def _pop_due_alarms(self, now_ts):
+        """Estrae dall'heap le sveglie scadute, scartando le voci obsolete"""
+        due = []
+        with self._heap_lock:
+            while self._alarm_heap and self._alarm_heap[0][0] <= now_ts:
+                due_ts, alarm_id = heapq.heappop(self._alarm_heap)
+                if self._scheduled_times.get(alarm_id) != due_ts:
+                    continue
+                del self._scheduled_times[alarm_id]
+                due.append((due_ts, alarm_id))
+        return due
+    
+    def _check_pending_alarms(self):
+        """Consegna al dispatcher le sveglie scadute in cima all'heap"""
+        try:
+            for due_ts, alarm_id in self._pop_due_alarms(time.time()):
+                self.dispatcher.submit(alarm_id, due_ts)
                     
         except Exception as e:
             self.logger.error(f"Errore nel controllo sveglie: {e}")
     
-    def _execute_alarm(self, alarm):
-        """Esegue una sveglia specifica con supporto snooze"""
-        alarm_id = alarm[0]
-        room_number = alarm[1]
-        audio_message_id = alarm[3]
+    def _run_alarm(self, ticket, pbx_connection):
+        """
+        Eseguito da un worker del dispatcher con la sua sessione PBX
+        
+        Returns:
+            True se la sveglia è fallita e va ritentata
+        """
+        alarm_id = ticket.alarm_id
+        
+        # Transizione atomica scheduled -> executing: una sveglia cancellata o
+        # modificata nel frattempo, o già presa da un altro worker, viene saltata
+        if not self.db.transition_alarm_status(alarm_id, 'scheduled', 'executing', fired_epoch=time.time()):
+            self.logger.info(f"Sveglia {alarm_id} non più programmata, skip")
+            return False
+        
+        alarm = self.db.get_alarm(alarm_id)
+        concurrent_calls = len(self.dispatcher.get_active_calls())
+        success = self._execute_alarm(alarm, pbx_connection)
+        
+        if not success:
+            # Lo status finale è scritto solo se la sveglia è ancora in
+            # esecuzione (compare-and-set): nessuna scrittura cieca dal worker
+            if ticket.attempt < self.max_retries:
+                # Torna programmata per il retry
+                return self.db.transition_alarm_status(alarm_id, 'executing', 'scheduled')
+            self.writer.update_alarm_status(alarm_id, "failed", from_status='executing')
         
+        self._record_alarm_outcome(alarm, success, concurrent_calls)
+        return False
+    
+    def _record_alarm_outcome(self, alarm, success, concurrent_calls):
+        """Aggiorna le statistiche orarie con l'esito finale della sveglia"""
         try:
-            # Ottiene l'interno telefonico della camera
-            room_data = self.db.get_room(room_number)
-            if not room_data:
+            # In caso di successo l'esito (completed/snoozed) è lo status scritto
+            # da _execute_alarm_with_snooze, letto dal writer dopo averlo applicato
+            outcome = None if success else 'failed'
+            # fired_epoch è quello del primo tentativo: il ritardo include i retry
+            lateness = alarm.fired_epoch - alarm.alarm_epoch if alarm.fired_epoch is not None else None
+            self.writer.record_alarm_outcome(alarm.id, alarm.alarm_epoch, outcome, lateness, concurrent_calls)
+        except Exception as e:
+            self.logger.error(f"Errore aggiornamento statistiche sveglia {alarm.id}: {e}")
+    
+    def _execute_alarm(self, alarm, pbx_connection=None):
+        """
+        Esegue una sveglia specifica con supporto snooze (True se la chiamata è riuscita)
+        
+        In caso di errore la sveglia resta 'executing': retry o status
+        'failed' li decide _run_alarm
+        """
+        alarm_id = alarm.id
+        room_number = alarm.room_number
+        audio_message_id = alarm.audio_message_id
+        
+        try:
+            # Interno, lingua e audio risolti alla programmazione della sveglia
+            plan = self.get_call_plan(room_number, audio_message_id)
+            if not plan:
                 self.logger.error(f"Camera {room_number} non trovata")
-                self.db.update_alarm_status(alarm_id, "failed")
-                return
-            
-            # Usa l'interno telefonico se specificato, altrimenti il numero camera
-            phone_extension = room_data[2] if len(room_data) > 2 and room_data[2] else room_number
-            
-            # Ottiene il file audio principale (wake_up) E la sua lingua
-            audio_file_path = None
-            room_language = 'it'  # Default
-            
-            if audio_message_id:
-                audio_messages = self.db.get_audio_messages()
-                for msg in audio_messages:
-                    if msg[0] == audio_message_id:
-                        audio_file_path = msg[2]  # file_path
-                        # Recupera la lingua dall'audio wake_up selezionato
-                        room_language = msg[5] if len(msg) > 5 and msg[5] else 'it'
-                        self.logger.info(f"Audio wake_up: {msg[1]}, Lingua: {room_language}")
-                        break
-            
-            # Se non c'è audio message, usa la lingua della camera come fallback
-            if not audio_message_id and len(room_data) > 8 and room_data[8]:
-                room_language = room_data[8]
-            
-            # Avvia la chiamata con DTMF per snooze
-            success, dtmf_digit = self._execute_alarm_with_snooze(
-                phone_extension, 
-                audio_file_path,
-                alarm_id,
-                room_number,
-                room_language  # Passa la lingua della camera
+                return False
+            
+            phone_extension = plan['phone_extension']
+            
+            # Interno offline secondo lo stato condiviso (solo memoria, nessun
+            # poll dal worker): nessuna originate, la sveglia segue il percorso
+            # dei retry. Stato sconosciuto o fotografia scaduta = si chiama
+            if self.extension_status.cached_reachability(phone_extension) is False:
+                self.logger.warning(f"Interno {phone_extension} della camera {room_number} non raggiungibile, chiamata non avviata")
+                self.writer.add_call_log(
+                    alarm_id=alarm_id,
+                    room_number=room_number,
+                    call_time=datetime.now(),
+                    status="unreachable"
+                )
+                return False
+            
+            # Log dell'avvio chiamata
+            self.writer.add_call_log(
+                alarm_id=alarm_id,
+                room_number=room_number,
+                call_time=datetime.now(),
+                status="initiated"
             )
             
+            # Avvia la chiamata con DTMF per snooze (bloccante fino a fine chiamata).
+            # Lo status finale (completed/snoozed) viene scritto da _execute_alarm_with_snooze
+            success, dtmf_digit = self._execute_alarm_with_snooze(plan, alarm_id, pbx_connection)
+            
             if success:
-                # Aggiorna lo status della sveglia
-                self.db.update_alarm_status(alarm_id, "executing")
-                
-                # Log della chiamata
-                self.db.add_call_log(
+                self.writer.add_call_log(
                     alarm_id=alarm_id,
                     room_number=room_number,
                     call_time=datetime.now(),
-                    status="initiated"
+                    response=dtmf_digit,
+                    status="snoozed" if dtmf_digit else "completed"
                 )
-                
                 self.logger.info(f"Sveglia eseguita per camera {room_number} (interno {phone_extension})")
-                
-                # Programma la terminazione della chiamata
-                threading.Timer(self.call_duration, self._end_alarm_call, 
-                              args=[alarm_id, phone_extension]).start()
+                return True
             else:
                 self.logger.error(f"Errore nell'esecuzione sveglia camera {room_number}")
-                self.db.update_alarm_status(alarm_id, "failed")
-                
-        except Exception as e:
-            self.logger.error(f"Errore nell'esecuzione sveglia: {e}")
-            self.db.update_alarm_status(alarm_id, "failed")
-    
-    def _end_alarm_call(self, alarm_id, phone_extension):
-        """Termina una chiamata di sveglia"""
-        try:
-            # Termina la chiamata
-            success, message = self.pbx.end_alarm_call(phone_extension)
-            
-            if success:
-                # Aggiorna lo status
-                self.db.update_alarm_status(alarm_id, "completed")
-                
-                # Log della terminazione
-                self.db.add_call_log(
+                self.writer.add_call_log(
                     alarm_id=alarm_id,
-                    room_number="",  # Non abbiamo il numero camera qui
+                    room_number=room_number,
                     call_time=datetime.now(),
-                    status="completed"
+                    status="failed"
                 )
-                
-                self.logger.info(f"Chiamata sveglia terminata per interno {phone_extension}")
-            else:
-                self.logger.error(f"Errore nella terminazione chiamata interno {phone_extension}: {message}")
+                return False
                 
         except Exception as e:
-            self.logger.error(f"Errore nella terminazione chiamata: {e}")
+            self.logger.error(f"Errore nell'esecuzione sveglia: {e}")
+            return False
     
     def _cleanup_completed_calls(self):
         """Pulisce le chiamate completate"""
@@ -192,48 +419,113 @@ class AlarmManager:
         except Exception as e:
             self.logger.error(f"Errore nella pulizia chiamate: {e}")
     
+    def add_alarm(self, room_number, alarm_time, audio_message_id=None, snooze_count=0):
+        """
+        Aggiunge una sveglia al database e allo scheduler
+        
+        Args:
+            room_number: Numero camera
+            alarm_time: datetime o stringa ISO dell'orario sveglia
+            audio_message_id: ID messaggio audio (opzionale)
+            snooze_count: Numero di rinvii già effettuati
+            
+        Returns:
+            ID della nuova sveglia
+        """
+        if isinstance(alarm_time, str):
+            alarm_time = datetime.fromisoformat(alarm_time)
+        
+        alarm_id = self.db.add_alarm(room_number, alarm_time.isoformat(), audio_message_id, snooze_count)
+        self._prepare_call_plans([(room_number, audio_message_id)])
+        self.schedule_alarm(alarm_id, alarm_time)
+        return alarm_id
+    
+    def add_group_alarms(self, alarm_time, room_numbers=None, room_range=None, label=None):
+        """
+        Sveglia di gruppo: stessa ora per tutte le camere selezionate, audio
+        nella lingua di ciascuna camera
+        
+        Args:
+            alarm_time: datetime o stringa ISO dell'orario sveglia
+            room_numbers: lista di numeri camera
+            room_range: (prima, ultima) camera, inclusi
+            label: etichetta delle camere (es. nome del gruppo)
+            
+        Returns:
+            lista di (alarm_id, room_number, audio_message_id); audio None se
+            manca il messaggio nella lingua della camera
+        """
+        if isinstance(alarm_time, str):
+            alarm_time = datetime.fromisoformat(alarm_time)
+        
+        rooms = self.db.select_rooms(room_numbers, room_range, label)
+        entries = []
+        for room in rooms:
+            msg = self.audio_catalog.find('wake_up', room.language or 'it')
+            entries.append((room.room_number, alarm_time, msg.id if msg else None))
+        
+        alarm_ids = self.db.add_alarms(entries)
+        self._prepare_call_plans([(room_number, audio_id) for room_number, _, audio_id in entries])
+        self.schedule_alarms([(alarm_id, alarm_time) for alarm_id in alarm_ids])
+        
+        self.logger.info(f"Sveglia di gruppo alle {alarm_time.strftime('%H:%M')}: {len(alarm_ids)} camere")
+        return [(alarm_id, room_number, audio_id)
+                for alarm_id, (room_number, _, audio_id) in zip(alarm_ids, entries)]
+    
+    def update_alarm(self, alarm_id, alarm_time=None, audio_message_id=None):
+        """Aggiorna una sveglia e, se cambia l'orario, la riprogramma nello scheduler"""
+        if isinstance(alarm_time, datetime):
+            alarm_time = alarm_time.isoformat()
+        
+        affected = self.db.update_alarm(alarm_id, alarm_time, audio_message_id)
+        
+        if affected and (alarm_time or audio_message_id):
+            alarm = self.db.get_alarm(alarm_id)
+            if alarm and alarm.status == 'scheduled':
+                self._prepare_call_plans([(alarm.room_number, alarm.audio_message_id)])
+                if alarm_time:
+                    self.schedule_alarm(alarm_id, alarm_time)
+        
+        return affected
+    
     def snooze_alarm(self, alarm_id, snooze_minutes):
         """Posticipa una sveglia"""
         try:
             # Ottiene la sveglia
-            alarms = self.db.get_alarms()
-            alarm = None
-            for a in alarms:
-                if a[0] == alarm_id:
-                    alarm = a
-                    break
+            alarm = self.db.get_alarm(alarm_id)
             
             if not alarm:
                 return False, "Sveglia non trovata"
             
             # Calcola la nuova ora
-            current_time = datetime.fromisoformat(alarm[2])
-            new_time = current_time + timedelta(minutes=snooze_minutes)
+            new_time = alarm.alarm_time + timedelta(minutes=snooze_minutes)
             
             # Aggiorna il conteggio rinvii
-            current_snooze_count = alarm[5] if len(alarm) > 5 else 0
-            new_snooze_count = current_snooze_count + 1
+            new_snooze_count = (alarm.snooze_count or 0) + 1
             
             # Crea una nuova sveglia posticipata con conteggio rinvii
-            new_alarm_id = self.db.add_alarm(
-                room_number=alarm[1],
-                alarm_time=new_time.isoformat(),
-                audio_message_id=alarm[3],
+            new_alarm_id = self.add_alarm(
+                room_number=alarm.room_number,
+                alarm_time=new_time,
+                audio_message_id=alarm.audio_message_id,
                 snooze_count=new_snooze_count
             )
             
             # Aggiorna lo status della sveglia originale
-            self.db.update_alarm_status(alarm_id, "snoozed")
+            self.writer.update_alarm_status(alarm_id, "snoozed")
+            self.unschedule_alarm(alarm_id)
             
             # Log del rinvio
-            self.db.add_call_log(
+            self.writer.add_call_log(
                 alarm_id=alarm_id,
-                room_number=alarm[1],
+                room_number=alarm.room_number,
                 call_time=datetime.now(),
                 snooze_minutes=snooze_minutes,
                 status="snoozed"
             )
             
+            # L'interfaccia ricarica subito la lista sveglie
+            self.writer.flush()
             self.logger.info(f"Sveglia {alarm_id} posticipata di {snooze_minutes} minuti")
             return True, f"Sveglia posticipata di {snooze_minutes} minuti"
             
@@ -242,18 +534,42 @@ class AlarmManager:
             return False, str(e)
     
     def cancel_alarm(self, alarm_id):
-        """Cancella una sveglia"""
+        """
+        Cancella una sveglia
+        
+        Solo con compare-and-set sullo status letto: una sveglia che un worker
+        ha già in esecuzione non viene toccata (il suo esito la sovrascriverebbe
+        e un retry richiamerebbe l'ospite)
+        """
         try:
-            self.db.update_alarm_status(alarm_id, "cancelled")
+            # Dopo le scritture accodate: lo status letto è quello corrente
+            self.writer.flush()
+            alarm = self.db.get_alarm(alarm_id)
+            if not alarm:
+                return False, "Sveglia non trovata"
+            if alarm.status == 'executing':
+                return False, "Chiamata di sveglia in corso, impossibile cancellarla"
+            if alarm.status != 'cancelled':
+                # Le sveglie concluse restano eliminabili dalla lista
+                if not self.db.transition_alarm_status(alarm_id, alarm.status, 'cancelled'):
+                    # Presa da un worker tra la lettura e la cancellazione
+                    return False, "Chiamata di sveglia in corso, impossibile cancellarla"
+            self.unschedule_alarm(alarm_id)
+            
+            # Nelle statistiche contano solo le sveglie cancellate prima di partire
+            if alarm.fired_epoch is None and alarm.status == 'scheduled':
+                self.writer.record_alarm_outcome(alarm_id, alarm.alarm_epoch, 'cancelled')
             
             # Log della cancellazione
-            self.db.add_call_log(
+            self.writer.add_call_log(
                 alarm_id=alarm_id,
-                room_number="",
+                room_number=alarm.room_number,
                 call_time=datetime.now(),
                 status="cancelled"
             )
             
+            # L'interfaccia ricarica subito la lista sveglie
+            self.writer.flush()
             self.logger.info(f"Sveglia {alarm_id} cancellata")
             return True, "Sveglia cancellata"
             
@@ -264,52 +580,63 @@ class AlarmManager:
     def get_alarm_status(self, alarm_id):
         """Ottiene lo status di una sveglia"""
         try:
-            alarms = self.db.get_alarms()
-            for alarm in alarms:
-                if alarm[0] == alarm_id:
-                    return {
-                        'id': alarm[0],
-                        'room': alarm[1],
-                        'time': alarm[2],
-                        'status': alarm[4],
-                        'snooze_count': alarm[5] if len(alarm) > 5 else 0
-                    }
+            alarm = self.db.get_alarm(alarm_id)
+            if alarm:
+                return {
+                    'id': alarm.id,
+                    'room': alarm.room_number,
+                    'time': alarm.alarm_time.isoformat(),
+                    'status': alarm.status,
+                    'snooze_count': alarm.snooze_count or 0
+                }
             return None
         except Exception as e:
             self.logger.error(f"Errore nel recupero status sveglia: {e}")
             return None
     
+    def get_dispatch_stats(self):
+        """Statistiche di coda delle chiamate (profondità, ritardo stimato, picchi)"""
+        return self.dispatcher.get_stats()
+    
     def get_active_calls(self):
-        """Ottiene le chiamate attive"""
-        return self.pbx.get_active_calls()
+        """Ottiene le chiamate attive (manuali e sveglie in esecuzione sui worker)"""
+        active_calls = self.pbx.get_active_calls()
+        for alarm_id, start_time in self.dispatcher.get_active_calls().items():
+            active_calls[f"alarm_{alarm_id}"] = {
+                'start_time': start_time,
+                'status': 'executing'
+            }
+        return active_calls
     
     def test_pbx_connection(self):
         """Testa la connessione al centralino"""
         return self.pbx.pbx.test_connection()
     
-    def _execute_alarm_with_snooze(self, phone_extension, wake_audio_path, alarm_id, room_number, language='it'):
+    def _execute_alarm_with_snooze(self, plan, alarm_id, pbx_connection=None):
         """
         Esegue sveglia con opzioni snooze tramite DTMF
         
         Args:
-            phone_extension: Interno telefonico
-            wake_audio_path: File audio sveglia principale
+            plan: Piano di chiamata (vedi get_call_plan)
             alarm_id: ID sveglia nel database
-            room_number: Numero camera
-            language: Lingua della camera (it, en, etc.)
+            pbx_connection: Sessione PBX da usare (default quella del PBXManager)
             
         Returns:
             (success, dtmf_digit): Success e tasto premuto
         """
+        pbx = pbx_connection or self.pbx.pbx
+        room_number = plan['room_number']
+        phone_extension = plan['phone_extension']
+        language = plan['language']
+        snooze_5_audio = plan['snooze_5_audio']
+        snooze_10_audio = plan['snooze_10_audio']
+        
         try:
             self.logger.info("="*60)
             self.logger.info(f"SVEGLIA CON SNOOZE - Camera {room_number} - Interno {phone_extension} - Lingua: {language.upper()}")
             self.logger.info("="*60)
             
-            # 1. Ottieni audio di conferma PRIMA della chiamata
-            snooze_5_audio = self._get_audio_by_action('snooze_confirm', language, '5')
-            snooze_10_audio = self._get_audio_by_action('snooze_confirm', language, '10')
-            
+            # 1. Audio di conferma (già risolti nel piano di chiamata)
             if snooze_5_audio:
                 self.logger.info(f"Audio conferma 5min: {snooze_5_audio}")
             if snooze_10_audio:
@@ -317,16 +644,16 @@ class AlarmManager:
             
             # 2. Chiamata + riproduzione audio + DTMF + conferma in UNA SOLA chiamata
             self.logger.info(f"Avvio chiamata con audio, DTMF e conferma...")
-            success, dtmf_digit = self.pbx.pbx.play_audio_with_dtmf(
+            success, dtmf_digit = pbx.play_audio_with_dtmf(
                 phone_extension,
-                wake_audio_path,
+                plan['wake_audio'],
                 snooze_5_audio=snooze_5_audio,
                 snooze_10_audio=snooze_10_audio,
                 timeout=30
             )
             
             if not success:
-                self.logger.error("Errore nella riproduzione audio")
+                self.logger.error("Chiamata non riuscita o non risposta")
                 return False, None
             
             # 3. Gestisce risposta DTMF e riprogramma
@@ -343,25 +670,27 @@ class AlarmManager:
             else:
                 # Nessun snooze - cliente ha chiuso/non ha premuto nulla
                 self.logger.info(f"Nessuno snooze richiesto - Cliente ha chiuso o timeout")
-                self.db.update_alarm_status(alarm_id, "completed")
+                self.writer.update_alarm_status(alarm_id, "completed", from_status='executing')
                 return True, None
             
             # 4. Riprogramma sveglia
             new_alarm_time = datetime.now() + timedelta(minutes=snooze_minutes)
             self.logger.info(f"Riprogrammazione sveglia per {new_alarm_time.strftime('%H:%M')}")
             
-            # Aggiorna sveglia esistente
-            self.db.update_alarm_status(alarm_id, "snoozed")
+            # Aggiorna sveglia esistente (solo se ancora in esecuzione)
+            if not self.db.transition_alarm_status(alarm_id, 'executing', 'snoozed'):
+                self.logger.warning(f"Sveglia {alarm_id} non più in esecuzione, rinvio non programmato")
+                return True, dtmf_digit
             
             # Crea nuova sveglia per snooze - USA LO STESSO AUDIO_MESSAGE_ID E INCREMENTA SNOOZE_COUNT
             alarm_data = self.db.get_alarm(alarm_id)
-            original_audio_id = alarm_data[3] if alarm_data and len(alarm_data) > 3 else None
-            current_snooze_count = alarm_data[5] if alarm_data and len(alarm_data) > 5 else 0
+            original_audio_id = alarm_data.audio_message_id if alarm_data else None
+            current_snooze_count = (alarm_data.snooze_count or 0) if alarm_data else 0
             new_snooze_count = current_snooze_count + 1
             
-            self.db.add_alarm(
+            self.add_alarm(
                 room_number,
-                new_alarm_time.isoformat(),
+                new_alarm_time,
                 audio_message_id=original_audio_id,  # Usa stesso audio della sveglia originale
                 snooze_count=new_snooze_count  # Incrementa contatore rinvii
             )
@@ -375,44 +704,92 @@ class AlarmManager:
             self.logger.error(f"Errore esecuzione sveglia con snooze: {e}")
             return False, None
     
-    def _get_audio_by_action(self, action_type, language='it', variant=None):
+    def get_call_plan(self, room_number, audio_message_id=None):
         """
-        Ottiene file audio per azione specifica
+        Piano di chiamata di una sveglia (dalla cache, calcolato se manca)
         
-        Args:
-            action_type: 'wake_up', 'snooze_confirm', 'goodbye'
-            language: Codice lingua (it, en, etc.)
-            variant: Variante specifica (es. '5min', '10min')
-            
         Returns:
-            path del file audio o None
+            dict con room_number, phone_extension, language, wake_audio,
+            snooze_5_audio, snooze_10_audio; None se la camera non esiste
         """
+        key = (room_number, audio_message_id)
+        version = (self.audio_catalog.version(), self.room_cache.version())
+        with self._plans_lock:
+            plan = self._call_plans.get(key) if version == self._plans_version else None
+        if plan is None:
+            self._prepare_call_plans([key])
+            with self._plans_lock:
+                plan = self._call_plans.get(key)
+        return plan
+    
+    def invalidate_call_plans(self):
+        """Scarta i piani di chiamata (camere o messaggi audio modificati)"""
+        with self._plans_lock:
+            self._call_plans.clear()
+        self.logger.info("Piani di chiamata invalidati")
+    
+    def _prepare_call_plans(self, keys):
+        """
+        Calcola i piani di chiamata mancanti dalle cache di camere e
+        messaggi audio
+        
+        Args:
+            keys: coppie (room_number, audio_message_id)
+        """
+        # Camere o messaggi audio modificati: i piani esistenti non sono più validi
+        version = (self.audio_catalog.version(), self.room_cache.version())
+        with self._plans_lock:
+            if version != self._plans_version:
+                self._call_plans.clear()
+                self._plans_version = version
+            missing = [key for key in keys if key not in self._call_plans]
+        if not missing:
+            return
+        
         try:
-            audio_messages = self.db.get_audio_messages()
-            
-            for msg in audio_messages:
-                # msg = (id, name, file_path, duration, category, language, action_type, created_at)
-                msg_action = msg[6] if len(msg) > 6 else None
-                msg_language = msg[5] if len(msg) > 5 else 'it'
-                msg_name = msg[1]
+            plans = {}
+            for room_number, audio_message_id in missing:
+                room_data = self.room_cache.get(room_number)
+                if not room_data:
+                    continue
+                
+                # Usa l'interno telefonico se specificato, altrimenti il numero camera
+                phone_extension = room_data.phone_extension or room_number
+                
+                # La lingua è quella dell'audio wake_up selezionato; senza audio
+                # si usa la lingua della camera
+                wake_audio = None
+                language = 'it'
+                if audio_message_id:
+                    msg = self.audio_catalog.get(audio_message_id)
+                    if msg:
+                        wake_audio = msg.file_path
+                        language = msg.language or 'it'
+                elif room_data.language:
+                    language = room_data.language
+                
+                plans[(room_number, audio_message_id)] = {
+                    'room_number': room_number,
+                    'phone_extension': phone_extension,
+                    'language': language,
+                    'wake_audio': wake_audio,
+                    'snooze_5_audio': self._find_audio_path('snooze_confirm', language, '5'),
+                    'snooze_10_audio': self._find_audio_path('snooze_confirm', language, '10')
+                }
+            
+            with self._plans_lock:
+                self._call_plans.update(plans)
                 
-                # Match per action type e lingua
-                if msg_action == action_type and msg_language.lower() == language.lower():
-                    # Se variant specificato, cerca nel nome
-                    if variant:
-                        if variant.lower() in msg_name.lower():
-                            self.logger.info(f"Audio trovato: {msg_name} ({action_type}, {language}, {variant})")
-                            return msg[2]  # file_path
-                    else:
-                        self.logger.info(f"Audio trovato: {msg_name} ({action_type}, {language})")
-                        return msg[2]  # file_path
-            
-            self.logger.warning(f"Audio non trovato: {action_type}, {language}, {variant}")
-            return None
-            
         except Exception as e:
-            self.logger.error(f"Errore ricerca audio: {e}")
+            self.logger.error(f"Errore preparazione piani di chiamata: {e}")
+    
+    def _find_audio_path(self, action_type, language='it', variant=None):
+        """Path del file audio per azione, lingua e variante (None se assente)"""
+        msg = self.audio_catalog.find(action_type, language, variant)
+        if not msg:
+            self.logger.warning(f"Audio non trovato: {action_type}, {language}, {variant}")
             return None
+        return msg.file_path
 
 if __name__ == "__main__":
     # Test del modulo
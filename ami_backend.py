@@ -0,0 +1,573 @@
+"""
+Backend AMI (Asterisk Manager Interface) per il centralino PBX
+"""
+import itertools
+import socket
+import threading
+import time
+from datetime import datetime
+from logger import get_logger
+from pbx_backend import PBXBackend, NO_ANSWER
+
+AMI_DEFAULT_PORT = 5038
+
+# Eventi necessari alle chiamate: OriginateResponse/Hangup (call) e DTMFEnd (dtmf)
+AMI_EVENT_MASK = 'call,dtmf'
+
+_action_ids = itertools.count(1)
+
+
+class AMIParser:
+    """
+    Scompone il flusso AMI in messaggi (dict chiave -> valore).
+
+    Ogni messaggio è una serie di righe "Chiave: valore" chiusa da una riga
+    vuota. L'output di Action: Command arriva come righe "Output:" ripetute
+    (Asterisk 14+) oppure, con "Response: Follows", come testo libero fino
+    a "--END COMMAND--" (Asterisk 13 e precedenti): in entrambi i casi è
+    restituito nella chiave 'Output'.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._message = {}
+        self._output = []
+        self._follows = False
+
+    def feed(self, data):
+        """Aggiunge dati ricevuti e restituisce i messaggi completati"""
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\r\n')
+        messages = []
+        for raw in lines:
+            message = self._handle_line(raw.decode('utf-8', errors='replace'))
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def _handle_line(self, line):
+        if self._follows:
+            if line == '--END COMMAND--':
+                self._follows = False
+            else:
+                self._output.append(line)
+            return None
+
+        if line == '':
+            if not self._message:
+                return None
+            message = self._message
+            if self._output:
+                message['Output'] = '\n'.join(self._output)
+            self._message = {}
+            self._output = []
+            return message
+
+        key, _, value = line.partition(':')
+        key = key.strip()
+        value = value.strip()
+        if key == 'Output':
+            self._output.append(value)
+        else:
+            self._message[key] = value
+        # Formato "Follows": l'output segue l'ActionID come testo libero
+        if key == 'ActionID' and self._message.get('Response') == 'Follows':
+            self._follows = True
+        return None
+
+
+class _ActionWaiter:
+    __slots__ = ('done', 'response')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class _PendingCall:
+    """Stato di una chiamata wakeup-service in attesa di esito"""
+
+    __slots__ = ('call_id', 'channel_id', 'uniqueids', 'answered', 'result', 'done')
+
+    def __init__(self, call_id, channel_id):
+        self.call_id = call_id
+        self.channel_id = channel_id
+        self.uniqueids = {channel_id}   # canali che eseguono wakeup-service
+        self.answered = False
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result):
+        """Registra l'esito (conta solo il primo)"""
+        if not self.done.is_set():
+            self.result = result
+            self.done.set()
+
+
+class _AMISession:
+    """
+    Sessione TCP persistente verso l'AMI condivisa da tutte le PBXConnection
+    verso lo stesso PBX (stesso host, porta e credenziali AMI).
+
+    Le azioni sono inviate da qualunque thread e correlate alla risposta
+    tramite ActionID; un unico thread lettore smista risposte ed eventi.
+    Gli eventi OriginateResponse, DTMFEnd e Hangup sono ricondotti alla
+    chiamata che li ha generati tramite ActionID, Uniqueid e Linkedid.
+    Dopo un errore di connessione i tentativi sono distanziati con backoff
+    esponenziale, come per la sessione SSH.
+    """
+
+    MAX_BACKOFF = 60  # secondi
+
+    def __init__(self, config):
+        self.config = config
+        self.sock = None
+        self.connected = False
+        self.last_connection_time = None
+        self.logger = get_logger('ami_backend')
+
+        self._connect_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._failures = 0
+        self._next_attempt_ts = 0
+
+        self._waiters = {}          # ActionID -> _ActionWaiter
+        self._calls = {}            # call_id -> _PendingCall
+        self._calls_by_action = {}  # ActionID dell'Originate -> _PendingCall
+        self._calls_by_channel = {} # Uniqueid/Linkedid -> _PendingCall
+
+    def is_active(self):
+        """Stato della sessione (nessun comando remoto)"""
+        return self.connected
+
+    def ensure_connected(self, force=False):
+        """
+        Apre la sessione se non è attiva
+
+        Args:
+            force: ignora il backoff (es. test manuale della connessione)
+
+        Raises:
+            ConnectionError / OSError se la connessione o il login falliscono
+        """
+        if self.connected:
+            return
+
+        with self._connect_lock:
+            if self.connected:
+                return
+
+            now = time.time()
+            if not force and now < self._next_attempt_ts:
+                raise ConnectionError(
+                    f"Riconnessione AMI in backoff per altri {self._next_attempt_ts - now:.0f}s")
+
+            try:
+                self._open()
+            except Exception:
+                self._failures += 1
+                self._next_attempt_ts = time.time() + min(self.MAX_BACKOFF, 2 ** self._failures)
+                raise
+
+            self._failures = 0
+            self._next_attempt_ts = 0
+            self.last_connection_time = datetime.now()
+            self.logger.info(f"Connessione AMI stabilita con {self.config['host']}")
+
+    def _open(self):
+        """Connessione TCP, banner e login"""
+        timeout = self.config.get('timeout', 10)
+        sock = socket.create_connection(
+            (self.config['host'], self.config.get('ami_port', AMI_DEFAULT_PORT)), timeout=timeout)
+        # Azioni brevi e frequenti: niente attesa di Nagle
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        reader_started = False
+        try:
+            # Banner "Asterisk Call Manager/x.y"
+            pending = b''
+            while b'\r\n' not in pending:
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Connessione AMI chiusa dal server")
+                pending += data
+            banner, pending = pending.split(b'\r\n', 1)
+            self.logger.debug(f"Banner AMI: {banner.decode('utf-8', errors='replace')}")
+
+            # Il lettore usa il timeout di ricezione per inviare i keepalive
+            sock.settimeout(self.config.get('keepalive_interval', 30))
+            self.sock = sock
+            threading.Thread(target=self._reader_loop, args=(sock, pending),
+                             name="ami-reader", daemon=True).start()
+            reader_started = True
+
+            # Il Login viaggia sul socket in apertura: la sessione risulta
+            # connessa (e usabile dagli altri thread) solo dopo il Success
+            response = self._request_many([('Login', [
+                ('Username', self.config.get('ami_username', '')),
+                ('Secret', self.config.get('ami_secret', '')),
+                ('Events', AMI_EVENT_MASK),
+            ])], timeout, sock=sock)[0]
+            if response.get('Response') != 'Success':
+                raise ConnectionError(f"Login AMI rifiutato: {response.get('Message', '')}")
+            self.connected = True
+        except Exception:
+            self._drop(sock, close=not reader_started)
+            raise
+
+    def send_action(self, action, fields=(), timeout=None, call=None):
+        """
+        Invia un'azione e attende la risposta con lo stesso ActionID
+
+        Args:
+            fields: lista di (chiave, valore); le chiavi possono ripetersi
+            call: _PendingCall a cui ricondurre l'OriginateResponse
+
+        Returns:
+            dict della risposta
+
+        Raises:
+            ConnectionError / OSError / TimeoutError
+        """
+        self.ensure_connected()
+        return self._request(action, fields, timeout, call)
+
+    def send_actions(self, actions, timeout=None):
+        """
+        Invia più azioni in un'unica scrittura e ne attende tutte le risposte
+        (pipeline: un solo round-trip invece di uno per azione)
+
+        Args:
+            actions: lista di (azione, campi)
+
+        Returns:
+            lista delle risposte, nello stesso ordine delle azioni
+        """
+        self.ensure_connected()
+        return self._request_many(actions, timeout)
+
+    def _request(self, action, fields, timeout=None, call=None):
+        return self._request_many([(action, fields)], timeout, call)[0]
+
+    def _request_many(self, actions, timeout=None, call=None, sock=None):
+        waiters = []
+        messages = []
+        with self._state_lock:
+            for action, fields in actions:
+                action_id = str(next(_action_ids))
+                waiter = _ActionWaiter()
+                self._waiters[action_id] = waiter
+                if call is not None:
+                    self._calls_by_action[action_id] = call
+                waiters.append((action, action_id, waiter))
+                messages.append([('Action', action), ('ActionID', action_id)] + list(fields))
+
+        try:
+            self._write(*messages, sock=sock)
+            deadline = time.monotonic() + (timeout or self.config.get('timeout', 10))
+            for action, action_id, waiter in waiters:
+                if not waiter.done.wait(max(0, deadline - time.monotonic())):
+                    raise TimeoutError(f"Nessuna risposta AMI a {action}")
+        finally:
+            with self._state_lock:
+                for action, action_id, waiter in waiters:
+                    self._waiters.pop(action_id, None)
+
+        responses = [waiter.response for action, action_id, waiter in waiters]
+        if any(response is None for response in responses):
+            raise ConnectionError("Connessione AMI persa")
+        return responses
+
+    def _write(self, *messages, sock=None):
+        """
+        Invia uno o più messaggi (liste di (chiave, valore)) con un'unica sendall
+
+        Args:
+            sock: socket su cui scrivere anche se la sessione non è ancora
+                connessa (login, keepalive del lettore); default la sessione
+        """
+        if sock is None:
+            sock = self.sock if self.connected else None
+        if sock is None:
+            raise ConnectionError("Connessione AMI non attiva")
+        # Un a capo nei valori romperebbe il framing del protocollo
+        data = ''.join(
+            ''.join(f"{key}: {str(value).replace(chr(13), ' ').replace(chr(10), ' ')}\r\n"
+                    for key, value in fields) + '\r\n'
+            for fields in messages)
+        try:
+            with self._send_lock:
+                sock.sendall(data.encode('utf-8'))
+        except OSError:
+            self._drop(sock)
+            raise
+
+    def register_call(self, call_id, channel_id):
+        """Registra una chiamata di cui attendere l'esito"""
+        call = _PendingCall(call_id, channel_id)
+        with self._state_lock:
+            self._calls[call_id] = call
+            self._calls_by_channel[channel_id] = call
+        return call
+
+    def get_call(self, call_id):
+        with self._state_lock:
+            return self._calls.get(call_id)
+
+    def forget_call(self, call):
+        """Dimentica una chiamata conclusa (gli eventi successivi sono ignorati)"""
+        with self._state_lock:
+            self._calls.pop(call.call_id, None)
+            for key in [k for k, c in self._calls_by_channel.items() if c is call]:
+                del self._calls_by_channel[key]
+            for key in [k for k, c in self._calls_by_action.items() if c is call]:
+                del self._calls_by_action[key]
+
+    def _reader_loop(self, sock, pending):
+        parser = AMIParser()
+        messages = parser.feed(pending)
+        try:
+            while True:
+                for message in messages:
+                    self._dispatch(message)
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    # Keepalive: la risposta al Ping non ha un waiter ed è ignorata
+                    self._write([('Action', 'Ping'), ('ActionID', f"keepalive-{next(_action_ids)}")], sock=sock)
+                    messages = []
+                    continue
+                if not data:
+                    break
+                messages = parser.feed(data)
+        except Exception as e:
+            if self.sock is sock:
+                self.logger.warning(f"Connessione AMI interrotta: {e}")
+        finally:
+            self._drop(sock, close=True)
+
+    def _dispatch(self, message):
+        action_id = message.get('ActionID')
+
+        # Gli eventi possono avere una chiave Response (OriginateResponse)
+        if 'Event' not in message:
+            with self._state_lock:
+                waiter = self._waiters.get(action_id)
+            if waiter is not None:
+                waiter.response = message
+                waiter.done.set()
+            return
+
+        event = message.get('Event')
+        if event == 'OriginateResponse':
+            with self._state_lock:
+                call = self._calls_by_action.pop(action_id, None)
+                if call is not None and message.get('Response') == 'Success':
+                    call.answered = True
+                    uniqueid = message.get('Uniqueid')
+                    if uniqueid:
+                        call.uniqueids.add(uniqueid)
+                        self._calls_by_channel[uniqueid] = call
+            if call is not None and message.get('Response') != 'Success':
+                # Nessuna risposta / occupato: come l'extension 'failed' del backend SSH
+                self.logger.info(f"Chiamata {call.call_id} non risposta: {message.get('Reason', '')}")
+                call.finish(NO_ANSWER)
+
+        elif event == 'DTMFEnd' or (event == 'DTMF' and message.get('End') == 'Yes'):
+            if message.get('Direction', 'Received') != 'Received':
+                return
+            digit = message.get('Digit')
+            call = self._find_call(message)
+            if call is not None and digit in ('1', '2'):
+                call.finish(digit)
+
+        elif event == 'Hangup':
+            call = self._find_call(message)
+            # Solo la fine del canale che esegue wakeup-service dopo la risposta,
+            # come l'extension h del dialplan
+            if call is not None and call.answered and message.get('Uniqueid') in call.uniqueids:
+                call.finish('H')
+
+    def _find_call(self, message):
+        with self._state_lock:
+            for key in (message.get('Uniqueid'), message.get('Linkedid')):
+                call = self._calls_by_channel.get(key) if key else None
+                if call is not None:
+                    return call
+        return None
+
+    def _drop(self, sock, close=False):
+        """
+        Chiude la connessione e sblocca chi attende risposte o esiti
+
+        Args:
+            close: chiude il socket; altrimenti lo interrompe soltanto e la
+                chiusura resta al thread lettore, così il descrittore non viene
+                riassegnato mentre il lettore è ancora in recv()
+        """
+        with self._state_lock:
+            current = self.sock is sock
+            if current:
+                was_connected = self.connected
+                self.sock = None
+                self.connected = False
+                waiters = list(self._waiters.values())
+                calls = list(self._calls.values())
+                self._calls_by_action.clear()
+        try:
+            if close:
+                sock.close()
+            else:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if not current:
+            # Socket di una connessione precedente già sostituita
+            return
+        for waiter in waiters:
+            waiter.done.set()
+        for call in calls:
+            call.finish(None)
+        if was_connected:
+            self.logger.info("Connessione AMI chiusa")
+
+    def close(self):
+        """Logoff e chiusura della sessione"""
+        sock = self.sock
+        if sock is None:
+            return
+        try:
+            self._write([('Action', 'Logoff'), ('ActionID', str(next(_action_ids)))])
+        except Exception:
+            pass
+        self._drop(sock)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _get_shared_session(config):
+    """Sessione AMI condivisa per la configurazione indicata"""
+    key = (config['host'], config.get('ami_port', AMI_DEFAULT_PORT),
+           config.get('ami_username', ''), config.get('ami_secret', ''))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _AMISession(dict(config))
+            _sessions[key] = session
+        return session
+
+def close_all_sessions():
+    """Chiude tutte le sessioni AMI condivise (alla chiusura dell'applicazione)"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+class AMIBackend(PBXBackend):
+    """
+    Backend AMI: una sola connessione TCP persistente, Originate asincrono
+    ed esito della chiamata dagli eventi DTMFEnd/Hangup/OriginateResponse,
+    senza processi 'asterisk -rx' né file di esito sul PBX.
+
+    Richiede in manager.conf un utente con permessi read=call,dtmf e
+    write=originate,call,command.
+    """
+
+    name = 'ami'
+
+    def __init__(self, config):
+        self.config = config
+        self.session = _get_shared_session(config)
+        self.logger = get_logger('ami_backend')
+
+    def connect(self, force=False):
+        try:
+            self.session.ensure_connected(force=force)
+            return True
+        except Exception as e:
+            self.logger.error(f"Errore di connessione AMI: {e}")
+            return False
+
+    def is_connected(self):
+        return self.session.is_active()
+
+    def test(self):
+        try:
+            if not self.is_connected():
+                self.session.ensure_connected(force=True)
+            response = self.session.send_action('Ping')
+        except Exception as e:
+            return False, f"Errore AMI: {e}"
+        if response.get('Response') != 'Success':
+            return False, f"Errore AMI: {response.get('Message', '')}"
+        return True, "Connessione AMI attiva"
+
+    def command(self, cli_command):
+        return self.command_batch([cli_command])[0]
+
+    def command_batch(self, cli_commands):
+        """Azioni Command inviate in pipeline sulla sessione persistente"""
+        if not cli_commands:
+            return []
+        try:
+            responses = self.session.send_actions(
+                [('Command', [('Command', cli_command)]) for cli_command in cli_commands])
+        except Exception as e:
+            self.logger.error(f"Errore comandi AMI {cli_commands}: {e}")
+            return [(None, str(e))] * len(cli_commands)
+
+        results = []
+        for response in responses:
+            if response.get('Response') == 'Error':
+                results.append((None, response.get('Message', 'Errore comando')))
+            else:
+                results.append((response.get('Output', ''), None))
+        return results
+
+    def originate(self, channel, context, exten, callerid, call_id=None, timeout=None, variables=None):
+        fields = [
+            ('Channel', channel),
+            ('Context', context),
+            ('Exten', exten),
+            ('Priority', '1'),
+            ('CallerID', callerid),
+            ('Async', 'true'),
+        ]
+        if timeout:
+            fields.append(('Timeout', str(int(timeout * 1000))))
+        fields += [('Variable', f"{name}={value}") for name, value in (variables or {}).items()]
+
+        call = None
+        if call_id is not None:
+            # Uniqueid noti in anticipo: DTMFEnd e Hangup dei canali della
+            # chiamata riportano questo id come Uniqueid o Linkedid
+            channel_id = f"wakeup-{call_id}"
+            fields += [('ChannelId', channel_id), ('OtherChannelId', f"{channel_id}-2")]
+            call = self.session.register_call(call_id, channel_id)
+
+        try:
+            response = self.session.send_action('Originate', fields, call=call)
+        except Exception as e:
+            if call is not None:
+                self.session.forget_call(call)
+            return False, str(e)
+
+        if response.get('Response') != 'Success':
+            if call is not None:
+                self.session.forget_call(call)
+            return False, response.get('Message', 'Originate rifiutato')
+        return True, "Chiamata accodata"
+
+    def wait_call_result(self, call_id, max_wait):
+        call = self.session.get_call(call_id)
+        if call is None:
+            return None
+        try:
+            call.done.wait(max_wait)
+            return call.result
+        finally:
+            self.session.forget_call(call)
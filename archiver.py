@@ -0,0 +1,83 @@
+"""
+Archiviazione periodica delle sveglie concluse e dei log chiamate
+"""
+import threading
+from datetime import datetime, timedelta
+from config import ARCHIVE_CONFIG
+from logger import get_logger
+
+class AlarmArchiver:
+    """
+    Sposta nelle tabelle *_archive le sveglie concluse e i log chiamate più
+    vecchi dei giorni di retention (ARCHIVE_CONFIG, sezione "archive" di
+    settings.json), così le tabelle attive restano di dimensione limitata.
+
+    Lavora su un thread proprio, a blocchi di batch_size righe per
+    transazione con una breve pausa tra un blocco e l'altro: il thread
+    delle sveglie e l'interfaccia non restano mai bloccati a lungo.
+    """
+
+    BATCH_PAUSE = 0.05   # secondi tra due blocchi
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.logger = get_logger('archiver')
+        self.running = False
+        self.archive_thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Avvia l'archiviazione periodica"""
+        if self.running:
+            return
+        self.running = True
+        self._stop_event.clear()
+        self.archive_thread = threading.Thread(target=self._archive_loop, name="archiver", daemon=True)
+        self.archive_thread.start()
+
+    def stop(self):
+        """Ferma l'archiviazione (un blocco in corso viene completato)"""
+        self.running = False
+        self._stop_event.set()
+        if self.archive_thread and self.archive_thread.is_alive():
+            self.archive_thread.join(timeout=0.5)
+
+    def _archive_loop(self):
+        while self.running:
+            if ARCHIVE_CONFIG.get('enabled', True):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    self.logger.error(f"Errore archiviazione: {e}")
+            self._stop_event.wait(ARCHIVE_CONFIG.get('run_interval', 3600))
+
+    def run_once(self):
+        """
+        Archivia tutto ciò che ha superato la retention
+
+        Returns:
+            (sveglie archiviate, log chiamate archiviati)
+        """
+        batch_size = ARCHIVE_CONFIG.get('batch_size', 500)
+        statuses = ARCHIVE_CONFIG.get('archived_statuses', ['completed', 'cancelled', 'snoozed', 'failed'])
+        now = datetime.now()
+        alarms_before = now - timedelta(days=ARCHIVE_CONFIG.get('alarm_retention_days', 1))
+        logs_before = now - timedelta(days=ARCHIVE_CONFIG.get('call_log_retention_days', 1))
+
+        alarms = self._run_batches(lambda: self.db.archive_alarms(alarms_before.timestamp(), statuses, batch_size),
+                                   batch_size)
+        logs = self._run_batches(lambda: self.db.archive_call_logs(logs_before, batch_size), batch_size)
+
+        if alarms or logs:
+            self.logger.info(f"Archiviate {alarms} sveglie e {logs} log chiamate")
+        return alarms, logs
+
+    def _run_batches(self, archive_batch, batch_size):
+        """Ripete archive_batch finché restano righe da spostare"""
+        total = 0
+        while True:
+            moved = archive_batch()
+            total += moved
+            if moved < batch_size or self._stop_event.wait(self.BATCH_PAUSE):
+                break
+        return total
@@ -0,0 +1,104 @@
+"""
+Catalogo in memoria dei messaggi audio
+"""
+import re
+import threading
+from logger import get_logger
+
+class AudioCatalog:
+    """
+    Indice in memoria della tabella audio_messages.
+
+    La tabella viene letta una sola volta e indicizzata per id e per
+    (action_type, language, variant); il catalogo si ricarica da solo quando
+    il DatabaseManager segnala una modifica agli audio (get_data_version).
+
+    La variante è il primo numero nel nome del messaggio, es.
+    "snooze_5min_it_1" -> '5', "Conferma Snooze 10min ITA" -> '10'.
+    """
+
+    TABLE = 'audio_messages'
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.logger = get_logger('audio_catalog')
+
+        self._lock = threading.Lock()
+        self._version = None
+        self._messages = []   # righe ordinate per nome
+        self._by_id = {}      # id -> riga
+        self._by_key = {}     # (action_type, language, variant) -> prima riga per nome
+
+    @staticmethod
+    def variant_of(name):
+        """Variante di un messaggio audio ricavata dal nome (None se assente)"""
+        match = re.search(r'\d+', name or '')
+        return match.group(0) if match else None
+
+    def _ensure_loaded(self):
+        """Ricarica il catalogo se il database è cambiato"""
+        version = self.db.get_data_version(self.TABLE)
+        with self._lock:
+            if version == self._version:
+                return
+
+        # Versione letta PRIMA delle righe: una modifica concorrente
+        # provoca al più una ricarica in più, mai dati vecchi
+        messages = self.db.get_audio_messages()
+        by_id = {}
+        by_key = {}
+        for msg in messages:
+            by_id[msg.id] = msg
+            language = (msg.language or 'it').lower()
+            by_key.setdefault((msg.action_type, language, None), msg)
+            variant = self.variant_of(msg.name)
+            if variant:
+                by_key.setdefault((msg.action_type, language, variant), msg)
+
+        with self._lock:
+            self._messages = messages
+            self._by_id = by_id
+            self._by_key = by_key
+            self._version = version
+        self.logger.debug(f"Catalogo audio caricato: {len(messages)} messaggi")
+
+    def version(self):
+        """Versione dei dati su cui è costruito il catalogo"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._version
+
+    def get(self, audio_id):
+        """Messaggio audio (AudioMessage) per id o None"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._by_id.get(audio_id)
+
+    def find(self, action_type, language='it', variant=None):
+        """
+        Primo messaggio (per nome) con azione, lingua e variante richieste
+
+        Args:
+            action_type: 'wake_up', 'snooze_confirm', 'goodbye'
+            language: Codice lingua (it, en, etc.)
+            variant: Variante (es. '5', '10'), None per qualsiasi
+
+        Returns:
+            AudioMessage o None
+        """
+        self._ensure_loaded()
+        key = (action_type, (language or 'it').lower(), str(variant) if variant else None)
+        with self._lock:
+            return self._by_key.get(key)
+
+    def get_all(self):
+        """Tutti i messaggi audio ordinati per nome"""
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._messages)
+
+    def get_names(self):
+        """Dizionario id -> nome"""
+        self._ensure_loaded()
+        with self._lock:
+            return {audio_id: msg.name for audio_id, msg in self._by_id.items()}
@@ -262,31 +262,31 @@ class AudioManagerWindow:
             messages = self.db.get_audio_messages()
             for msg in messages:
                 # Formatta la durata (gestisce sia stringhe "MM:SS" che numeri/None)
-                if msg[3]:
-                    if isinstance(msg[3], str):
+                if msg.duration:
+                    if isinstance(msg.duration, str):
                         # Nuova durata già formattata come "MM:SS"
-                        duration = msg[3]
+                        duration = msg.duration
                     else:
                         # Vecchia durata numerica (secondi)
-                        duration = f"{msg[3]:.1f}s"
+                        duration = f"{msg.duration:.1f}s"
                 else:
                     duration = "N/A"
                 
                 # Ottiene la lingua e l'azione
-                language = msg[5] if len(msg) > 5 else "it"
-                action_type = msg[6] if len(msg) > 6 else "wake_up"
+                language = msg.language or "it"
+                action_type = msg.action_type or "wake_up"
                 action_display = self.action_map_reverse.get(action_type, "Messaggio Sveglia")
                 
                 # Formatta la data di creazione
-                created_date = msg[7].split(' ')[0] if len(msg) > 7 and msg[7] else "N/A"
+                created_date = msg.created_at.split(' ')[0] if msg.created_at else "N/A"
                 
                 # Inserisci nella lista
                 item_id = self.audio_tree.insert("", "end", values=(
-                    msg[0],  # ID
-                    msg[1],  # Nome
-                    os.path.basename(msg[2]),  # File (solo nome)
+                    msg.id,  # ID
+                    msg.name,  # Nome
+                    os.path.basename(msg.file_path),  # File (solo nome)
                     duration,  # Durata
-                    msg[4] if len(msg) > 4 else "standard",  # Categoria
+                    msg.category or "standard",  # Categoria
                     language.upper(),  # Lingua
                     action_display,  # Tipo Azione
                     created_date  # Data creazione
@@ -378,16 +378,12 @@ class AudioManagerWindow:
                     messages = self.db.get_audio_messages()
                     file_path = None
                     for msg in messages:
-                        if msg[0] == int(self.selected_audio_id):
-                            file_path = msg[2]
+                        if msg.id == int(self.selected_audio_id):
+                            file_path = msg.file_path
                             break
                     
                     # Elimina dal database
-                    conn = self.db.get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("DELETE FROM audio_messages WHERE id = ?", (self.selected_audio_id,))
-                    conn.commit()
-                    conn.close()
+                    self.db.delete_audio_message(self.selected_audio_id)
                     
                     # Elimina il file fisico
                     if file_path and os.path.exists(file_path):
@@ -0,0 +1,130 @@
+"""
+Cache degli audio già caricati sul centralino Asterisk
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from config import AUDIO_CONFIG
+from logger import get_logger
+
+class AudioUploadCache:
+    """
+    Manifest locale hash contenuto -> file remoto, per PBX.
+
+    Un audio già presente sul PBX con lo stesso contenuto (sha256) non viene
+    più ricaricato: basta che il file remoto abbia ancora la dimensione e la
+    data di modifica registrate al momento dell'upload. Il controllo remoto
+    (stat SFTP) viene ripetuto al massimo ogni verify_interval secondi, quindi
+    nel caso comune una chiamata non richiede alcun accesso SFTP.
+    """
+
+    def __init__(self, manifest_path=None, verify_interval=300):
+        """
+        Args:
+            manifest_path: file JSON del manifest (default AUDIO_CONFIG['upload_manifest'])
+            verify_interval: secondi di validità di una verifica del file remoto
+        """
+        self.manifest_path = manifest_path or AUDIO_CONFIG.get('upload_manifest', 'audio_upload_manifest.json')
+        self.verify_interval = verify_interval
+        self.logger = get_logger('audio_upload_cache')
+
+        self._lock = threading.Lock()
+        self._manifest = self._load()     # host -> {sha256: {remote_path, size, mtime}}
+        self._fingerprints = {}           # path locale -> (size, mtime, sha256)
+        self._verified = {}               # (host, sha256) -> ultima verifica remota
+
+    def _load(self):
+        """Carica il manifest dal disco"""
+        try:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Manifest upload audio non leggibile, verrà ricreato: {e}")
+        return {}
+
+    def _save(self):
+        """Salva il manifest (chiamato con il lock acquisito)"""
+        try:
+            tmp_path = self.manifest_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._manifest, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception as e:
+            self.logger.warning(f"Errore salvataggio manifest upload audio: {e}")
+
+    def content_hash(self, local_path):
+        """
+        sha256 del file locale, ricalcolato solo se dimensione o data di
+        modifica sono cambiate
+        """
+        stat = os.stat(local_path)
+        with self._lock:
+            cached = self._fingerprints.get(local_path)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+                return cached[2]
+
+        digest = hashlib.sha256()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+
+        with self._lock:
+            self._fingerprints[local_path] = (stat.st_size, stat.st_mtime, sha256)
+        return sha256
+
+    def lookup(self, host, sha256):
+        """
+        Voce del manifest per un contenuto
+
+        Returns:
+            (entry, needs_verify): entry None se il contenuto non è mai stato caricato
+        """
+        with self._lock:
+            entry = self._manifest.get(host, {}).get(sha256)
+            if entry is None:
+                return None, False
+            verified_at = self._verified.get((host, sha256), 0)
+            return dict(entry), time.time() - verified_at > self.verify_interval
+
+    def matches(self, entry, remote_size, remote_mtime):
+        """True se il file remoto corrisponde a quanto registrato all'upload"""
+        return entry['size'] == remote_size and int(entry['mtime']) == int(remote_mtime)
+
+    def mark_verified(self, host, sha256):
+        """Registra una verifica remota riuscita"""
+        with self._lock:
+            self._verified[(host, sha256)] = time.time()
+
+    def record(self, host, sha256, remote_path, remote_size, remote_mtime):
+        """Registra un upload completato"""
+        with self._lock:
+            self._manifest.setdefault(host, {})[sha256] = {
+                'remote_path': remote_path,
+                'size': remote_size,
+                'mtime': int(remote_mtime)
+            }
+            self._verified[(host, sha256)] = time.time()
+            self._save()
+
+    def forget(self, host, sha256):
+        """Rimuove una voce non più valida (file remoto cancellato o modificato)"""
+        with self._lock:
+            if self._manifest.get(host, {}).pop(sha256, None) is not None:
+                self._verified.pop((host, sha256), None)
+                self._save()
+
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+def get_upload_cache():
+    """Istanza condivisa della cache upload audio"""
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = AudioUploadCache()
+        return _upload_cache
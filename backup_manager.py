@@ -12,9 +12,15 @@ from database import DatabaseManager
 from config import create_directories
 
 class BackupManagerWindow:
-    def __init__(self, parent, db_manager):
+    def __init__(self, parent, db_manager, services=()):
+        """
+        Args:
+            services: servizi in background che usano il database (con
+                      start()/stop()), fermati durante il ripristino
+        """
         self.parent = parent
         self.db = db_manager
+        self.services = list(services)
         
         # Crea la finestra
         self.window = tk.Toplevel(parent)
@@ -220,6 +226,8 @@ class BackupManagerWindow:
                 # Database
                 if self.include_database.get():
                     if os.path.exists(self.db.db_path):
+                        # Porta nel file principale le modifiche ancora nel WAL
+                        self.db.checkpoint()
                         zipf.write(self.db.db_path, "database/sveglie.db")
                 
                 # Messaggi audio
@@ -302,7 +310,24 @@ class BackupManagerWindow:
                         zipf.extract("database/sveglie.db", ".")
                         # Sposta il file nella posizione corretta
                         if os.path.exists("database/sveglie.db"):
-                            shutil.move("database/sveglie.db", self.db.db_path)
+                            # Nessun thread deve essere a metà di una scrittura
+                            # quando le connessioni vengono chiuse
+                            for service in self.services:
+                                service.stop()
+                            try:
+                                # Chiude le connessioni persistenti e scarta il WAL del database sostituito
+                                self.db.close_all_connections()
+                                for suffix in ("-wal", "-shm"):
+                                    if os.path.exists(self.db.db_path + suffix):
+                                        os.remove(self.db.db_path + suffix)
+                                shutil.move("database/sveglie.db", self.db.db_path)
+                                # Un backup vecchio può avere uno schema precedente
+                                self.db.init_database()
+                                # Le cache in memoria devono rileggere il database ripristinato
+                                self.db.bump_data_version('audio_messages', 'rooms')
+                            finally:
+                                for service in self.services:
+                                    service.start()
                     
                     if self.restore_audio.get():
                         for member in zipf.namelist():
@@ -340,6 +365,7 @@ class BackupManagerWindow:
             
             with zipfile.ZipFile(safety_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
                 if os.path.exists(self.db.db_path):
+                    self.db.checkpoint()
                     zipf.write(self.db.db_path, "sveglie.db")
             
             print(f"Backup di sicurezza creato: {safety_file}")
@@ -0,0 +1,155 @@
+"""
+Benchmark dell'avvio del DatabaseManager
+
+Confronta, su una copia temporanea del database, l'avvio a freddo con lo
+schema versionato (una lettura di PRAGMA user_version) con i controlli
+dello schema che la versione precedente (commit 052ad0f) eseguiva a ogni
+istanza: init_database, update_database_schema e create_default_rooms,
+riportati qui sotto senza modifiche alla logica.
+
+Uso: python bench_database_startup.py [path_database] [ripetizioni]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from config import DATABASE_PATH
+from database import DatabaseManager
+
+
+def _baseline_init_database(db_path):
+    """init_database della versione precedente: tre connessioni e tutti i controlli a ogni avvio"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_number TEXT UNIQUE NOT NULL,
+            phone_extension TEXT DEFAULT '',
+            description TEXT DEFAULT '',
+            status TEXT DEFAULT 'available',
+            color TEXT DEFAULT '#FFFFFF',
+            label TEXT DEFAULT '',
+            language TEXT DEFAULT 'it',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    try:
+        cursor.execute("SELECT language FROM rooms LIMIT 1")
+    except sqlite3.OperationalError:
+        cursor.execute("ALTER TABLE rooms ADD COLUMN language TEXT DEFAULT 'it'")
+        conn.commit()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audio_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            duration REAL,
+            category TEXT DEFAULT 'standard',
+            language TEXT DEFAULT 'it',
+            action_type TEXT DEFAULT 'wake_up',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alarms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_number TEXT NOT NULL,
+            alarm_time TIMESTAMP NOT NULL,
+            audio_message_id INTEGER,
+            status TEXT DEFAULT 'scheduled',
+            snooze_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (audio_message_id) REFERENCES audio_messages (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS call_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alarm_id INTEGER,
+            room_number TEXT NOT NULL,
+            call_time TIMESTAMP NOT NULL,
+            response TEXT,
+            snooze_minutes INTEGER,
+            status TEXT NOT NULL,
+            FOREIGN KEY (alarm_id) REFERENCES alarms (id)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+    # update_database_schema
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("PRAGMA table_info(rooms)")
+        columns = [column[1] for column in cursor.fetchall()]
+        for name, definition in (('phone_extension', "TEXT DEFAULT ''"), ('description', "TEXT DEFAULT ''"),
+                                 ('color', "TEXT DEFAULT '#FFFFFF'"), ('label', "TEXT DEFAULT ''"),
+                                 ('language', "TEXT DEFAULT 'it'")):
+            if name not in columns:
+                cursor.execute(f"ALTER TABLE rooms ADD COLUMN {name} {definition}")
+                conn.commit()
+        cursor.execute("PRAGMA table_info(audio_messages)")
+        audio_columns = [column[1] for column in cursor.fetchall()]
+        for name, definition in (('language', "TEXT DEFAULT 'it'"), ('action_type', "TEXT DEFAULT 'wake_up'")):
+            if name not in audio_columns:
+                cursor.execute(f"ALTER TABLE audio_messages ADD COLUMN {name} {definition}")
+                conn.commit()
+    finally:
+        conn.close()
+
+    # create_default_rooms
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM rooms")
+    if cursor.fetchone()[0] == 0:
+        cursor.executemany("INSERT INTO rooms (room_number, status) VALUES (?, ?)",
+                           [(f"1{i:02d}", 'available') for i in range(101, 151)])
+        conn.commit()
+    conn.close()
+
+
+def _baseline_start(db_path):
+    """Tempo dei controlli dello schema della versione precedente"""
+    start = time.perf_counter()
+    _baseline_init_database(db_path)
+    return time.perf_counter() - start
+
+
+def _cold_start(db_path):
+    """Tempo di un avvio a freddo: nessuna connessione aperta, schema già aggiornato"""
+    manager = DatabaseManager.__new__(DatabaseManager)
+    manager.db_path = db_path
+    manager.close_all_connections()
+
+    start = time.perf_counter()
+    DatabaseManager(db_path)
+    return time.perf_counter() - start
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else DATABASE_PATH
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_startup.db")
+    if os.path.exists(source):
+        shutil.copy(source, db_path)
+    DatabaseManager(db_path)
+
+    results = {}
+    for label, measure in (("controlli schema (052ad0f)", _baseline_start), ("schema versionato", _cold_start)):
+        timings = sorted(measure(db_path) for _ in range(repeats))
+        results[label] = timings[len(timings) // 2]
+
+    print(f"Avvio a freddo DatabaseManager (mediana su {repeats} ripetizioni)")
+    for label, median in results.items():
+        print(f"  {label:28s} {median * 1000:8.2f} ms")
+    full, fast = results.values()
+    print(f"  guadagno: {full / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
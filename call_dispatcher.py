@@ -0,0 +1,176 @@
+"""
+Dispatcher concorrente delle chiamate di sveglia
+"""
+import threading
+import time
+from datetime import datetime
+from admission_controller import AdmissionController, AdmissionTicket
+from pbx_connection import PBXConnection
+from logger import get_logger
+
+class CallDispatcher:
+    """
+    Esegue le sveglie su un pool limitato di worker.
+
+    Ogni worker possiede la propria PBXConnection; tutte condividono lo
+    stesso trasporto SSH persistente e ogni comando apre un proprio canale,
+    così più chiamate possono essere in corso contemporaneamente senza
+    nuovi handshake. L'ammissione delle chiamate
+    (canali contemporanei, originate al secondo, priorità) è delegata
+    all'AdmissionController.
+    """
+
+    def __init__(self, execute_callback, max_workers=4, max_rate=2.0,
+                 max_retries=3, retry_delay=60, pbx_config=None, call_timeout=90):
+        """
+        Args:
+            execute_callback: funzione (ticket, pbx_connection) eseguita dal worker;
+                restituisce True se la sveglia va ritentata
+            max_workers: numero massimo di chiamate contemporanee
+            max_rate: originate massime al secondo verso il PBX
+            max_retries: retry massimi per sveglia
+            retry_delay: secondi di attesa prima di un retry
+            pbx_config: configurazione PBX per le sessioni dei worker (default PBX_CONFIG)
+            call_timeout: durata massima di una chiamata; stop() attende al
+                più questo tempo i worker con una chiamata in corso
+        """
+        self.execute_callback = execute_callback
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.pbx_config = pbx_config
+        self.call_timeout = call_timeout
+        self.logger = get_logger('call_dispatcher')
+
+        self.admission = AdmissionController(self.max_workers, max_rate)
+
+        self.running = False
+        self._workers = []
+        self._generation = 0        # incrementata da stop(): i worker precedenti terminano
+        self._lock = threading.Lock()
+        self._pending_ids = set()   # sveglie in coda o in esecuzione
+        self._in_flight = {}        # alarm_id -> inizio esecuzione
+
+    def start(self):
+        """Avvia i worker"""
+        if self.running:
+            return
+
+        # Worker di un avvio precedente ancora in chiamata: il nuovo pool
+        # parte solo dopo di loro, mai due pool completi insieme
+        if self._workers:
+            self._join_workers(self.call_timeout)
+
+        self.running = True
+        self.admission.reopen()
+        generation = self._generation
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, args=(index, generation),
+                                      name=f"alarm-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        self.logger.info(f"Dispatcher avviato con {self.max_workers} worker, "
+                         f"max {self.admission.max_rate} originate/s")
+
+    def stop(self, timeout=None):
+        """
+        Ferma i worker attendendo la fine delle chiamate in corso
+
+        Args:
+            timeout: attesa massima in secondi (default call_timeout)
+        """
+        if not self.running:
+            return
+
+        self.running = False
+        self._generation += 1
+        self.admission.close()
+        self._join_workers(self.call_timeout if timeout is None else timeout)
+        self.logger.info("Dispatcher fermato")
+
+    def _join_workers(self, timeout):
+        """Attende i worker entro timeout secondi; restano in _workers quelli ancora vivi"""
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        if self._workers:
+            self.logger.warning(f"{len(self._workers)} worker ancora in chiamata dopo {timeout}s")
+
+    def submit(self, alarm_id, due_ts=None):
+        """
+        Accoda una sveglia da eseguire
+
+        Args:
+            alarm_id: ID sveglia
+            due_ts: timestamp previsto della sveglia (default: adesso)
+
+        Returns:
+            False se la sveglia è già in coda o in esecuzione
+        """
+        with self._lock:
+            if alarm_id in self._pending_ids:
+                return False
+            self._pending_ids.add(alarm_id)
+
+        self.admission.submit(AdmissionTicket(alarm_id, due_ts or time.time()))
+
+        stats = self.admission.get_stats()
+        if stats['queue_depth'] > self.max_workers:
+            self.logger.info(f"Coda sveglie: {stats['queue_depth']} in attesa, "
+                             f"ritardo stimato {stats['expected_lateness']:.0f}s")
+        return True
+
+    def is_pending(self, alarm_id):
+        """True se la sveglia è in coda o in esecuzione"""
+        with self._lock:
+            return alarm_id in self._pending_ids
+
+    def get_active_calls(self):
+        """Sveglie attualmente in esecuzione: {alarm_id: ora di inizio}"""
+        with self._lock:
+            return self._in_flight.copy()
+
+    def get_stats(self):
+        """Statistiche di coda e ammissione (vedi AdmissionController.get_stats)"""
+        return self.admission.get_stats()
+
+    def _worker_loop(self, index, generation):
+        """Loop di un worker: preleva sveglie ammesse con la propria sessione PBX"""
+        pbx = PBXConnection(self.pbx_config)
+        self.logger.debug(f"Worker {index} avviato")
+
+        try:
+            # Dopo uno stop() il worker termina anche se il dispatcher è già ripartito
+            while self.running and generation == self._generation:
+                ticket = self.admission.acquire()
+                if ticket is None:
+                    break
+
+                with self._lock:
+                    self._in_flight[ticket.alarm_id] = datetime.now()
+
+                retry = False
+                try:
+                    retry = self.execute_callback(ticket, pbx)
+                except Exception as e:
+                    self.logger.error(f"Worker {index}: errore esecuzione sveglia {ticket.alarm_id}: {e}")
+                finally:
+                    self.admission.release(ticket)
+                    with self._lock:
+                        self._in_flight.pop(ticket.alarm_id, None)
+
+                if retry and ticket.attempt < self.max_retries:
+                    self.logger.info(f"Sveglia {ticket.alarm_id}: retry {ticket.attempt + 1}/{self.max_retries} "
+                                     f"tra {self.retry_delay}s")
+                    self.admission.submit(AdmissionTicket(
+                        ticket.alarm_id, ticket.due_ts, ticket.attempt + 1,
+                        not_before=time.time() + self.retry_delay
+                    ))
+                else:
+                    with self._lock:
+                        self._pending_ids.discard(ticket.alarm_id)
+        finally:
+            pbx.disconnect()
+            self.logger.debug(f"Worker {index} terminato")
@@ -16,7 +16,18 @@ PBX_CONFIG = {
     'test_on_startup': True,   # Test automatico all'avvio
     'wake_extension': '999',   # Interno virtuale per servizio sveglie
     'wake_callerid': 'Servizio Sveglie',  # Nome da mostrare sul display
-    'context': 'from-internal'  # Context Asterisk (di solito from-internal per FreePBX)
+    'context': 'from-internal',  # Context Asterisk (di solito from-internal per FreePBX)
+    'ring_timeout': 30,         # Secondi di squillo massimi prima di considerare la chiamata senza risposta
+    'keepalive_interval': 30,   # Secondi tra i keepalive delle sessioni persistenti (SSH e AMI)
+    'status_refresh_interval': 30,  # Secondi di validità dello stato interni (al più un poll per intervallo)
+    'backend': 'ssh',           # Controllo chiamate: 'ssh' (asterisk -rx) o 'ami' (Asterisk Manager Interface)
+    'ami_port': 5038,           # Porta AMI (manager.conf)
+    'ami_username': 'sveglie',  # Utente AMI - da configurare
+    'ami_secret': '',           # Secret AMI - da configurare
+    'fastagi_enabled': False,   # Sveglie gestite dal server FastAGI integrato (context wakeup-agi)
+    'fastagi_host': '',         # Indirizzo di questo PC raggiungibile dal PBX (scritto nel dialplan)
+    'fastagi_listen': '0.0.0.0',  # Interfaccia di ascolto del server FastAGI
+    'fastagi_port': 4573        # Porta del server FastAGI
 }
 
 # File per salvare le configurazioni utente
@@ -32,6 +43,10 @@ def load_user_config():
                 # Sovrascrivi PBX_CONFIG con le impostazioni utente
                 if 'pbx' in user_settings:
                     PBX_CONFIG.update(user_settings['pbx'])
+                if 'alarms' in user_settings:
+                    ALARM_CONFIG.update(user_settings['alarms'])
+                if 'archive' in user_settings:
+                    ARCHIVE_CONFIG.update(user_settings['archive'])
                 return user_settings
         except Exception as e:
             print(f"Errore nel caricamento impostazioni: {e}")
@@ -48,21 +63,32 @@ def save_user_config(settings):
         print(f"Errore nel salvataggio impostazioni: {e}")
         return False
 
-# Carica le impostazioni utente all'importazione
-load_user_config()
-
 # Configurazione audio
 AUDIO_CONFIG = {
     'supported_formats': ['.mp3', '.wav', '.ogg'],
     'audio_folder': 'audio_messages',
-    'default_volume': 0.8
+    'default_volume': 0.8,
+    'upload_manifest': 'audio_upload_manifest.json'  # audio già caricati sul PBX (hash -> file remoto)
 }
 
 # Configurazione sveglie
 ALARM_CONFIG = {
     'snooze_options': [5, 10, 15, 30],  # minuti
     'max_snooze_attempts': 3,
-    'call_timeout': 30  # secondi
+    'call_timeout': 30,  # secondi
+    'max_concurrent_calls': 4,  # chiamate di sveglia contemporanee (worker del dispatcher)
+    'max_originate_rate': 2.0,  # originate al secondo verso il PBX (smussa i picchi)
+    'retry_delay': 60           # secondi prima di ritentare una sveglia fallita
+}
+
+# Archiviazione sveglie concluse e log chiamate (tabelle *_archive)
+ARCHIVE_CONFIG = {
+    'enabled': True,
+    'alarm_retention_days': 1,     # giorni dopo l'orario sveglia prima di archiviarla
+    'call_log_retention_days': 1,  # giorni prima di archiviare un log chiamata
+    'archived_statuses': ['completed', 'cancelled', 'snoozed', 'failed'],
+    'batch_size': 500,             # righe spostate per transazione
+    'run_interval': 3600           # secondi tra due passaggi dell'archiviatore
 }
 
 # Configurazione hotel
@@ -72,6 +98,9 @@ HOTEL_CONFIG = {
     'room_prefix': '1'  # Prefisso per numeri di camera
 }
 
+# Carica le impostazioni utente all'importazione
+load_user_config()
+
 # Crea cartelle necessarie
 def create_directories():
     """Crea le cartelle necessarie per il funzionamento del sistema"""
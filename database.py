@@ -3,18 +3,146 @@ Gestione database SQLite per il sistema di sveglie
 """
 import sqlite3
 import datetime
+import threading
+import weakref
 from config import DATABASE_PATH
+from models import Room, AudioMessage, Alarm, CallLog
+
+# Parametri delle connessioni SQLite
+BUSY_TIMEOUT_MS = 5000      # attesa massima su un database bloccato da un altro thread
+CACHE_SIZE_KB = 8192        # cache pagine per connessione
+CACHED_STATEMENTS = 256     # statement preparati riutilizzati per connessione
+
+# Indici secondari
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_alarms_status_time ON alarms (status, alarm_time)",
+    "CREATE INDEX IF NOT EXISTS idx_alarms_room_status ON alarms (room_number, status, alarm_time)",
+    "CREATE INDEX IF NOT EXISTS idx_rooms_extension ON rooms (phone_extension)",
+    "CREATE INDEX IF NOT EXISTS idx_audio_action_language ON audio_messages (action_type, language)",
+    "CREATE INDEX IF NOT EXISTS idx_call_logs_alarm ON call_logs (alarm_id)",
+    "CREATE INDEX IF NOT EXISTS idx_call_logs_time ON call_logs (call_time)",
+]
+
+# Indici sull'orario epoch delle sveglie (sostituiscono quelli sulla stringa ISO)
+EPOCH_INDEXES = [
+    "DROP INDEX IF EXISTS idx_alarms_status_time",
+    "DROP INDEX IF EXISTS idx_alarms_room_status",
+    "CREATE INDEX IF NOT EXISTS idx_alarms_status_epoch ON alarms (status, alarm_epoch)",
+    "CREATE INDEX IF NOT EXISTS idx_alarms_room_status ON alarms (room_number, status, alarm_epoch)",
+]
+
+# Migrazioni dello schema: (numero, descrizione, metodo del DatabaseManager).
+# Ogni passo è idempotente; il numero dell'ultimo passo applicato è
+# registrato in PRAGMA user_version.
+MIGRATIONS = [
+    (1, "Tabelle di base", '_migrate_base_schema'),
+    (2, "Indici secondari", '_migrate_indexes'),
+    (3, "Camere di default", '_migrate_default_rooms'),
+    (4, "Orario sveglie in secondi epoch", '_migrate_alarm_epoch'),
+    (5, "Tabelle di archivio", '_migrate_archive_tables'),
+    (6, "Statistiche orarie del servizio sveglie", '_migrate_alarm_stats'),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Colonne copiate nelle tabelle di archivio (stesso ordine delle tabelle attive)
+ALARM_COLUMNS = "id, room_number, alarm_time, audio_message_id, status, snooze_count, created_at, alarm_epoch, fired_epoch"
+CALL_LOG_COLUMNS = "id, alarm_id, room_number, call_time, response, snooze_minutes, status"
+
+# Etichetta delle camere create dall'import interni del PBX
+PBX_IMPORT_LABEL = 'Importato da PBX'
+
+# Esiti finali delle sveglie -> colonna di alarm_stats_hourly
+STATS_OUTCOMES = {
+    'completed': 'answered',
+    'snoozed': 'snoozed',
+    'failed': 'failed',
+    'cancelled': 'cancelled',
+}
+
+
+class _ThreadConnection(sqlite3.Connection):
+    """
+    Connessione persistente di un thread.
+    
+    I metodi del DatabaseManager (e il codice esterno che usa get_connection)
+    chiamano close() dopo ogni operazione: qui close() annulla solo
+    l'eventuale transazione rimasta aperta, come farebbe la chiusura reale,
+    e lascia la connessione pronta per la prossima operazione del thread.
+    """
+    
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+    
+    def dispose(self):
+        """Chiusura reale della connessione"""
+        super().close()
+
 
 class DatabaseManager:
-    def __init__(self):
-        self.db_path = DATABASE_PATH
+    # Una connessione persistente per thread e per file database: niente
+    # setup a ogni chiamata, statement preparati riutilizzati
+    _local = threading.local()
+    _connections = weakref.WeakSet()   # tutte le connessioni aperte (per close_all_connections)
+    _generations = {}                  # db_path -> generazione, incrementata da close_all_connections
+    _connections_lock = threading.Lock()
+    
+    # File già portati all'ultima versione dello schema in questo processo
+    _initialized_paths = set()
+    _init_lock = threading.Lock()
+    
+    # Contatori di modifica per tabella, condivisi tra le istanze sullo stesso
+    # file: le cache in memoria li confrontano per sapere quando ricaricare
+    _data_versions = {}
+    _versions_lock = threading.Lock()
+    
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DATABASE_PATH
         self.init_database()
     
     def init_database(self):
-        """Inizializza il database con le tabelle necessarie"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """
+        Porta lo schema del database all'ultima versione.
         
+        Su un database già aggiornato costa una sola lettura di PRAGMA
+        user_version, e solo per la prima istanza del processo.
+        """
+        with self._init_lock:
+            if self.db_path in self._initialized_paths:
+                return
+            
+            conn = self.get_connection()
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < SCHEMA_VERSION:
+                    self._run_migrations(conn)
+            finally:
+                conn.close()
+            
+            self._initialized_paths.add(self.db_path)
+    
+    def _run_migrations(self, conn):
+        """Applica in un'unica transazione i passi di migrazione mancanti"""
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Riletta dentro la transazione: un altro processo potrebbe averla già aggiornata
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            
+            for number, description, step in MIGRATIONS:
+                if number > version:
+                    getattr(self, step)(cursor)
+                    print(f"Migrazione database {number}: {description}")
+            
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _migrate_base_schema(self, cursor):
+        """Migrazione 1: tabelle di base e colonne aggiunte nelle versioni precedenti"""
         # Tabella camere
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS rooms (
@@ -30,15 +158,6 @@ class DatabaseManager:
             )
         ''')
         
-        # Migrazione: aggiungi colonna language se non esiste
-        try:
-            cursor.execute("SELECT language FROM rooms LIMIT 1")
-        except sqlite3.OperationalError:
-            # La colonna non esiste, aggiungila
-            cursor.execute("ALTER TABLE rooms ADD COLUMN language TEXT DEFAULT 'it'")
-            conn.commit()
-            print("✓ Colonna 'language' aggiunta alla tabella rooms")
-        
         # Tabella messaggi audio
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS audio_messages (
@@ -81,103 +200,258 @@ class DatabaseManager:
             )
         ''')
         
-        conn.commit()
-        conn.close()
-        
-        # Aggiorna il database se necessario
-        self.update_database_schema()
-        
-        # Inserisci camere di default
-        self.create_default_rooms()
+        # Colonne aggiunte dopo la prima versione (database creati prima)
+        added_columns = {
+            'rooms': [
+                ('phone_extension', "TEXT DEFAULT ''"),
+                ('description', "TEXT DEFAULT ''"),
+                ('color', "TEXT DEFAULT '#FFFFFF'"),
+                ('label', "TEXT DEFAULT ''"),
+                ('language', "TEXT DEFAULT 'it'"),
+            ],
+            'audio_messages': [
+                ('language', "TEXT DEFAULT 'it'"),
+                ('action_type', "TEXT DEFAULT 'wake_up'"),
+            ],
+        }
+        for table, columns in added_columns.items():
+            cursor.execute(f"PRAGMA table_info({table})")
+            existing = {column[1] for column in cursor.fetchall()}
+            for name, definition in columns:
+                if name not in existing:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                    print(f"Aggiunta colonna {name} alla tabella {table}")
     
-    def update_database_schema(self):
-        """Aggiorna lo schema del database per nuove colonne"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            # Verifica se la colonna phone_extension esiste
-            cursor.execute("PRAGMA table_info(rooms)")
-            columns = [column[1] for column in cursor.fetchall()]
-            
-            if 'phone_extension' not in columns:
-                # Aggiunge la colonna phone_extension
-                cursor.execute("ALTER TABLE rooms ADD COLUMN phone_extension TEXT DEFAULT ''")
-                conn.commit()
-                print("Aggiunta colonna phone_extension alla tabella rooms")
-            
-            if 'description' not in columns:
-                # Aggiunge la colonna description
-                cursor.execute("ALTER TABLE rooms ADD COLUMN description TEXT DEFAULT ''")
-                conn.commit()
-                print("Aggiunta colonna description alla tabella rooms")
-            
-            if 'color' not in columns:
-                # Aggiunge la colonna color
-                cursor.execute("ALTER TABLE rooms ADD COLUMN color TEXT DEFAULT '#FFFFFF'")
-                conn.commit()
-                print("Aggiunta colonna color alla tabella rooms")
-            
-            if 'label' not in columns:
-                # Aggiunge la colonna label
-                cursor.execute("ALTER TABLE rooms ADD COLUMN label TEXT DEFAULT ''")
-                conn.commit()
-                print("Aggiunta colonna label alla tabella rooms")
-            
-            if 'language' not in columns:
-                # Aggiunge la colonna language per le camere
-                cursor.execute("ALTER TABLE rooms ADD COLUMN language TEXT DEFAULT 'it'")
-                conn.commit()
-                print("Aggiunta colonna language alla tabella rooms")
-            
-            # Verifica se la colonna language esiste nella tabella audio_messages
-            cursor.execute("PRAGMA table_info(audio_messages)")
-            audio_columns = [column[1] for column in cursor.fetchall()]
-            
-            if 'language' not in audio_columns:
-                # Aggiunge la colonna language
-                cursor.execute("ALTER TABLE audio_messages ADD COLUMN language TEXT DEFAULT 'it'")
-                conn.commit()
-                print("Aggiunta colonna language alla tabella audio_messages")
-            
-            if 'action_type' not in audio_columns:
-                # Aggiunge la colonna action_type
-                cursor.execute("ALTER TABLE audio_messages ADD COLUMN action_type TEXT DEFAULT 'wake_up'")
-                conn.commit()
-                print("Aggiunta colonna action_type alla tabella audio_messages")
-            
-        except Exception as e:
-            print(f"Errore nell'aggiornamento schema database: {e}")
-        finally:
-            conn.close()
+    def _migrate_indexes(self, cursor):
+        """Migrazione 2: indici secondari per scheduler e interfaccia"""
+        for statement in INDEXES:
+            cursor.execute(statement)
     
-    def create_default_rooms(self):
-        """Crea le camere di default per l'hotel"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Verifica se le camere esistono già
+    def _migrate_default_rooms(self, cursor):
+        """Migrazione 3: camere di default per l'hotel (solo su database vuoto)"""
         cursor.execute("SELECT COUNT(*) FROM rooms")
-        count = cursor.fetchone()[0]
-        
-        if count == 0:
+        if cursor.fetchone()[0] == 0:
             # Crea camere da 101 a 150 (50 camere)
-            rooms = []
-            for i in range(101, 151):
-                rooms.append((f"1{i:02d}", 'available'))
-            
+            rooms = [(f"1{i:02d}", 'available') for i in range(101, 151)]
             cursor.executemany(
                 "INSERT INTO rooms (room_number, status) VALUES (?, ?)",
                 rooms
             )
-            conn.commit()
             print(f"Create {len(rooms)} camere di default")
+    
+    def _migrate_alarm_epoch(self, cursor):
+        """Migrazione 4: colonna alarm_epoch (secondi epoch) calcolata da alarm_time"""
+        cursor.execute("PRAGMA table_info(alarms)")
+        if 'alarm_epoch' not in {column[1] for column in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE alarms ADD COLUMN alarm_epoch INTEGER")
         
-        conn.close()
+        # alarm_time è un orario locale: la conversione va fatta in Python
+        cursor.execute("SELECT id, alarm_time FROM alarms WHERE alarm_epoch IS NULL")
+        updates = []
+        for alarm_id, alarm_time in cursor.fetchall():
+            try:
+                updates.append((self._alarm_time_values(alarm_time)[1], alarm_id))
+            except (TypeError, ValueError):
+                print(f"Sveglia {alarm_id}: orario non valido {alarm_time!r}")
+        cursor.executemany("UPDATE alarms SET alarm_epoch = ? WHERE id = ?", updates)
+        
+        for statement in EPOCH_INDEXES:
+            cursor.execute(statement)
+    
+    def _migrate_archive_tables(self, cursor):
+        """Migrazione 5: tabelle di archivio per sveglie concluse e log chiamate vecchi"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS alarms_archive (
+                id INTEGER PRIMARY KEY,
+                room_number TEXT NOT NULL,
+                alarm_time TIMESTAMP NOT NULL,
+                audio_message_id INTEGER,
+                status TEXT,
+                snooze_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP,
+                alarm_epoch INTEGER,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS call_logs_archive (
+                id INTEGER PRIMARY KEY,
+                alarm_id INTEGER,
+                room_number TEXT NOT NULL,
+                call_time TIMESTAMP NOT NULL,
+                response TEXT,
+                snooze_minutes INTEGER,
+                status TEXT NOT NULL,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_alarms_archive_epoch ON alarms_archive (alarm_epoch)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_archive_time ON call_logs_archive (call_time)")
+    
+    def _migrate_alarm_stats(self, cursor):
+        """
+        Migrazione 6: colonna fired_epoch (inizio della prima chiamata) e
+        rollup orario alarm_stats_hourly ricostruito dallo storico
+        """
+        for table in ('alarms', 'alarms_archive'):
+            cursor.execute(f"PRAGMA table_info({table})")
+            if 'fired_epoch' not in {column[1] for column in cursor.fetchall()}:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN fired_epoch INTEGER")
+        
+        # Storico: inizio chiamata dal primo log 'initiated' di ogni sveglia
+        cursor.execute('''
+            SELECT alarm_id, MIN(call_time) FROM (
+                SELECT alarm_id, call_time FROM call_logs WHERE status = 'initiated'
+                UNION ALL SELECT alarm_id, call_time FROM call_logs_archive WHERE status = 'initiated'
+            ) GROUP BY alarm_id
+        ''')
+        updates = []
+        for alarm_id, call_time in cursor.fetchall():
+            try:
+                updates.append((int(datetime.datetime.fromisoformat(call_time).timestamp()), alarm_id))
+            except (TypeError, ValueError):
+                continue
+        for table in ('alarms', 'alarms_archive'):
+            cursor.executemany(f"UPDATE {table} SET fired_epoch = ? WHERE id = ? AND fired_epoch IS NULL", updates)
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS alarm_stats_hourly (
+                hour_epoch INTEGER PRIMARY KEY,
+                day TEXT NOT NULL,
+                answered INTEGER DEFAULT 0,
+                snoozed INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                cancelled INTEGER DEFAULT 0,
+                lateness_total REAL DEFAULT 0,
+                lateness_max REAL DEFAULT 0,
+                lateness_count INTEGER DEFAULT 0,
+                peak_concurrent INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_alarm_stats_day ON alarm_stats_hourly (day)")
+        self._rebuild_alarm_stats(cursor)
+    
+    @staticmethod
+    def _alarm_time_values(alarm_time):
+        """
+        Valori da salvare per un orario sveglia
+        
+        Args:
+            alarm_time: datetime o stringa ISO (orario locale)
+            
+        Returns:
+            (stringa ISO, secondi epoch)
+        """
+        if isinstance(alarm_time, str):
+            alarm_time = datetime.datetime.fromisoformat(alarm_time)
+        return alarm_time.isoformat(), int(alarm_time.timestamp())
+    
+    def get_data_version(self, table):
+        """Versione corrente dei dati di una tabella (cambia a ogni modifica)"""
+        with self._versions_lock:
+            return self._data_versions.get((self.db_path, table), 0)
+    
+    def bump_data_version(self, *tables):
+        """Segnala la modifica di una o più tabelle alle cache in memoria"""
+        with self._versions_lock:
+            for table in tables:
+                key = (self.db_path, table)
+                self._data_versions[key] = self._data_versions.get(key, 0) + 1
     
     def get_connection(self):
-        """Restituisce una connessione al database"""
-        return sqlite3.connect(self.db_path)
+        """
+        Restituisce la connessione persistente del thread corrente
+        
+        Il chiamante usa commit() e close() come con una connessione nuova:
+        close() annulla le modifiche non confermate ma non chiude la connessione.
+        """
+        with self._connections_lock:
+            generation = self._generations.get(self.db_path, 0)
+        
+        cached = getattr(self._local, 'connections', None)
+        if cached is None:
+            cached = self._local.connections = {}
+        
+        entry = cached.get(self.db_path)
+        if entry and entry[0] == generation:
+            return entry[1]
+        if entry:
+            # Connessione resa obsoleta da close_all_connections: la chiude
+            # il thread proprietario, mai a metà di una sua operazione
+            try:
+                entry[1].dispose()
+            except sqlite3.Error:
+                pass
+        
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            factory=_ThreadConnection,
+            cached_statements=CACHED_STATEMENTS,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA journal_mode = WAL")     # lettori e scrittore non si bloccano a vicenda
+        conn.execute("PRAGMA synchronous = NORMAL")   # sicuro in WAL, fsync solo al checkpoint
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.db_path = self.db_path
+        conn.owner = threading.current_thread()
+        
+        cached[self.db_path] = (generation, conn)
+        with self._connections_lock:
+            self._connections.add(conn)
+        return conn
+    
+    def checkpoint(self):
+        """Riporta nel file principale le modifiche del WAL (prima di copiare il database)"""
+        conn = self.get_connection()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+    
+    def close_all_connections(self):
+        """
+        Chiude le connessioni di tutti i thread verso questo database (es. prima
+        di sostituire il file con un backup o alla chiusura dell'applicazione).
+        
+        Sono chiuse subito la connessione del thread corrente e quelle di thread
+        terminati. Le altre sono solo segnate come obsolete: un thread ancora
+        attivo (writer, archiviatore, worker) potrebbe essere a metà di una
+        transazione, quindi è lui a chiuderla e a riaprirne una nuova alla
+        chiamata successiva. Per sostituire il file vanno prima fermati i
+        thread che usano il database.
+        """
+        try:
+            self.checkpoint()
+        except sqlite3.Error:
+            pass
+        
+        with self._connections_lock:
+            self._generations[self.db_path] = self._generations.get(self.db_path, 0) + 1
+            # Il file potrebbe essere sostituito (ripristino backup): schema da riverificare
+            self._initialized_paths.discard(self.db_path)
+            connections = [conn for conn in self._connections if conn.db_path == self.db_path]
+        
+        current = threading.current_thread()
+        for conn in connections:
+            if conn.owner is not current and conn.owner.is_alive():
+                continue
+            try:
+                conn.dispose()
+            except sqlite3.Error:
+                pass
+    
+    @staticmethod
+    def _fetch_all(cursor, model):
+        """Righe della query come record del modello (colonne associate per nome)"""
+        cursor.row_factory = model.row_factory(cursor.description)
+        return cursor.fetchall()
+    
+    @staticmethod
+    def _fetch_one(cursor, model):
+        """Prima riga della query come record del modello, o None"""
+        cursor.row_factory = model.row_factory(cursor.description)
+        return cursor.fetchone()
     
     def get_rooms(self, status=None):
         """Ottiene la lista delle camere"""
@@ -189,7 +463,47 @@ class DatabaseManager:
         else:
             cursor.execute("SELECT * FROM rooms ORDER BY room_number")
         
-        rooms = cursor.fetchall()
+        rooms = self._fetch_all(cursor, Room)
+        conn.close()
+        return rooms
+    
+    def select_rooms(self, room_numbers=None, room_range=None, label=None):
+        """
+        Camere di un gruppo (criteri in AND tra loro)
+        
+        Args:
+            room_numbers: lista di numeri camera
+            room_range: (prima, ultima) inclusi; confronto numerico se entrambi numerici
+            label: etichetta camera (senza distinzione maiuscole/minuscole)
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        query = "SELECT * FROM rooms WHERE 1=1"
+        params = []
+        
+        if room_numbers:
+            room_numbers = [str(number) for number in room_numbers]
+            query += f" AND room_number IN ({', '.join('?' * len(room_numbers))})"
+            params.extend(room_numbers)
+        
+        if room_range:
+            first, last = (str(value) for value in room_range)
+            if first.isdigit() and last.isdigit():
+                query += " AND room_number NOT GLOB '*[^0-9]*' AND CAST(room_number AS INTEGER) BETWEEN ? AND ?"
+                params.extend([int(first), int(last)])
+            else:
+                query += " AND room_number BETWEEN ? AND ?"
+                params.extend([first, last])
+        
+        if label:
+            query += " AND label = ? COLLATE NOCASE"
+            params.append(label)
+        
+        query += " ORDER BY room_number"
+        
+        cursor.execute(query, params)
+        rooms = self._fetch_all(cursor, Room)
         conn.close()
         return rooms
     
@@ -198,7 +512,7 @@ class DatabaseManager:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM rooms WHERE room_number = ?", (room_number,))
-        room = cursor.fetchone()
+        room = self._fetch_one(cursor, Room)
         conn.close()
         return room
     
@@ -207,7 +521,7 @@ class DatabaseManager:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM rooms WHERE phone_extension = ?", (phone_extension,))
-        room = cursor.fetchone()
+        room = self._fetch_one(cursor, Room)
         conn.close()
         return room
     
@@ -221,6 +535,7 @@ class DatabaseManager:
         )
         conn.commit()
         conn.close()
+        self.bump_data_version('rooms')
     
     def add_room(self, room_number, phone_extension='', description='', status='available', color='#FFFFFF', label='', language='it'):
         """Aggiunge una nuova camera"""
@@ -233,6 +548,7 @@ class DatabaseManager:
         conn.commit()
         room_id = cursor.lastrowid
         conn.close()
+        self.bump_data_version('rooms')
         return room_id
     
     def update_room(self, room_id, room_number, phone_extension, description, status, color, label, language='it'):
@@ -245,6 +561,7 @@ class DatabaseManager:
         )
         conn.commit()
         conn.close()
+        self.bump_data_version('rooms')
     
     def delete_room(self, room_id):
         """Elimina una camera"""
@@ -253,6 +570,90 @@ class DatabaseManager:
         cursor.execute("DELETE FROM rooms WHERE id = ?", (room_id,))
         conn.commit()
         conn.close()
+        self.bump_data_version('rooms')
+    
+    def bulk_upsert_rooms(self, peers, replace=False):
+        """
+        Importa in un'unica transazione gli interni letti dal PBX
+        
+        Un interno già associato a una camera aggiorna solo la descrizione
+        delle camere create dall'import; una camera con lo stesso numero ma
+        senza interno viene associata all'interno; gli altri interni creano
+        una nuova camera.
+        
+        Args:
+            peers: lista di dict con almeno 'extension' e 'type' (get_sip_peers)
+            replace: elimina prima tutte le camere (pulizia e reimport)
+            
+        Returns:
+            dict con i conteggi inserted, updated, unchanged
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if replace:
+                cursor.execute("DELETE FROM rooms")
+            
+            # Camere senza interno: '' o NULL (righe create prima del default)
+            cursor.execute("SELECT id, room_number, COALESCE(phone_extension, ''), description, label FROM rooms")
+            by_extension = {}
+            by_number = {}
+            for room in cursor.fetchall():
+                by_number[room[1]] = room
+                if room[2]:
+                    by_extension.setdefault(room[2], room)
+            
+            inserts = []
+            updates = []
+            seen = set()
+            for peer in peers:
+                extension = peer['extension']
+                description = f"Interno {extension} ({peer['type']})"
+                existing = by_extension.get(extension)
+                
+                if extension in seen:
+                    # Interno elencato due volte (es. SIP e PJSIP): vale il primo
+                    counts['unchanged'] += 1
+                    continue
+                seen.add(extension)
+                
+                if existing:
+                    if existing[4] == PBX_IMPORT_LABEL and existing[3] != description:
+                        updates.append((description, existing[0]))
+                        counts['updated'] += 1
+                    else:
+                        counts['unchanged'] += 1
+                    continue
+                
+                same_number = by_number.get(extension)
+                if same_number and same_number[2]:
+                    # Numero camera già usato da un altro interno: non si tocca
+                    counts['unchanged'] += 1
+                    continue
+                
+                inserts.append((extension, extension, description, PBX_IMPORT_LABEL))
+                counts['updated' if same_number else 'inserted'] += 1
+            
+            # Una camera con lo stesso numero e senza interno viene associata all'interno
+            cursor.executemany(
+                '''INSERT INTO rooms (room_number, phone_extension, description, status, color, label)
+                   VALUES (?, ?, ?, 'available', '#FFFFFF', ?)
+                   ON CONFLICT(room_number) DO UPDATE SET phone_extension = excluded.phone_extension
+                   WHERE COALESCE(rooms.phone_extension, '') = ''
+                ''',
+                inserts
+            )
+            cursor.executemany("UPDATE rooms SET description = ? WHERE id = ?", updates)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.bump_data_version('rooms')
+        return counts
     
     def add_audio_message(self, name, file_path, duration=None, category='standard', language='it', action_type='wake_up'):
         """Aggiunge un messaggio audio"""
@@ -265,6 +666,7 @@ class DatabaseManager:
         conn.commit()
         message_id = cursor.lastrowid
         conn.close()
+        self.bump_data_version('audio_messages')
         return message_id
     
     def get_audio_messages(self, category=None):
@@ -277,7 +679,7 @@ class DatabaseManager:
         else:
             cursor.execute("SELECT * FROM audio_messages ORDER BY name")
         
-        messages = cursor.fetchall()
+        messages = self._fetch_all(cursor, AudioMessage)
         conn.close()
         return messages
     
@@ -286,41 +688,77 @@ class DatabaseManager:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM audio_messages WHERE name = ?", (name,))
-        message = cursor.fetchone()
+        message = self._fetch_one(cursor, AudioMessage)
         conn.close()
         return message
     
     def add_alarm(self, room_number, alarm_time, audio_message_id=None, snooze_count=0):
-        """Aggiunge una sveglia"""
+        """Aggiunge una sveglia (alarm_time: datetime o stringa ISO)"""
+        alarm_time, alarm_epoch = self._alarm_time_values(alarm_time)
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO alarms (room_number, alarm_time, audio_message_id, snooze_count) VALUES (?, ?, ?, ?)",
-            (room_number, alarm_time, audio_message_id, snooze_count)
+            "INSERT INTO alarms (room_number, alarm_time, alarm_epoch, audio_message_id, snooze_count) VALUES (?, ?, ?, ?, ?)",
+            (room_number, alarm_time, alarm_epoch, audio_message_id, snooze_count)
         )
         conn.commit()
         alarm_id = cursor.lastrowid
         conn.close()
         return alarm_id
     
+    def add_alarms(self, alarms):
+        """
+        Aggiunge più sveglie in un'unica transazione
+        
+        Args:
+            alarms: lista di (room_number, alarm_time, audio_message_id)
+            
+        Returns:
+            lista degli ID creati, nello stesso ordine
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        alarm_ids = []
+        try:
+            for room_number, alarm_time, audio_message_id in alarms:
+                alarm_time, alarm_epoch = self._alarm_time_values(alarm_time)
+                cursor.execute(
+                    "INSERT INTO alarms (room_number, alarm_time, alarm_epoch, audio_message_id) VALUES (?, ?, ?, ?)",
+                    (room_number, alarm_time, alarm_epoch, audio_message_id)
+                )
+                alarm_ids.append(cursor.lastrowid)
+            conn.commit()
+        finally:
+            conn.close()
+        return alarm_ids
+    
     def get_alarm(self, alarm_id):
         """Ottiene una singola sveglia per ID"""
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM alarms WHERE id = ?", (alarm_id,))
-        alarm = cursor.fetchone()
+        alarm = self._fetch_one(cursor, Alarm)
         conn.close()
         return alarm
     
     def get_alarms(self, status=None, room_number=None):
-        """Ottiene le sveglie"""
+        """
+        Ottiene le sveglie ordinate per orario
+        
+        Args:
+            status: status o lista di status (usa l'indice status, alarm_epoch)
+            room_number: numero camera (usa l'indice room_number, status, alarm_epoch)
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
         query = "SELECT * FROM alarms WHERE 1=1"
         params = []
         
-        if status:
+        if isinstance(status, (list, tuple, set)):
+            query += f" AND status IN ({', '.join('?' * len(status))})"
+            params.extend(status)
+        elif status:
             query += " AND status = ?"
             params.append(status)
         
@@ -328,28 +766,59 @@ class DatabaseManager:
             query += " AND room_number = ?"
             params.append(room_number)
         
-        query += " ORDER BY alarm_time"
+        query += " ORDER BY alarm_epoch"
         
         cursor.execute(query, params)
-        alarms = cursor.fetchall()
+        alarms = self._fetch_all(cursor, Alarm)
+        conn.close()
+        return alarms
+    
+    def get_due_alarms(self, until_ts, since_ts=None, status='scheduled'):
+        """
+        Sveglie con orario nell'intervallo [since_ts, until_ts] (range scan
+        sull'indice status, alarm_epoch)
+        
+        Args:
+            until_ts: limite superiore (secondi epoch, incluso)
+            since_ts: limite inferiore (secondi epoch, incluso), None = nessuno
+            status: status delle sveglie
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if since_ts is None:
+            cursor.execute(
+                "SELECT * FROM alarms WHERE status = ? AND alarm_epoch <= ? ORDER BY alarm_epoch",
+                (status, int(until_ts))
+            )
+        else:
+            cursor.execute(
+                "SELECT * FROM alarms WHERE status = ? AND alarm_epoch BETWEEN ? AND ? ORDER BY alarm_epoch",
+                (status, int(since_ts), int(until_ts))
+            )
+        
+        alarms = self._fetch_all(cursor, Alarm)
         conn.close()
         return alarms
     
     def update_alarm(self, alarm_id, alarm_time=None, audio_message_id=None):
-        """Aggiorna i dati di una sveglia"""
+        """Aggiorna i dati di una sveglia (alarm_time: datetime o stringa ISO)"""
+        if alarm_time:
+            alarm_time, alarm_epoch = self._alarm_time_values(alarm_time)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
         # Aggiorna solo i campi forniti
         if alarm_time and audio_message_id is not None:
             cursor.execute(
-                "UPDATE alarms SET alarm_time = ?, audio_message_id = ? WHERE id = ?",
-                (alarm_time, audio_message_id, alarm_id)
+                "UPDATE alarms SET alarm_time = ?, alarm_epoch = ?, audio_message_id = ? WHERE id = ?",
+                (alarm_time, alarm_epoch, audio_message_id, alarm_id)
             )
         elif alarm_time:
             cursor.execute(
-                "UPDATE alarms SET alarm_time = ? WHERE id = ?",
-                (alarm_time, alarm_id)
+                "UPDATE alarms SET alarm_time = ?, alarm_epoch = ? WHERE id = ?",
+                (alarm_time, alarm_epoch, alarm_id)
             )
         elif audio_message_id is not None:
             cursor.execute(
@@ -373,6 +842,72 @@ class DatabaseManager:
         conn.commit()
         conn.close()
     
+    def transition_alarm_status(self, alarm_id, from_status, to_status, fired_epoch=None):
+        """
+        Cambia lo status di una sveglia solo se è ancora in from_status
+        
+        Args:
+            fired_epoch: inizio della chiamata (secondi epoch), registrato solo
+                         al primo tentativo
+        
+        Returns:
+            True se la transizione è avvenuta (operazione atomica tra thread)
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        if fired_epoch is None:
+            cursor.execute(
+                "UPDATE alarms SET status = ? WHERE id = ? AND status = ?",
+                (to_status, alarm_id, from_status)
+            )
+        else:
+            cursor.execute(
+                "UPDATE alarms SET status = ?, fired_epoch = COALESCE(fired_epoch, ?) WHERE id = ? AND status = ?",
+                (to_status, int(fired_epoch), alarm_id, from_status)
+            )
+        conn.commit()
+        changed = cursor.rowcount > 0
+        conn.close()
+        return changed
+    
+    def fail_stale_alarms(self, before_ts):
+        """
+        Porta a 'failed' le sveglie rimaste 'executing' dopo un'interruzione
+        (chiusura o crash durante la chiamata), così l'archiviatore le raccoglie
+        
+        Args:
+            before_ts: solo sveglie partite (o programmate, se mai partite)
+                       prima di questo istante (secondi epoch)
+        
+        Returns:
+            numero di sveglie recuperate
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                "SELECT id, alarm_epoch, fired_epoch FROM alarms WHERE status = 'executing' AND COALESCE(fired_epoch, alarm_epoch) < ?",
+                (int(before_ts),)
+            )
+            stale = cursor.fetchall()
+            cursor.executemany(
+                "UPDATE alarms SET status = 'failed' WHERE id = ? AND status = 'executing'",
+                [(alarm_id,) for alarm_id, _, _ in stale]
+            )
+            # Esito mai registrato nel rollup orario
+            for alarm_id, alarm_epoch, fired_epoch in stale:
+                if alarm_epoch is not None:
+                    lateness = fired_epoch - alarm_epoch if fired_epoch is not None else None
+                    self._apply_alarm_outcome(cursor, alarm_epoch, 'failed', lateness)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(stale)
+    
     def add_call_log(self, alarm_id, room_number, call_time, response=None, snooze_minutes=None, status='completed'):
         """Aggiunge un log di chiamata"""
         conn = self.get_connection()
@@ -384,6 +919,383 @@ class DatabaseManager:
         conn.commit()
         conn.close()
     
+    def get_call_logs(self, alarm_id=None, since=None, until=None, limit=None):
+        """
+        Ottiene i log chiamate, dal più recente
+        
+        Args:
+            alarm_id: solo i log di una sveglia (indice alarm_id)
+            since, until: intervallo di call_time (indice call_time)
+            limit: numero massimo di righe
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        query = "SELECT * FROM call_logs WHERE 1=1"
+        params = []
+        
+        if alarm_id is not None:
+            query += " AND alarm_id = ?"
+            params.append(alarm_id)
+        
+        if since:
+            query += " AND call_time >= ?"
+            params.append(since)
+        
+        if until:
+            query += " AND call_time < ?"
+            params.append(until)
+        
+        query += " ORDER BY call_time DESC"
+        
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        cursor.execute(query, params)
+        logs = self._fetch_all(cursor, CallLog)
+        conn.close()
+        return logs
+    
+    def archive_alarms(self, before_ts, statuses, batch_size=500):
+        """
+        Sposta in alarms_archive un blocco di sveglie concluse
+        
+        Args:
+            before_ts: solo sveglie con orario precedente (secondi epoch)
+            statuses: status considerati conclusi
+            batch_size: righe massime spostate in questa transazione
+            
+        Returns:
+            numero di sveglie archiviate (minore di batch_size = nient'altro da archiviare)
+        """
+        placeholders = ', '.join('?' * len(statuses))
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Range scan sull'indice status, alarm_epoch
+            cursor.execute(
+                f"SELECT id FROM alarms WHERE status IN ({placeholders}) AND alarm_epoch < ? LIMIT ?",
+                (*statuses, int(before_ts), batch_size)
+            )
+            ids = [(row[0],) for row in cursor.fetchall()]
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO alarms_archive ({ALARM_COLUMNS}) SELECT {ALARM_COLUMNS} FROM alarms WHERE id = ?",
+                ids
+            )
+            cursor.executemany("DELETE FROM alarms WHERE id = ?", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(ids)
+    
+    def archive_call_logs(self, before, batch_size=500):
+        """
+        Sposta in call_logs_archive un blocco di log chiamate
+        
+        Args:
+            before: datetime, solo log con call_time precedente
+            batch_size: righe massime spostate in questa transazione
+            
+        Returns:
+            numero di log archiviati
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Range scan sull'indice call_time
+            cursor.execute("SELECT id FROM call_logs WHERE call_time < ? LIMIT ?", (before, batch_size))
+            ids = [(row[0],) for row in cursor.fetchall()]
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO call_logs_archive ({CALL_LOG_COLUMNS}) SELECT {CALL_LOG_COLUMNS} FROM call_logs WHERE id = ?",
+                ids
+            )
+            cursor.executemany("DELETE FROM call_logs WHERE id = ?", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(ids)
+    
+    def get_archived_alarms(self, since_ts=None, until_ts=None, room_number=None):
+        """Sveglie archiviate, ordinate per orario (intervallo in secondi epoch)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        query = "SELECT * FROM alarms_archive WHERE 1=1"
+        params = []
+        
+        if since_ts is not None:
+            query += " AND alarm_epoch >= ?"
+            params.append(int(since_ts))
+        
+        if until_ts is not None:
+            query += " AND alarm_epoch < ?"
+            params.append(int(until_ts))
+        
+        if room_number:
+            query += " AND room_number = ?"
+            params.append(room_number)
+        
+        query += " ORDER BY alarm_epoch"
+        
+        cursor.execute(query, params)
+        alarms = self._fetch_all(cursor, Alarm)
+        conn.close()
+        return alarms
+    
+    def get_dashboard_stats(self):
+        """
+        Contatori per il monitor di sistema con due query aggregate (costo
+        indipendente dallo storico: GROUP BY sugli indici e COUNT)
+        
+        Returns:
+            dict con rooms_by_status, alarms_by_status, total_rooms, total_alarms,
+            audio_messages, call_logs, completed_today, next_alarm (datetime o None)
+        """
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        today_ts = int(today.timestamp())
+        tomorrow_ts = int((today + datetime.timedelta(days=1)).timestamp())
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT 'rooms', status, COUNT(*) FROM rooms GROUP BY status
+            UNION ALL SELECT 'alarms', status, COUNT(*) FROM alarms GROUP BY status
+            UNION ALL SELECT 'audio_messages', NULL, COUNT(*) FROM audio_messages
+            UNION ALL SELECT 'call_logs', NULL, COUNT(*) FROM call_logs
+        ''')
+        counts = {'rooms': {}, 'alarms': {}, 'audio_messages': {}, 'call_logs': {}}
+        for table, status, count in cursor.fetchall():
+            counts[table][status] = count
+        
+        # Le sveglie di oggi già archiviate contano comunque tra le completate
+        cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM alarms WHERE status = 'completed' AND alarm_epoch >= ? AND alarm_epoch < ?),
+                (SELECT COUNT(*) FROM alarms_archive WHERE alarm_epoch >= ? AND alarm_epoch < ? AND status = 'completed'),
+                (SELECT MIN(alarm_epoch) FROM alarms WHERE status = 'scheduled')
+        ''', (today_ts, tomorrow_ts, today_ts, tomorrow_ts))
+        completed_today, archived_today, next_epoch = cursor.fetchone()
+        conn.close()
+        
+        return {
+            'rooms_by_status': counts['rooms'],
+            'alarms_by_status': counts['alarms'],
+            'total_rooms': sum(counts['rooms'].values()),
+            'total_alarms': sum(counts['alarms'].values()),
+            'audio_messages': counts['audio_messages'].get(None, 0),
+            'call_logs': counts['call_logs'].get(None, 0),
+            'completed_today': completed_today + archived_today,
+            'next_alarm': datetime.datetime.fromtimestamp(next_epoch) if next_epoch is not None else None
+        }
+    
+    @staticmethod
+    def _stats_hour(epoch):
+        """(inizio dell'ora locale in secondi epoch, giorno ISO) di un orario sveglia"""
+        hour = datetime.datetime.fromtimestamp(epoch).replace(minute=0, second=0, microsecond=0)
+        return int(hour.timestamp()), hour.date().isoformat()
+    
+    def record_alarm_outcome(self, alarm_epoch, outcome, lateness=None, concurrent_calls=None):
+        """
+        Aggiorna il rollup orario con l'esito finale di una sveglia
+        
+        Args:
+            alarm_epoch: orario programmato della sveglia (ora di riferimento)
+            outcome: status finale ('completed', 'snoozed', 'failed', 'cancelled')
+            lateness: secondi tra orario programmato e inizio chiamata
+            concurrent_calls: chiamate in corso all'avvio della chiamata
+            
+        Returns:
+            False se l'esito non è tra quelli conteggiati
+        """
+        if outcome not in STATS_OUTCOMES:
+            return False
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        self._apply_alarm_outcome(cursor, alarm_epoch, outcome, lateness, concurrent_calls)
+        conn.commit()
+        conn.close()
+        return True
+    
+    def _apply_alarm_outcome(self, cursor, alarm_epoch, outcome, lateness=None, concurrent_calls=None):
+        """Aggiornamento di alarm_stats_hourly (dentro la transazione del chiamante)"""
+        column = STATS_OUTCOMES.get(outcome)
+        if column is None:
+            return
+        hour_epoch, day = self._stats_hour(alarm_epoch)
+        cursor.execute("INSERT OR IGNORE INTO alarm_stats_hourly (hour_epoch, day) VALUES (?, ?)", (hour_epoch, day))
+        cursor.execute(
+            f"""UPDATE alarm_stats_hourly SET {column} = {column} + 1,
+                lateness_total = lateness_total + ?, lateness_max = MAX(lateness_max, ?),
+                lateness_count = lateness_count + ?, peak_concurrent = MAX(peak_concurrent, ?)
+                WHERE hour_epoch = ?""",
+            (max(lateness or 0, 0), max(lateness or 0, 0), 0 if lateness is None else 1,
+             concurrent_calls or 0, hour_epoch)
+        )
+    
+    def write_batch(self, call_logs=(), statuses=None, outcomes=()):
+        """
+        Scritture raccolte dal DatabaseWriter, applicate in un'unica transazione
+        
+        Args:
+            call_logs: lista di (alarm_id, room_number, call_time, response, snooze_minutes, status)
+            statuses: dict alarm_id -> (ultimo status richiesto, from_status);
+                      con from_status lo status cambia solo se la sveglia è
+                      ancora in from_status (come transition_alarm_status)
+            outcomes: lista di (alarm_id, alarm_epoch, outcome, lateness, concurrent_calls);
+                      outcome None = status della sveglia dopo gli aggiornamenti
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            if call_logs:
+                cursor.executemany(
+                    "INSERT INTO call_logs (alarm_id, room_number, call_time, response, snooze_minutes, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    call_logs
+                )
+            if statuses:
+                cursor.executemany(
+                    "UPDATE alarms SET status = ? WHERE id = ? AND status = COALESCE(?, status)",
+                    [(status, alarm_id, from_status) for alarm_id, (status, from_status) in statuses.items()]
+                )
+            for alarm_id, alarm_epoch, outcome, lateness, concurrent_calls in outcomes:
+                if outcome is None:
+                    cursor.execute("SELECT status FROM alarms WHERE id = ?", (alarm_id,))
+                    row = cursor.fetchone()
+                    outcome = row[0] if row else None
+                self._apply_alarm_outcome(cursor, alarm_epoch, outcome, lateness, concurrent_calls)
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def rebuild_alarm_stats(self):
+        """Ricalcola alarm_stats_hourly da sveglie attive e archiviate"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self._rebuild_alarm_stats(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def _rebuild_alarm_stats(self, cursor):
+        """
+        Ricostruzione del rollup (dentro la transazione del chiamante).
+        
+        Una sveglia conta come chiamata se completata o fallita, oppure se
+        rinviata dopo essere partita (fired_epoch): i rinvii manuali dalla
+        reception non sono chiamate. Le cancellazioni contano solo se la
+        sveglia non è mai partita. Il picco di chiamate contemporanee non
+        è ricavabile dallo storico e viene mantenuto.
+        """
+        cursor.execute("SELECT hour_epoch, peak_concurrent FROM alarm_stats_hourly")
+        peaks = dict(cursor.fetchall())
+        
+        cursor.execute('''
+            SELECT alarm_epoch, status, fired_epoch FROM alarms
+            UNION ALL SELECT alarm_epoch, status, fired_epoch FROM alarms_archive
+        ''')
+        hours = {}
+        for alarm_epoch, status, fired_epoch in cursor.fetchall():
+            column = STATS_OUTCOMES.get(status)
+            if alarm_epoch is None or column is None:
+                continue
+            if status == 'snoozed' and fired_epoch is None:
+                continue
+            if status == 'cancelled' and fired_epoch is not None:
+                continue
+            
+            hour_epoch, day = self._stats_hour(alarm_epoch)
+            row = hours.setdefault(hour_epoch, {
+                'day': day, 'answered': 0, 'snoozed': 0, 'failed': 0, 'cancelled': 0,
+                'lateness_total': 0, 'lateness_max': 0, 'lateness_count': 0
+            })
+            row[column] += 1
+            if fired_epoch is not None and column != 'cancelled':
+                lateness = max(fired_epoch - alarm_epoch, 0)
+                row['lateness_total'] += lateness
+                row['lateness_max'] = max(row['lateness_max'], lateness)
+                row['lateness_count'] += 1
+        
+        cursor.execute("DELETE FROM alarm_stats_hourly")
+        cursor.executemany(
+            '''INSERT INTO alarm_stats_hourly (hour_epoch, day, answered, snoozed, failed, cancelled,
+                   lateness_total, lateness_max, lateness_count, peak_concurrent)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(hour_epoch, row['day'], row['answered'], row['snoozed'], row['failed'], row['cancelled'],
+              row['lateness_total'], row['lateness_max'], row['lateness_count'], peaks.get(hour_epoch, 0))
+             for hour_epoch, row in hours.items()]
+        )
+    
+    def get_alarm_stats(self, since_ts=None, until_ts=None, group_by='day'):
+        """
+        KPI del servizio sveglie dal rollup orario
+        
+        Args:
+            since_ts, until_ts: intervallo in secondi epoch (until escluso)
+            group_by: 'day' o 'hour'
+            
+        Returns:
+            lista di dict (dal più vecchio) con period, calls, answered, snoozed,
+            failed, cancelled, answer_rate, snooze_rate, failure_rate,
+            avg_lateness, max_lateness, peak_concurrent
+        """
+        key = 'day' if group_by == 'day' else 'hour_epoch'
+        query = f'''
+            SELECT {key}, MIN(hour_epoch), SUM(answered), SUM(snoozed), SUM(failed), SUM(cancelled),
+                   SUM(lateness_total), MAX(lateness_max), SUM(lateness_count), MAX(peak_concurrent)
+            FROM alarm_stats_hourly WHERE 1=1'''
+        params = []
+        
+        if since_ts is not None:
+            query += " AND hour_epoch >= ?"
+            params.append(int(since_ts))
+        
+        if until_ts is not None:
+            query += " AND hour_epoch < ?"
+            params.append(int(until_ts))
+        
+        query += f" GROUP BY {key} ORDER BY MIN(hour_epoch)"
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        conn.close()
+        
+        stats = []
+        for (period, hour_epoch, answered, snoozed, failed, cancelled,
+             lateness_total, lateness_max, lateness_count, peak) in rows:
+            calls = answered + snoozed + failed
+            stats.append({
+                'period': period if group_by == 'day' else datetime.datetime.fromtimestamp(hour_epoch),
+                'calls': calls,
+                'answered': answered,
+                'snoozed': snoozed,
+                'failed': failed,
+                'cancelled': cancelled,
+                'answer_rate': (answered + snoozed) / calls if calls else 0.0,
+                'snooze_rate': snoozed / (answered + snoozed) if answered + snoozed else 0.0,
+                'failure_rate': failed / calls if calls else 0.0,
+                'avg_lateness': lateness_total / lateness_count if lateness_count else 0.0,
+                'max_lateness': lateness_max,
+                'peak_concurrent': peak
+            })
+        return stats
+    
     def update_audio_message(self, message_id, name, file_path, duration=None, category='standard', language='it', action_type='wake_up'):
         """Aggiorna un messaggio audio"""
         conn = self.get_connection()
@@ -394,6 +1306,7 @@ class DatabaseManager:
         )
         conn.commit()
         conn.close()
+        self.bump_data_version('audio_messages')
     
     def delete_audio_message(self, message_id):
         """Elimina un messaggio audio"""
@@ -402,6 +1315,7 @@ class DatabaseManager:
         cursor.execute("DELETE FROM audio_messages WHERE id = ?", (message_id,))
         conn.commit()
         conn.close()
+        self.bump_data_version('audio_messages')
     
     def get_audio_message_by_action_and_language(self, action_type, language='it'):
         """Ottiene un messaggio audio per tipo di azione e lingua"""
@@ -411,7 +1325,7 @@ class DatabaseManager:
             "SELECT * FROM audio_messages WHERE action_type = ? AND language = ? LIMIT 1",
             (action_type, language)
         )
-        message = cursor.fetchone()
+        message = self._fetch_one(cursor, AudioMessage)
         conn.close()
         return message
 
@@ -424,4 +1338,4 @@ if __name__ == "__main__":
     rooms = db.get_rooms()
     print(f"Camere trovate: {len(rooms)}")
     for room in rooms[:5]:  # Mostra solo le prime 5
-        print(f"Camera {room[1]} - Status: {room[2]}")
+        print(f"Camera {room.room_number} - Status: {room.status}")
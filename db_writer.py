@@ -0,0 +1,148 @@
+"""
+Scrittore in background per log chiamate e status delle sveglie
+"""
+import queue
+import threading
+import time
+from logger import get_logger
+
+class DatabaseWriter:
+    """
+    Unico thread che scrive log chiamate, status sveglie ed esiti nel database.
+
+    I worker delle chiamate accodano le scritture e proseguono senza
+    attendere SQLite. Il thread raccoglie per commit_interval secondi tutto
+    ciò che arriva e lo scrive in un'unica transazione (group commit): per
+    ogni sveglia conta solo l'ultimo status richiesto, i log chiamate sono
+    inseriti in blocco.
+
+    flush() è la barriera per chi deve rileggere subito quanto scritto
+    (transizioni condizionali di status, refresh dell'interfaccia).
+    Se il thread non è avviato le scritture sono eseguite subito.
+    """
+
+    def __init__(self, db_manager, commit_interval=0.005):
+        self.db = db_manager
+        self.commit_interval = commit_interval
+        self.logger = get_logger('db_writer')
+
+        self.running = False
+        self.writer_thread = None
+        self._queue = queue.Queue()
+        # running e accodamento insieme: niente finisce in coda dopo il sentinella di stop()
+        self._state_lock = threading.Lock()
+
+    def start(self):
+        """Avvia il thread di scrittura"""
+        if self.running:
+            return
+        self.running = True
+        self.writer_thread = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self.writer_thread.start()
+
+    def stop(self, timeout=2.0):
+        """Scrive quanto ancora in coda e ferma il thread"""
+        if not self.running:
+            return
+        self.flush(timeout)
+        with self._state_lock:
+            self.running = False
+            self._queue.put(None)
+        if self.writer_thread and self.writer_thread.is_alive():
+            self.writer_thread.join(timeout=timeout)
+
+    def add_call_log(self, alarm_id, room_number, call_time, response=None, snooze_minutes=None, status='completed'):
+        """Accoda un log chiamata (stessi argomenti di DatabaseManager.add_call_log)"""
+        self._submit(('call_log', (alarm_id, room_number, call_time, response, snooze_minutes, status)))
+
+    def update_alarm_status(self, alarm_id, status, from_status=None):
+        """
+        Accoda un cambio di status (prevale l'ultimo accodato per la sveglia)
+
+        Args:
+            from_status: se indicato, lo status cambia solo se la sveglia è
+                         ancora in from_status al momento della scrittura
+        """
+        self._submit(('status', (alarm_id, status, from_status)))
+
+    def record_alarm_outcome(self, alarm_id, alarm_epoch, outcome=None, lateness=None, concurrent_calls=None):
+        """
+        Accoda l'esito finale di una sveglia per le statistiche orarie
+
+        Args:
+            outcome: status finale; None = status della sveglia al momento della scrittura
+        """
+        self._submit(('outcome', (alarm_id, alarm_epoch, outcome, lateness, concurrent_calls)))
+
+    def flush(self, timeout=5.0):
+        """
+        Attende che tutte le scritture accodate finora siano confermate
+
+        Returns:
+            True se la coda è stata scritta entro il timeout
+        """
+        done = threading.Event()
+        with self._state_lock:
+            if not self.running:
+                return True
+            self._queue.put(('flush', done))
+        return done.wait(timeout)
+
+    def _submit(self, item):
+        with self._state_lock:
+            if self.running:
+                self._queue.put(item)
+                return
+        # Thread fermo o in chiusura: scrittura immediata
+        self._write([item])
+
+    def _writer_loop(self):
+        # Termina solo sul sentinella: le scritture accodate prima di stop()
+        # vengono applicate anche se running è già False
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            # Raccoglie le scritture che arrivano entro commit_interval
+            batch = [item]
+            deadline = time.monotonic() + self.commit_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        """Scrive un blocco di operazioni in una transazione e sblocca i flush"""
+        call_logs = []
+        statuses = {}
+        outcomes = []
+        barriers = []
+        for kind, payload in batch:
+            if kind == 'call_log':
+                call_logs.append(payload)
+            elif kind == 'status':
+                alarm_id, status, from_status = payload
+                statuses[alarm_id] = (status, from_status)
+            elif kind == 'outcome':
+                outcomes.append(payload)
+            elif kind == 'flush':
+                barriers.append(payload)
+
+        try:
+            if call_logs or statuses or outcomes:
+                self.db.write_batch(call_logs, statuses, outcomes)
+        except Exception as e:
+            self.logger.error(f"Errore scrittura database ({len(batch)} operazioni): {e}")
+        finally:
+            for done in barriers:
+                done.set()
@@ -0,0 +1,320 @@
+"""
+Stato degli interni del centralino condiviso da tutta l'applicazione
+"""
+import threading
+import time
+from config import PBX_CONFIG
+from pbx_connection import PBXConnection, PEER_COMMANDS
+from logger import get_logger
+
+CONTACTS_COMMAND = 'pjsip show contacts'  # raggiungibilità e RTT dei telefoni PJSIP registrati
+
+# Stato dei contatti PJSIP -> stato interno (come _parse_sip_output). Solo un
+# esito di qualify negativo vale 'offline': Unknown, Created, NonQual e stati
+# non riconosciuti non dicono nulla sul telefono e non devono bloccare le chiamate
+_CONTACT_STATUS = {
+    'Avail': 'online',
+    'Reachable': 'online',
+    'Unavail': 'offline',
+    'Unreachable': 'offline',  # nome di Unavail nelle prime versioni di Asterisk 13
+}
+
+_STATUS_RANK = {'online': 2, 'unmonitored': 1, 'offline': 0}
+
+def parse_pjsip_contacts(output):
+    """
+    Parsa l'output di 'pjsip show contacts'
+
+    Formato tipico:
+        Contact:  101/sip:101@10.0.0.15:5060    a1b2c3d4e5 Avail        12.345
+        Contact:  102/sip:102@10.0.0.16:5060    f6a7b8c9d0 Unavail         nan
+
+    Returns:
+        dict interno -> (status, latency); con più contatti per interno
+        conta il migliore
+    """
+    contacts = {}
+    for line in output.split('\n'):
+        parts = line.split()
+        # Salta intestazione ("<Aor/ContactUri...>"), separatori e riepilogo
+        if len(parts) < 4 or parts[0] != 'Contact:' or parts[1].startswith('<'):
+            continue
+
+        extension = parts[1].split('/')[0]
+        if not extension.isdigit():
+            continue
+
+        status = _CONTACT_STATUS.get(parts[3], 'unmonitored')
+        latency = None
+        if len(parts) >= 5:
+            try:
+                latency = int(float(parts[4]))
+            except ValueError:
+                pass  # 'nan': contatto non qualificato
+
+        current = contacts.get(extension)
+        if current is None or _STATUS_RANK[status] > _STATUS_RANK[current[0]]:
+            contacts[extension] = (status, latency)
+    return contacts
+
+
+class ExtensionSnapshot:
+    """
+    Stato di tutti gli interni letto con un solo poll
+
+    Attributi:
+        peers: lista di dict come get_sip_peers, più 'changed_at'
+               (epoch dell'ultimo cambio di stato osservato)
+        by_extension: interno -> dict del peer
+        taken_at: epoch di inizio del poll
+        error: errore del poll (peers resta quello dell'ultimo poll riuscito)
+    """
+
+    __slots__ = ('peers', 'by_extension', 'taken_at', 'error')
+
+    def __init__(self, peers, taken_at, error=None):
+        self.peers = peers
+        self.by_extension = {peer['extension']: peer for peer in peers}
+        self.taken_at = taken_at
+        self.error = error
+
+    def age(self):
+        """Secondi trascorsi dal poll"""
+        return time.time() - self.taken_at
+
+    def get(self, extension):
+        """Stato di un interno (dict del peer) o None"""
+        return self.by_extension.get(extension)
+
+    def is_reachable(self, extension):
+        """
+        Raggiungibilità di un interno
+
+        Returns:
+            True online, False offline, None se non si può dire (poll
+            fallito, interno sconosciuto o non monitorato)
+        """
+        if self.error:
+            return None
+        peer = self.get(extension)
+        if peer is None or peer['status'] == 'unmonitored':
+            return None
+        return peer['status'] == 'online'
+
+    def counts(self):
+        """Numero di interni per stato"""
+        counts = {'online': 0, 'offline': 0, 'unmonitored': 0}
+        for peer in self.peers:
+            counts[peer['status']] = counts.get(peer['status'], 0) + 1
+        return counts
+
+
+class ExtensionStatusService:
+    """
+    Fotografia dello stato degli interni letta dal PBX al più una volta per
+    intervallo e servita a tutti: finestre Gestione Camere, import degli
+    interni e controllo di raggiungibilità prima delle chiamate di sveglia.
+
+    Il poll è "read-through": parte solo quando un consumatore chiede uno
+    stato più recente di quello in memoria. 'sip show peers',
+    'pjsip show endpoints' e 'pjsip show contacts' viaggiano in un unico
+    batch sulla sessione condivisa; richieste contemporanee attendono lo
+    stesso poll, quindi il carico sul PBX non dipende da quante finestre
+    sono aperte.
+
+    Con start() un thread tiene aggiornata la fotografia a ogni intervallo:
+    i worker delle sveglie la leggono con cached_reachability senza mai
+    attendere il PBX.
+    """
+
+    def __init__(self, pbx_connection=None, interval=None):
+        """
+        Args:
+            pbx_connection: connessione usata per i poll (default una PBXConnection propria)
+            interval: secondi di validità della fotografia (default PBX_CONFIG['status_refresh_interval'])
+        """
+        self.pbx = pbx_connection or PBXConnection()
+        self.interval = interval if interval is not None else PBX_CONFIG.get('status_refresh_interval', 30)
+        self.logger = get_logger('extension_status')
+
+        self._lock = threading.Lock()       # protegge _snapshot
+        self._poll_lock = threading.Lock()  # un solo poll alla volta
+        self._snapshot = None
+        self.poll_count = 0
+
+        self.running = False
+        self._refresh_thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Avvia il thread che aggiorna la fotografia a ogni intervallo"""
+        if self.running:
+            return
+        self.running = True
+        self._stop_event.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name="extension-status", daemon=True)
+        self._refresh_thread.start()
+
+    def stop(self):
+        """Ferma il thread di aggiornamento (un poll in corso termina in background)"""
+        if not self.running:
+            return
+        self.running = False
+        self._stop_event.set()
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            self._refresh_thread.join(timeout=0.5)
+        self._refresh_thread = None
+
+    def _refresh_loop(self):
+        while self.running:
+            try:
+                # Nessun poll se una finestra ne ha appena fatto uno
+                snapshot = self.get_snapshot()
+                wait = self.interval - snapshot.age()
+            except Exception as e:
+                self.logger.error(f"Errore aggiornamento stato interni: {e}")
+                wait = self.interval
+            self._stop_event.wait(max(1.0, wait))
+
+    def get_snapshot(self, max_age=None):
+        """
+        Fotografia non più vecchia di max_age secondi (poll se necessario)
+
+        Un poll fallito viene conservato come fotografia con error: fino alla
+        sua scadenza non si ritenta, così un PBX irraggiungibile non viene
+        interrogato da ogni consumatore.
+
+        Args:
+            max_age: età massima accettata (default interval; 0 = poll nuovo)
+        """
+        max_age = self.interval if max_age is None else max_age
+        # Vale solo un poll iniziato dopo questo istante
+        oldest = time.time() - max_age
+
+        snapshot = self._fresh(oldest)
+        if snapshot is not None:
+            return snapshot
+
+        with self._poll_lock:
+            # Il poll atteso sul lock può aver già prodotto una fotografia valida
+            snapshot = self._fresh(oldest)
+            if snapshot is not None:
+                return snapshot
+            return self._poll()
+
+    def get_cached(self):
+        """Ultima fotografia in memoria (anche scaduta) o None, senza poll"""
+        with self._lock:
+            return self._snapshot
+
+    def get_peers(self, max_age=None):
+        """
+        Interni del PBX nel formato di PBXConnection.get_sip_peers
+
+        Returns:
+            (peers, error)
+        """
+        snapshot = self.get_snapshot(max_age)
+        if snapshot.error:
+            return None, snapshot.error
+        if not snapshot.peers:
+            return None, "Nessun interno trovato"
+        return [dict(peer) for peer in snapshot.peers], None
+
+    def get_status(self, extension, max_age=None):
+        """Stato di un interno (dict del peer) o None se sconosciuto"""
+        return self.get_snapshot(max_age).get(extension)
+
+    def is_reachable(self, extension, max_age=None):
+        """
+        Raggiungibilità di un interno secondo la fotografia
+
+        Returns:
+            True online, False offline, None se non si può dire (poll
+            fallito, interno sconosciuto o non monitorato)
+        """
+        return self.get_snapshot(max_age).is_reachable(extension)
+
+    def cached_reachability(self, extension, max_age=None):
+        """
+        Raggiungibilità dalla fotografia in memoria, senza mai interrogare il PBX
+
+        Args:
+            max_age: età massima accettata (default due intervalli); una
+                fotografia assente o più vecchia vale None (si chiama)
+        """
+        max_age = 2 * self.interval if max_age is None else max_age
+        snapshot = self.get_cached()
+        if snapshot is None or snapshot.age() > max_age:
+            return None
+        return snapshot.is_reachable(extension)
+
+    def _fresh(self, oldest):
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None and snapshot.taken_at >= oldest:
+            return snapshot
+        return None
+
+    def _poll(self):
+        """Legge lo stato dal PBX e pubblica la nuova fotografia"""
+        taken_at = time.time()
+        self.poll_count += 1
+        with self._lock:
+            previous = self._snapshot
+
+        try:
+            sip_result, pjsip_result, contacts_result = self.pbx.execute_cli_batch(
+                PEER_COMMANDS + [CONTACTS_COMMAND])
+            peers, error = self.pbx.parse_peers(sip_result, pjsip_result)
+            if peers is not None:
+                self._apply_contacts(peers, contacts_result)
+        except Exception as e:
+            peers, error = None, str(e)
+
+        if error:
+            self.logger.warning(f"Lettura stato interni non riuscita: {error}")
+            snapshot = ExtensionSnapshot(previous.peers if previous else [], taken_at, error)
+        else:
+            self._carry_timestamps(peers, previous, taken_at)
+            snapshot = ExtensionSnapshot(peers, taken_at)
+            counts = snapshot.counts()
+            self.logger.info(f"Stato interni aggiornato: {len(peers)} interni, "
+                             f"{counts['online']} online, {counts['offline']} offline")
+
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def _apply_contacts(self, peers, contacts_result):
+        """Stato e RTT degli interni PJSIP dai contatti registrati"""
+        output, error = contacts_result
+        if error or not output or 'No such command' in output:
+            return
+        contacts = parse_pjsip_contacts(output)
+        for peer in peers:
+            # Endpoint senza contatti: resta lo stato dell'endpoint
+            if peer['type'] == 'PJSIP' and peer['extension'] in contacts:
+                peer['status'], peer['latency'] = contacts[peer['extension']]
+
+    @staticmethod
+    def _carry_timestamps(peers, previous, taken_at):
+        """changed_at resta quello precedente finché lo stato non cambia"""
+        for peer in peers:
+            old = previous.get(peer['extension']) if previous else None
+            if old is not None and old['status'] == peer['status']:
+                peer['changed_at'] = old['changed_at']
+            else:
+                peer['changed_at'] = taken_at
+
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_extension_status_service():
+    """Servizio stato interni del processo, creato alla prima richiesta"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ExtensionStatusService()
+        return _service
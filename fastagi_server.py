@@ -0,0 +1,294 @@
+"""
+Server FastAGI integrato per le chiamate di sveglia
+"""
+import socket
+import threading
+from pbx_backend import NO_ANSWER
+from logger import get_logger
+
+FASTAGI_DEFAULT_PORT = 4573
+
+DIGIT_PAUSE_MS = 500  # pausa dopo la conferma snooze prima dell'hangup (come Wait(0.5))
+
+class AGIHangup(Exception):
+    """Il canale è stato chiuso durante lo scambio AGI"""
+
+
+class _AGIChannel:
+    """Connessione AGI di una chiamata: environment e comandi riga per riga"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('r', encoding='utf-8', errors='replace', newline='\n')
+        self.env = {}
+
+    def read_environment(self):
+        """Legge le variabili agi_* fino alla riga vuota"""
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise AGIHangup("Connessione chiusa durante l'environment")
+            line = line.rstrip('\r\n')
+            if not line:
+                return self.env
+            key, _, value = line.partition(':')
+            self.env[key.strip()] = value.strip()
+
+    def execute(self, command):
+        """
+        Invia un comando AGI e restituisce il valore di result
+
+        Raises:
+            AGIHangup se il canale è chiuso o il comando non è più permesso
+        """
+        self.sock.sendall(f"{command}\n".encode('utf-8'))
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise AGIHangup("Connessione chiusa")
+            line = line.rstrip('\r\n')
+            # Notifica asincrona di hangup: la risposta al comando segue
+            if line == 'HANGUP':
+                continue
+            code = line[:3]
+            if line[3:4] == '-':
+                # Risposta su più righe (uso del comando): termina con "<code> "
+                while line and not line.startswith(f"{code} "):
+                    line = self.reader.readline().rstrip('\r\n')
+            break
+
+        if code == '511':
+            raise AGIHangup(line)
+        if code != '200':
+            raise RuntimeError(f"Comando AGI '{command}' fallito: {line}")
+
+        result = None
+        for part in line[4:].split():
+            if part.startswith('result='):
+                result = part[len('result='):]
+        if result == '-1':
+            raise AGIHangup(line)
+        return result
+
+    @staticmethod
+    def digit(result):
+        """Tasto dal result di STREAM FILE / WAIT FOR DIGIT (codice ASCII, 0 = nessuno)"""
+        if not result or result == '0':
+            return None
+        try:
+            return chr(int(result))
+        except ValueError:
+            return None
+
+
+class _PendingCall:
+    """Prompt ed esito di una chiamata affidata al server FastAGI"""
+
+    __slots__ = ('call_id', 'wake_audio', 'snooze_5_audio', 'snooze_10_audio',
+                 'digit_timeout', 'result', 'done')
+
+    def __init__(self, call_id, wake_audio, snooze_5_audio, snooze_10_audio, digit_timeout):
+        self.call_id = call_id
+        self.wake_audio = wake_audio
+        self.snooze_5_audio = snooze_5_audio
+        self.snooze_10_audio = snooze_10_audio
+        self.digit_timeout = digit_timeout
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result):
+        """Registra l'esito (conta solo il primo)"""
+        if not self.done.is_set():
+            self.result = result
+            self.done.set()
+
+
+class FastAGIServer:
+    """
+    Server FastAGI a cui il context 'wakeup-agi' del dialplan affida le
+    chiamate di sveglia (AGI(agi://<host>:<porta>/wakeup,<call_id>)).
+
+    Per ogni chiamata registrata con register_call il server riproduce
+    l'audio di sveglia, raccoglie il tasto, riproduce la conferma dello
+    snooze e consegna l'esito a wait_call_result nello stesso processo:
+    nessun file temporaneo, nessuna shell sul PBX, nessun polling via SSH.
+    Ogni connessione AGI è servita da un thread proprio.
+    """
+
+    def __init__(self, listen_host='0.0.0.0', port=FASTAGI_DEFAULT_PORT):
+        self.listen_host = listen_host
+        self.port = port
+        self.logger = get_logger('fastagi_server')
+
+        self.running = False
+        self.server_thread = None
+        self._sock = None
+        self._lock = threading.Lock()
+        self._calls = {}  # call_id -> _PendingCall
+
+    def start(self):
+        """Apre la porta e avvia il thread di accettazione"""
+        if self.running:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.listen_host, self.port))
+        sock.listen(64)
+        # Porta effettiva (0 = scelta dal sistema)
+        self.port = sock.getsockname()[1]
+        self._sock = sock
+        self.running = True
+        self.server_thread = threading.Thread(target=self._accept_loop, name="fastagi", daemon=True)
+        self.server_thread.start()
+        self.logger.info(f"Server FastAGI in ascolto su {self.listen_host}:{self.port}")
+
+    def stop(self):
+        """Chiude la porta; le chiamate in attesa ricevono esito None"""
+        if not self.running:
+            return
+        self.running = False
+        try:
+            # shutdown sblocca accept() prima della chiusura del descrittore
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.server_thread and self.server_thread.is_alive():
+            self.server_thread.join(timeout=1.0)
+        with self._lock:
+            calls = list(self._calls.values())
+        for call in calls:
+            call.finish(None)
+        self.logger.info("Server FastAGI fermato")
+
+    def register_call(self, call_id, wake_audio, snooze_5_audio='', snooze_10_audio='', digit_timeout=30):
+        """
+        Registra i prompt di una chiamata prima dell'originate
+
+        Args:
+            call_id: ID della chiamata (extension nel context wakeup-agi)
+            wake_audio: audio di sveglia come nome Asterisk (es. custom/wakeup_it)
+            snooze_5_audio / snooze_10_audio: audio di conferma ('' = nessuno)
+            digit_timeout: secondi di attesa del tasto dopo l'audio
+        """
+        call = _PendingCall(str(call_id), wake_audio, snooze_5_audio or '', snooze_10_audio or '', digit_timeout)
+        with self._lock:
+            self._calls[call.call_id] = call
+        return call
+
+    def wait_call_result(self, call_id, max_wait):
+        """
+        Attende l'esito di una chiamata registrata
+
+        Returns:
+            '1', '2', 'H' (hangup senza tasto), NO_ANSWER (chiamata non
+            risposta) o None se scade il timeout
+        """
+        with self._lock:
+            call = self._calls.get(str(call_id))
+        if call is None:
+            return None
+        try:
+            call.done.wait(max_wait)
+            return call.result
+        finally:
+            self.forget_call(call_id)
+
+    def forget_call(self, call_id):
+        """Dimentica una chiamata (una connessione AGI successiva viene chiusa)"""
+        with self._lock:
+            self._calls.pop(str(call_id), None)
+
+    def _accept_loop(self):
+        sock = self._sock
+        try:
+            while self.running:
+                try:
+                    client, address = sock.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self._serve, args=(client,), name="fastagi-call", daemon=True).start()
+        finally:
+            sock.close()
+
+    def _serve(self, client):
+        call = None
+        try:
+            agi = _AGIChannel(client)
+            env = agi.read_environment()
+            call_id = env.get('agi_arg_1') or env.get('agi_extension', '')
+            with self._lock:
+                call = self._calls.get(call_id)
+
+            if env.get('agi_network_script') == 'wakeup-failed':
+                # Extension failed del dialplan: la chiamata non è stata risposta
+                if call is not None:
+                    self.logger.info(f"Chiamata {call_id} non risposta")
+                    call.finish(NO_ANSWER)
+                return
+
+            if call is None:
+                self.logger.warning(f"Chiamata AGI sconosciuta: {call_id} ({env.get('agi_channel', '')})")
+                agi.execute("HANGUP")
+                return
+
+            self.logger.info(f"Chiamata AGI {call_id} su {env.get('agi_channel', '')}")
+            self._run_wakeup(agi, call)
+
+        except AGIHangup:
+            pass
+        except Exception as e:
+            self.logger.error(f"Errore sessione AGI: {e}")
+        finally:
+            # Chiusura senza tasto (hangup, timeout, tasto non valido)
+            if call is not None:
+                call.finish('H')
+            try:
+                client.close()
+            except OSError:
+                pass
+
+    def _run_wakeup(self, agi, call):
+        """Stessa sequenza del context wakeup-service, eseguita da qui"""
+        digit = agi.digit(agi.execute(f'STREAM FILE {call.wake_audio} "12"'))
+        if digit is None:
+            digit = agi.digit(agi.execute(f"WAIT FOR DIGIT {int(call.digit_timeout * 1000)}"))
+
+        if digit not in ('1', '2'):
+            self.logger.info(f"Chiamata {call.call_id}: nessun tasto valido")
+            agi.execute("HANGUP")
+            return
+
+        # Esito consegnato subito, la conferma viene riprodotta dopo
+        call.finish(digit)
+        confirmation = call.snooze_5_audio if digit == '1' else call.snooze_10_audio
+        if confirmation:
+            agi.execute(f'STREAM FILE {confirmation} ""')
+        agi.execute(f"WAIT FOR DIGIT {DIGIT_PAUSE_MS}")
+        agi.execute("HANGUP")
+
+
+_server = None
+_server_lock = threading.Lock()
+
+def get_fastagi_server(config):
+    """
+    Server FastAGI del processo, avviato alla prima richiesta
+
+    Args:
+        config: configurazione PBX (fastagi_listen, fastagi_port)
+    """
+    global _server
+    with _server_lock:
+        if _server is None or not _server.running:
+            _server = FastAGIServer(config.get('fastagi_listen', '0.0.0.0'),
+                                    config.get('fastagi_port', FASTAGI_DEFAULT_PORT))
+            _server.start()
+        return _server
+
+def stop_fastagi_server():
+    """Ferma il server FastAGI se avviato"""
+    global _server
+    with _server_lock:
+        server, _server = _server, None
+    if server is not None:
+        server.stop()
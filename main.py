@@ -16,6 +16,7 @@ from database import DatabaseManager
 from settings import SettingsWindow
 from pbx_connection import PBXConnection, PBXManager
 from alarm_manager import AlarmManager
+from archiver import AlarmArchiver
 from room_manager import RoomManagerWindow
 from audio_manager import AudioManagerWindow
 from log_viewer import LogViewerWindow
@@ -104,6 +105,10 @@ class SvegliaCentralinoApp:
         # Inizializza gestione PBX e sveglie
         self.pbx = PBXManager()
         self.alarm_manager = AlarmManager(self.db, self.pbx)
+        self.archiver = AlarmArchiver(self.db)
+        self.audio_catalog = self.alarm_manager.audio_catalog
+        self.room_cache = self.alarm_manager.room_cache
+        self.extension_status = self.alarm_manager.extension_status
         
         # Inizializza logger
         self.logger = get_logger('main')
@@ -127,6 +132,9 @@ class SvegliaCentralinoApp:
         self.alarm_manager.start()
         self.logger.info("Gestore sveglie avviato")
         
+        # Archiviazione delle sveglie concluse su un thread separato
+        self.archiver.start()
+        
         # Testa la connessione PBX all'avvio (usa impostazioni salvate)
         self.test_pbx_on_startup()
     
@@ -287,6 +295,8 @@ class SvegliaCentralinoApp:
                   command=self.set_alarm).grid(row=0, column=2, padx=(0, 10))
         ttk.Button(row2_frame, text="Test Audio", 
                   command=self.test_audio).grid(row=0, column=3)
+        ttk.Button(row2_frame, text="Sveglia di Gruppo", 
+                  command=self.open_group_alarm_dialog).grid(row=0, column=4, padx=(10, 0))
     
     def create_alarms_report_section(self, parent, row):
         """Crea la sezione report sveglie con possibilità di modifica"""
@@ -345,10 +355,12 @@ class SvegliaCentralinoApp:
     
     def manage_rooms(self):
         """Apre la gestione delle camere"""
-        RoomManagerWindow(self.root, self.db, self.on_rooms_updated)
+        RoomManagerWindow(self.root, self.db, on_save_callback=self.on_rooms_updated,
+                          room_cache=self.room_cache, extension_status=self.extension_status)
     
     def on_rooms_updated(self):
         """Callback quando le camere vengono aggiornate"""
+        # Piani di chiamata e cache camere seguono da soli la versione dei dati
         self.load_rooms()
         self.status_var.set("Lista camere aggiornata")
     
@@ -358,7 +370,7 @@ class SvegliaCentralinoApp:
     
     def on_audio_updated(self):
         """Callback quando i messaggi audio vengono aggiornati"""
-        # I messaggi audio vengono caricati automaticamente quando serve
+        # Catalogo audio e piani di chiamata si aggiornano da soli (versione dati del database)
         self.status_var.set("Lista messaggi audio aggiornata")
     
     def view_logs(self):
@@ -371,7 +383,7 @@ class SvegliaCentralinoApp:
     
     def open_backup_manager(self):
         """Apre il gestore di backup"""
-        BackupManagerWindow(self.root, self.db)
+        BackupManagerWindow(self.root, self.db, services=[self.alarm_manager, self.archiver])
     
     def show_about(self):
         """Mostra informazioni sull'applicazione"""
@@ -435,7 +447,7 @@ Email: alcodestudio2025@gmail.com"""
         main_frame.pack(fill=tk.BOTH, expand=True)
         
         # Titolo
-        ttk.Label(main_frame, text=f"Modifica Sveglia - Camera {alarm[1]}", 
+        ttk.Label(main_frame, text=f"Modifica Sveglia - Camera {alarm.room_number}", 
                  font=("Arial", 12, "bold")).pack(pady=(0, 20))
         
         # Form di modifica
@@ -446,7 +458,7 @@ Email: alcodestudio2025@gmail.com"""
         ttk.Label(form_frame, text="Data:").grid(row=0, column=0, sticky=tk.W, pady=5)
         date_entry = ttk.Entry(form_frame, width=15)
         date_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
-        alarm_time = datetime.datetime.fromisoformat(alarm[2])
+        alarm_time = alarm.alarm_time
         date_entry.insert(0, alarm_time.strftime("%Y-%m-%d"))
         
         # Ora
@@ -460,12 +472,10 @@ Email: alcodestudio2025@gmail.com"""
         language_var = tk.StringVar(value="it")
         
         # Trova lingua dell'audio corrente
-        if alarm[3]:  # Se c'è un audio_message_id
-            audio_messages = self.db.get_audio_messages()
-            for msg in audio_messages:
-                if msg[0] == alarm[3]:
-                    language_var.set(msg[5] if len(msg) > 5 else "it")
-                    break
+        if alarm.audio_message_id:
+            msg = self.audio_catalog.get(alarm.audio_message_id)
+            if msg:
+                language_var.set(msg.language or "it")
         
         language_combo = ttk.Combobox(form_frame, textvariable=language_var, 
                                      values=["it", "en", "fr", "de", "es"],
@@ -493,18 +503,11 @@ Email: alcodestudio2025@gmail.com"""
                     return
                 
                 # Trova audio message per la lingua selezionata
-                audio_id = None
-                messages = self.db.get_audio_messages()
-                for msg in messages:
-                    msg_language = msg[5] if len(msg) > 5 else 'it'
-                    msg_action = msg[6] if len(msg) > 6 else None
-                    
-                    if msg_language.lower() == language.lower() and msg_action == 'wake_up':
-                        audio_id = msg[0]
-                        break
+                msg = self.audio_catalog.find('wake_up', language)
+                audio_id = msg.id if msg else None
                 
                 # Aggiorna la sveglia
-                success = self.db.update_alarm(alarm_id, new_alarm_time.isoformat(), audio_id)
+                success = self.alarm_manager.update_alarm(alarm_id, new_alarm_time, audio_id)
                 
                 if success:
                     messagebox.showinfo("Successo", "Sveglia modificata con successo")
@@ -709,8 +712,8 @@ Email: alcodestudio2025@gmail.com"""
     
     def load_rooms(self):
         """Carica le camere disponibili"""
-        rooms = self.db.get_rooms('available')
-        room_numbers = [room[1] for room in rooms]
+        rooms = self.room_cache.get_all('available')
+        room_numbers = [room.room_number for room in rooms]
         self.room_combo['values'] = room_numbers
         if room_numbers:
             self.room_combo.set(room_numbers[0])
@@ -721,31 +724,29 @@ Email: alcodestudio2025@gmail.com"""
         alarms = self.db.get_alarms()
         self.alarms_tree.delete(*self.alarms_tree.get_children())
         
-        # Carica TUTTI gli audio UNA SOLA VOLTA prima del loop (performance)
-        audio_messages = self.db.get_audio_messages()
-        audio_dict = {msg[0]: msg[1] for msg in audio_messages}  # Crea dizionario ID -> Nome
+        # Nomi degli audio dal catalogo in memoria (nessuna query per riga)
+        audio_dict = self.audio_catalog.get_names()  # Dizionario ID -> Nome
         
         for alarm in alarms:
-            alarm_time = datetime.datetime.fromisoformat(alarm[2])
-            date_str = alarm_time.strftime("%Y-%m-%d")
-            time_str = alarm_time.strftime("%H:%M")
+            date_str = alarm.alarm_time.strftime("%Y-%m-%d")
+            time_str = alarm.alarm_time.strftime("%H:%M")
             
             # Ottieni nome messaggio audio dal dizionario (veloce!)
             audio_name = "Nessuno"
-            if alarm[3]:  # Se c'è un audio_message_id
-                audio_name = audio_dict.get(alarm[3], "Nessuno")
+            if alarm.audio_message_id:
+                audio_name = audio_dict.get(alarm.audio_message_id, "Nessuno")
             
             # Determina il colore in base allo status
-            status = alarm[4]
-            snooze_count = alarm[5] if len(alarm) > 5 else 0
+            status = alarm.status
+            snooze_count = alarm.snooze_count or 0
             
             # Determina il tipo: Originale o Rinvio
             tipo = "Originale" if snooze_count == 0 else f"Rinvio ({snooze_count})"
             
             # Inserisci nella lista con ID visibile
             item_id = self.alarms_tree.insert("", "end", values=(
-                alarm[0],  # ID
-                alarm[1],  # Camera
+                alarm.id,  # ID
+                alarm.room_number,  # Camera
                 date_str,  # Data
                 time_str,  # Ora
                 audio_name,  # Messaggio
@@ -794,24 +795,18 @@ Email: alcodestudio2025@gmail.com"""
             
             # Cerca messaggio audio "wake_up" nella lingua selezionata
             audio_id = None
-            messages = self.db.get_audio_messages()
-            for msg in messages:
-                # msg = (id, name, file_path, duration, category, language, action_type, created_at)
-                msg_language = msg[5] if len(msg) > 5 else 'it'
-                msg_action = msg[6] if len(msg) > 6 else None
-                
-                if msg_language.lower() == language.lower() and msg_action == 'wake_up':
-                    audio_id = msg[0]
-                    self.logger.info(f"Audio wake_up trovato: {msg[1]} (ID: {audio_id}, Lingua: {language})")
-                    break
+            msg = self.audio_catalog.find('wake_up', language)
+            if msg:
+                audio_id = msg.id
+                self.logger.info(f"Audio wake_up trovato: {msg.name} (ID: {audio_id}, Lingua: {language})")
             
             if not audio_id:
                 messagebox.showwarning("Attenzione", 
                                      f"Nessun messaggio sveglia trovato per la lingua '{language.upper()}'.\n"
                                      f"Sveglia creata senza audio.")
             
-            # Aggiungi sveglia al database
-            alarm_id = self.db.add_alarm(room, alarm_datetime.isoformat(), audio_id)
+            # Aggiungi sveglia al database e allo scheduler
+            alarm_id = self.alarm_manager.add_alarm(room, alarm_datetime, audio_id)
             
             lang_info = f" ({language.upper()})" if audio_id else " (senza audio)"
             messagebox.showinfo("Successo", f"Sveglia impostata per camera {room} alle {time_str}{lang_info}")
@@ -823,20 +818,122 @@ Email: alcodestudio2025@gmail.com"""
         except Exception as e:
             messagebox.showerror("Errore", f"Errore nell'impostazione della sveglia: {e}")
     
+    @staticmethod
+    def _parse_room_list(text):
+        """Camere da testo libero: "101, 102, 110-130" -> ['101', '102', '110', ..., '130']"""
+        rooms = []
+        for token in text.replace(';', ',').split(','):
+            token = token.strip()
+            if not token:
+                continue
+            first, sep, last = token.partition('-')
+            if sep and first.strip().isdigit() and last.strip().isdigit():
+                rooms.extend(str(number) for number in range(int(first), int(last) + 1))
+            else:
+                rooms.append(token)
+        return rooms
+    
+    def open_group_alarm_dialog(self):
+        """Apre la finestra per una sveglia di gruppo (stessa ora per più camere)"""
+        group_window = tk.Toplevel(self.root)
+        group_window.title("Sveglia di Gruppo")
+        group_window.geometry("450x320")
+        group_window.resizable(False, False)
+        
+        # Centra la finestra
+        group_window.transient(self.root)
+        group_window.grab_set()
+        
+        # Frame principale
+        main_frame = ttk.Frame(group_window, padding="20")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Titolo
+        ttk.Label(main_frame, text="Sveglia di Gruppo", 
+                 font=("Arial", 12, "bold")).pack(pady=(0, 20))
+        
+        # Form
+        form_frame = ttk.Frame(main_frame)
+        form_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Camere (elenco e intervalli)
+        ttk.Label(form_frame, text="Camere (es. 101, 105-120):").grid(row=0, column=0, sticky=tk.W, pady=5)
+        rooms_entry = ttk.Entry(form_frame, width=25)
+        rooms_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        
+        # Etichetta camere (gruppo / tour operator)
+        ttk.Label(form_frame, text="Etichetta:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        labels = self.room_cache.get_labels()
+        label_var = tk.StringVar()
+        ttk.Combobox(form_frame, textvariable=label_var, values=[""] + labels,
+                    state="readonly", width=22).grid(row=1, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        
+        # Data
+        ttk.Label(form_frame, text="Data:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        date_entry = ttk.Entry(form_frame, width=15)
+        date_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        date_entry.insert(0, self.date_entry.get())
+        
+        # Ora
+        ttk.Label(form_frame, text="Ora:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        time_entry = ttk.Entry(form_frame, width=15)
+        time_entry.grid(row=3, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        time_entry.insert(0, self.time_entry.get())
+        
+        ttk.Label(form_frame, text="L'audio segue la lingua impostata per ogni camera",
+                 font=("Arial", 8)).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=(10, 0))
+        
+        form_frame.columnconfigure(1, weight=1)
+        
+        # Pulsanti
+        buttons_frame = ttk.Frame(main_frame)
+        buttons_frame.pack(fill=tk.X, pady=(20, 0))
+        
+        def apply_group_alarm():
+            try:
+                room_numbers = self._parse_room_list(rooms_entry.get())
+                label = label_var.get()
+                if not room_numbers and not label:
+                    messagebox.showerror("Errore", "Indica le camere o un'etichetta", parent=group_window)
+                    return
+                
+                alarm_datetime = datetime.datetime.strptime(
+                    f"{date_entry.get()} {time_entry.get()}", "%Y-%m-%d %H:%M")
+                if alarm_datetime <= datetime.datetime.now():
+                    messagebox.showerror("Errore", "La sveglia deve essere programmata nel futuro", parent=group_window)
+                    return
+                
+                created = self.alarm_manager.add_group_alarms(
+                    alarm_datetime, room_numbers=room_numbers or None, label=label or None)
+                if not created:
+                    messagebox.showwarning("Attenzione", "Nessuna camera corrisponde alla selezione", parent=group_window)
+                    return
+                
+                without_audio = [room for _, room, audio_id in created if not audio_id]
+                message = f"Sveglia impostata alle {alarm_datetime.strftime('%H:%M')} per {len(created)} camere"
+                if without_audio:
+                    message += f"\n\nSenza audio nella lingua della camera: {', '.join(without_audio)}"
+                messagebox.showinfo("Successo", message)
+                
+                # Un solo aggiornamento della lista
+                self.load_alarms()
+                self.status_var.set(f"Sveglia di gruppo: {len(created)} camere - {alarm_datetime.strftime('%d/%m/%Y %H:%M')}")
+                group_window.destroy()
+                
+            except ValueError as e:
+                messagebox.showerror("Errore", f"Formato data/ora non valido: {e}", parent=group_window)
+            except Exception as e:
+                messagebox.showerror("Errore", f"Errore nell'impostazione della sveglia di gruppo: {e}", parent=group_window)
+        
+        ttk.Button(buttons_frame, text="Imposta", command=apply_group_alarm).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(buttons_frame, text="Annulla", command=group_window.destroy).pack(side=tk.RIGHT)
+    
     def test_audio(self):
         """Testa la riproduzione del messaggio audio nella lingua selezionata"""
         language = self.selected_language.get()
         
         # Cerca messaggio audio "wake_up" nella lingua selezionata
-        messages = self.db.get_audio_messages()
-        audio = None
-        for msg in messages:
-            msg_language = msg[5] if len(msg) > 5 else 'it'
-            msg_action = msg[6] if len(msg) > 6 else None
-            
-            if msg_language.lower() == language.lower() and msg_action == 'wake_up':
-                audio = msg
-                break
+        audio = self.audio_catalog.find('wake_up', language)
         
         if not audio:
             messagebox.showerror("Errore", 
@@ -846,8 +943,8 @@ Email: alcodestudio2025@gmail.com"""
                                f"- Lingua: {language.upper()}")
             return
         
-        audio_name = audio[1]
-        audio_path = audio[2]  # file_path
+        audio_name = audio.name
+        audio_path = audio.file_path
         
         if not os.path.exists(audio_path):
             messagebox.showerror("Errore", f"File audio non trovato:\n{audio_path}")
@@ -883,8 +980,11 @@ Email: alcodestudio2025@gmail.com"""
         
         if messagebox.askyesno("Conferma", f"Eliminare la sveglia per camera {room} del {date} alle {time}?"):
             try:
-                # Aggiorna status a cancelled nel database
-                self.db.update_alarm_status(alarm_id, "cancelled")
+                # Aggiorna status a cancelled e rimuove la sveglia dallo scheduler
+                success, message = self.alarm_manager.cancel_alarm(alarm_id)
+                if not success:
+                    messagebox.showerror("Errore", f"Errore nell'eliminazione: {message}")
+                    return
                 messagebox.showinfo("Successo", "Sveglia eliminata correttamente")
                 self.load_alarms()
                 self.status_var.set(f"Sveglia eliminata: Camera {room}")
@@ -961,6 +1061,25 @@ def main():
             except Exception as e:
                 app.logger.warning(f"Errore stop alarm manager: {e}")
             
+            # Ferma l'archiviazione
+            try:
+                app.archiver.stop()
+            except Exception as e:
+                app.logger.warning(f"Errore stop archiviazione: {e}")
+            
+            # Chiudi le sessioni SSH persistenti verso il PBX
+            try:
+                from pbx_connection import close_all_sessions
+                close_all_sessions()
+            except Exception as e:
+                app.logger.warning(f"Errore chiusura sessioni PBX: {e}")
+            
+            # Chiude le connessioni al database (checkpoint del WAL)
+            try:
+                app.db.close_all_connections()
+            except Exception as e:
+                app.logger.warning(f"Errore chiusura database: {e}")
+            
             # Chiudi finestra immediatamente
             app.logger.info("Applicazione chiusa")
             root.quit()  # quit() invece di destroy() per uscita più veloce
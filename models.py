@@ -0,0 +1,91 @@
+"""
+Record leggeri restituiti dal DatabaseManager
+"""
+from datetime import datetime
+
+
+class Record:
+    """
+    Riga di una tabella con attributi per nome.
+
+    I record sono costruiti da una row factory che associa le colonne per
+    nome, quindi non dipendono dall'ordine fisico delle colonne (che cambia
+    con le ALTER TABLE delle migrazioni). L'accesso per indice (record[2])
+    resta disponibile per gli script esistenti e segue l'ordine delle
+    colonne in CREATE TABLE, cioè quello di __slots__.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def row_factory(cls, description):
+        """
+        Row factory per un cursore già eseguito
+
+        Args:
+            description: cursor.description della query
+
+        Returns:
+            funzione (cursor, row) -> record; le colonne mancanti valgono None
+        """
+        names = [column[0] for column in description]
+        positions = [names.index(name) if name in names else None for name in cls.__slots__]
+
+        def factory(cursor, row):
+            return cls(*[row[position] if position is not None else None for position in positions])
+        return factory
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, self.__slots__[index])
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Room(Record):
+    __slots__ = ('id', 'room_number', 'phone_extension', 'description', 'status',
+                 'color', 'label', 'language', 'created_at')
+
+
+class AudioMessage(Record):
+    __slots__ = ('id', 'name', 'file_path', 'duration', 'category',
+                 'language', 'action_type', 'created_at')
+
+
+class Alarm(Record):
+    """
+    Sveglia: alarm_time è già un datetime, alarm_epoch lo stesso orario in
+    secondi epoch, fired_epoch l'inizio della prima chiamata (None se mai partita)
+    """
+
+    __slots__ = ('id', 'room_number', 'alarm_time', 'audio_message_id', 'status',
+                 'snooze_count', 'created_at', 'alarm_epoch', 'fired_epoch')
+
+    def __init__(self, *values):
+        super().__init__(*values)
+        if isinstance(self.alarm_time, str):
+            self.alarm_time = datetime.fromisoformat(self.alarm_time)
+
+
+class CallLog(Record):
+    __slots__ = ('id', 'alarm_id', 'room_number', 'call_time', 'response',
+                 'snooze_minutes', 'status')
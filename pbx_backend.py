@@ -0,0 +1,271 @@
+"""
+Backend di controllo chiamate del centralino PBX
+"""
+import itertools
+import secrets
+import shlex
+from logger import get_logger
+
+RESULT_POLL_INTERVAL = 0.2  # secondi tra due controlli del file esito sul PBX
+
+ASTERISK_SPOOL_DIR = "/var/spool/asterisk"  # call file: scritti in tmp/, spostati in outgoing/
+
+BATCH_MARKER = "@@SVEGLIE-BATCH"  # righe di separazione tra gli output di un batch di comandi
+
+NO_ANSWER = 'NOANSWER'  # esito di una chiamata non risposta (nessuna risposta, occupato, irraggiungibile)
+
+_call_files = itertools.count(1)
+
+class PBXBackend:
+    """
+    Interfaccia comune dei backend che pilotano Asterisk: comandi CLI,
+    originate delle chiamate e attesa dell'esito (tasto DTMF o hangup).
+
+    PBXConnection delega a un backend tutte le operazioni sulle chiamate;
+    upload degli audio e configurazione del dialplan restano su SSH/SFTP.
+    """
+
+    name = None
+
+    def connect(self, force=False):
+        """Apre (o riaggancia) la sessione verso il PBX"""
+        raise NotImplementedError
+
+    def is_connected(self):
+        """Stato della sessione (nessun comando remoto)"""
+        raise NotImplementedError
+
+    def disconnect(self):
+        """Rilascia la sessione"""
+
+    def test(self):
+        """
+        Verifica che il backend risponda
+
+        Returns:
+            (success, message)
+        """
+        raise NotImplementedError
+
+    def command(self, cli_command):
+        """
+        Esegue un comando della CLI di Asterisk (es. 'core show channels')
+
+        Returns:
+            (output, error)
+        """
+        raise NotImplementedError
+
+    def command_batch(self, cli_commands):
+        """
+        Esegue più comandi CLI con un solo round-trip verso il PBX
+
+        Il default li esegue uno alla volta; i backend lo ridefiniscono.
+
+        Returns:
+            lista di (output, error), nello stesso ordine dei comandi
+        """
+        return [self.command(cli_command) for cli_command in cli_commands]
+
+    def originate(self, channel, context, exten, callerid, call_id=None, timeout=None, variables=None):
+        """
+        Avvia una chiamata verso channel che, alla risposta, entra in exten@context
+
+        Args:
+            call_id: ID della chiamata di cui si attenderà l'esito con wait_call_result
+            timeout: secondi di squillo massimi (se supportato dal backend)
+            variables: dict di variabili di canale da impostare sulla chiamata
+
+        Returns:
+            (success, message)
+        """
+        raise NotImplementedError
+
+    def wait_call_result(self, call_id, max_wait):
+        """
+        Attende l'esito di una chiamata wakeup-service avviata con originate
+
+        Returns:
+            '1', '2', 'H' (hangup senza tasto), NO_ANSWER (chiamata non
+            risposta) o None se scade il timeout
+        """
+        raise NotImplementedError
+
+
+class SSHBackend(PBXBackend):
+    """
+    Backend storico: ogni operazione è un 'asterisk -rx' eseguito via SSH
+    sul trasporto condiviso della PBXConnection; l'esito delle chiamate
+    arriva dal file scritto dal dialplan e controllato sul PBX.
+
+    'channel originate' non imposta variabili di canale: le chiamate con
+    variabili sono avviate con un call file (un solo comando remoto).
+    """
+
+    name = 'ssh'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.logger = get_logger('pbx_connection')
+
+    def connect(self, force=False):
+        return self.connection.connect(force=force)
+
+    def is_connected(self):
+        return self.connection.is_connected()
+
+    def test(self):
+        output, error = self.connection.execute_command("echo 'PBX Connection Test'")
+        if error:
+            return False, f"Errore nel test: {error}"
+        return True, "Connessione SSH attiva"
+
+    def command(self, cli_command):
+        return self.connection.execute_command(f"asterisk -rx {shlex.quote(cli_command)}")
+
+    def command_batch(self, cli_commands):
+        """
+        Tutti i comandi in un unico script sullo stesso canale SSH, con gli
+        output separati da righe marcatore (token casuale per batch, non può
+        comparire nell'output dei comandi). Ogni batch usa un proprio canale
+        sul trasporto condiviso: più thread possono eseguirne in parallelo.
+        """
+        if not cli_commands:
+            return []
+        if len(cli_commands) == 1:
+            return [self.command(cli_commands[0])]
+
+        token = secrets.token_hex(8)
+        steps = [
+            f"echo '{BATCH_MARKER} {token} {index}'; "
+            f"asterisk -rx {shlex.quote(cli_command)} 2>&1; rc=$?; echo; "
+            f"echo \"{BATCH_MARKER} {token} {index} $rc\""
+            for index, cli_command in enumerate(cli_commands)
+        ]
+        output, error = self.connection.execute_command('; '.join(steps) + '; exit 0')
+        if error or output is None:
+            return [(None, error or "Nessun output")] * len(cli_commands)
+        return split_batch_output(output, token, len(cli_commands))
+
+    def originate(self, channel, context, exten, callerid, call_id=None, timeout=None, variables=None):
+        if call_id is not None:
+            # Il dialplan scrive il file esito solo per chi lo controlla; WAKE_CALL_ID
+            # serve all'extension 'failed', eseguita se la chiamata non viene risposta
+            variables = dict(variables or {}, WAKE_RESULT_FILE='1', WAKE_CALL_ID=call_id)
+        if variables:
+            return self._originate_call_file(channel, context, exten, callerid, timeout, variables)
+
+        # 'channel originate' non ha timeout di squillo: vale quello del dialplan
+        command = (
+            f"asterisk -rx \"channel originate {channel} "
+            f"extension {exten}@{context} "
+            f"callerid '{callerid}'\" "
+        )
+        self.logger.debug(f"Comando: {command}")
+        output, error = self.connection.execute_command(command)
+        if error:
+            return False, error
+        if output and "error" in output.lower():
+            return False, output.strip()
+        return True, "Chiamata avviata"
+
+    def _originate_call_file(self, channel, context, exten, callerid, timeout, variables):
+        """
+        Originate tramite call file: scritto in tmp/ e spostato in outgoing/
+        (stesso filesystem, Asterisk non lo legge mai a metà)
+        """
+        lines = [
+            f"Channel: {channel}",
+            f"CallerID: {callerid}",
+            f"Context: {context}",
+            f"Extension: {exten}",
+            "Priority: 1",
+            "MaxRetries: 0",
+        ]
+        if timeout:
+            lines.append(f"WaitTime: {int(timeout)}")
+        lines += [f"Setvar: {name}={value}" for name, value in variables.items()]
+
+        tmp_path = f"{ASTERISK_SPOOL_DIR}/tmp/sveglia_{exten}_{next(_call_files)}.call"
+        command = (
+            f"mkdir -p {ASTERISK_SPOOL_DIR}/tmp && "
+            f"printf '%s\\n' {' '.join(shlex.quote(line) for line in lines)} > {tmp_path} && "
+            f"mv {tmp_path} {ASTERISK_SPOOL_DIR}/outgoing/"
+        )
+        self.logger.debug(f"Comando: {command}")
+        output, error = self.connection.execute_command(command)
+        if error:
+            return False, error
+        return True, "Chiamata accodata"
+
+    def wait_call_result(self, call_id, max_wait):
+        """
+        Il dialplan scrive /tmp/asterisk_dtmf_<CALL_ID>.txt alla pressione di un
+        tasto, all'hangup o (extension 'failed') se la chiamata non viene
+        risposta. Un solo comando remoto controlla il file ogni
+        RESULT_POLL_INTERVAL secondi (stat locale sul PBX, nessun round-trip)
+        e ritorna appena compare, quindi chiamate contemporanee non leggono
+        mai l'esito di un'altra.
+        """
+        result_file = f"/tmp/asterisk_dtmf_{call_id}.txt"
+        polls = max(1, int(max_wait / RESULT_POLL_INTERVAL))
+        command = (
+            f"f={result_file}; i=0; "
+            f"while [ $i -lt {polls} ]; do "
+            f"if [ -s $f ]; then cat $f; rm -f $f; exit 0; fi; "
+            f"sleep {RESULT_POLL_INTERVAL}; i=$((i+1)); "
+            f"done; exit 0"
+        )
+
+        output, error = self.connection.execute_command(command)
+        if error or not output:
+            return None
+        return output.strip() or None
+
+
+def split_batch_output(output, token, count):
+    """
+    Separa l'output di un batch SSH nei risultati dei singoli comandi
+
+    Returns:
+        lista di (output, error); (None, error) per i comandi falliti o mancanti
+    """
+    results = [(None, "Output mancante")] * count
+    prefix = f"{BATCH_MARKER} {token} "
+    current = None
+    lines = []
+    for line in output.split('\n'):
+        if not line.startswith(prefix):
+            if current is not None:
+                lines.append(line)
+            continue
+
+        fields = line[len(prefix):].split()
+        if len(fields) == 1:
+            current = int(fields[0])
+            lines = []
+        elif current is not None:
+            # Riga vuota aggiunta dall'echo prima del marcatore di chiusura
+            if lines and lines[-1] == '':
+                lines.pop()
+            text = '\n'.join(lines) + '\n' if lines else ''
+            results[current] = (text, None) if fields[1] == '0' else (None, text.strip() or f"Uscita {fields[1]}")
+            current = None
+    return results
+
+
+def create_backend(connection, config):
+    """
+    Backend scelto da PBX_CONFIG['backend'] ('ssh' o 'ami')
+
+    Args:
+        connection: PBXConnection che usa il backend (trasporto SSH)
+        config: configurazione PBX
+    """
+    backend = config.get('backend', 'ssh')
+    if backend == 'ami':
+        from ami_backend import AMIBackend
+        return AMIBackend(config)
+    if backend != 'ssh':
+        connection.logger.warning(f"Backend PBX '{backend}' sconosciuto, uso SSH")
+    return SSHBackend(connection)
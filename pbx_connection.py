@@ -3,40 +3,178 @@ Gestione connessione SSH al centralino PBX
 """
 import paramiko
 import time
+import itertools
+import threading
 import logging
 import os
 from datetime import datetime
 from config import PBX_CONFIG
+from audio_upload_cache import get_upload_cache
+from pbx_backend import create_backend, NO_ANSWER
 from logger import get_logger
 
+# ID chiamata univoci nel processo (numerici per il pattern _X. del dialplan):
+# contatore che parte dal timestamp in millisecondi, quindi non si ripete
+# nemmeno tra un riavvio e l'altro
+_call_ids = itertools.count(int(time.time() * 1000))
+
+ASTERISK_SOUNDS_DIR = "/var/lib/asterisk/sounds/custom"  # directory audio custom di Asterisk
+
+PEER_COMMANDS = ['sip show peers', 'pjsip show endpoints']  # elenco interni configurati (get_sip_peers)
+
+class _SharedSSHSession:
+    """
+    Trasporto SSH persistente condiviso da tutte le PBXConnection verso lo
+    stesso PBX (stesso host, porta e credenziali).
+    
+    Ogni comando apre un proprio canale sul trasporto: più thread possono
+    eseguire comandi in parallelo senza nuovi handshake. Il keepalive tiene
+    vivo il trasporto; dopo un errore di connessione i tentativi successivi
+    sono distanziati con backoff esponenziale per evitare raffiche di
+    riconnessioni.
+    """
+    
+    MAX_BACKOFF = 60  # secondi
+    
+    def __init__(self, config):
+        self.config = config
+        self.client = None
+        self.last_connection_time = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._next_attempt_ts = 0
+        self.logger = get_logger('pbx_connection')
+    
+    def is_active(self):
+        """Stato del trasporto (nessun comando remoto)"""
+        client = self.client
+        if not client:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+    
+    def get_client(self, force=False):
+        """
+        Restituisce il client SSH, riconnettendo se il trasporto è caduto
+        
+        Args:
+            force: ignora il backoff (es. test manuale della connessione)
+            
+        Raises:
+            paramiko.SSHException / Exception se la connessione fallisce
+        """
+        if self.is_active():
+            return self.client
+        
+        with self._lock:
+            # Un altro thread potrebbe aver già riconnesso
+            if self.is_active():
+                return self.client
+            
+            now = time.time()
+            if not force and now < self._next_attempt_ts:
+                raise paramiko.SSHException(
+                    f"Riconnessione in backoff per altri {self._next_attempt_ts - now:.0f}s")
+            
+            if self.client:
+                self.client.close()
+                self.client = None
+            
+            try:
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(
+                    hostname=self.config['host'],
+                    port=self.config['port'],
+                    username=self.config['username'],
+                    password=self.config['password'],
+                    timeout=self.config['timeout']
+                )
+                client.get_transport().set_keepalive(self.config.get('keepalive_interval', 30))
+            except Exception:
+                self._failures += 1
+                self._next_attempt_ts = time.time() + min(self.MAX_BACKOFF, 2 ** self._failures)
+                raise
+            
+            self.client = client
+            self._failures = 0
+            self._next_attempt_ts = 0
+            self.last_connection_time = datetime.now()
+            self.logger.info(f"Connessione SSH stabilita con {self.config['host']}")
+            return client
+    
+    def close(self):
+        """Chiude il trasporto"""
+        with self._lock:
+            if self.client:
+                self.client.close()
+                self.client = None
+                self.logger.info("Connessione SSH chiusa")
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _get_shared_session(config):
+    """Sessione SSH condivisa per la configurazione indicata"""
+    key = (config['host'], config['port'], config['username'], config['password'])
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _SharedSSHSession(dict(config))
+            _sessions[key] = session
+        return session
+
+def close_all_sessions():
+    """Chiude tutti i trasporti SSH e le sessioni AMI condivise (alla chiusura dell'applicazione)"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+    
+    import ami_backend
+    ami_backend.close_all_sessions()
+
+
 class PBXConnection:
     def __init__(self, config=None):
         self.config = config or PBX_CONFIG
         self.ssh_client = None
         self.connected = False
         self.last_connection_time = None
+        self._session = None
+        self._backend = None
+        self._backend_config = None
         
         # Setup logging
         self.logger = get_logger('pbx_connection')
     
-    def connect(self):
-        """Stabilisce la connessione SSH al centralino PBX"""
+    @property
+    def backend(self):
+        """
+        Backend di controllo chiamate (PBX_CONFIG['backend']: 'ssh' o 'ami')
+        
+        Ricreato se la configurazione viene sostituita (es. test dalle impostazioni)
+        """
+        if self._backend is None or self._backend_config is not self.config:
+            self._backend = create_backend(self, self.config)
+            self._backend_config = self.config
+        return self._backend
+    
+    def connect(self, force=False):
+        """
+        Aggancia la sessione SSH persistente verso il centralino PBX
+        
+        Args:
+            force: tenta la connessione anche durante il backoff dopo un errore
+        """
         try:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            # Connessione SSH
-            self.ssh_client.connect(
-                hostname=self.config['host'],
-                port=self.config['port'],
-                username=self.config['username'],
-                password=self.config['password'],
-                timeout=self.config['timeout']
-            )
+            self._session = _get_shared_session(self.config)
+            self.ssh_client = self._session.get_client(force=force)
             
             self.connected = True
-            self.last_connection_time = datetime.now()
-            self.logger.info(f"Connessione SSH stabilita con {self.config['host']}")
+            self.last_connection_time = self._session.last_connection_time
             return True
             
         except paramiko.AuthenticationException:
@@ -50,51 +188,69 @@ class PBXConnection:
             return False
     
     def disconnect(self):
-        """Chiude la connessione SSH"""
-        if self.ssh_client:
-            self.ssh_client.close()
-            self.connected = False
-            self.logger.info("Connessione SSH chiusa")
+        """Rilascia la sessione SSH (il trasporto condiviso resta aperto per gli altri utenti)"""
+        self.ssh_client = None
+        self.connected = False
     
     def is_connected(self):
-        """Verifica se la connessione è attiva"""
+        """Verifica se la connessione è attiva dallo stato del trasporto (senza comandi remoti)"""
         if not self.connected or not self.ssh_client:
             return False
         
-        try:
-            # Testa la connessione con un comando semplice
-            stdin, stdout, stderr = self.ssh_client.exec_command("echo 'test'")
-            return stdout.channel.recv_exit_status() == 0
-        except:
+        transport = self.ssh_client.get_transport()
+        if transport is None or not transport.is_active():
             self.connected = False
             return False
+        return True
     
     def execute_command(self, command):
-        """Esegue un comando sul centralino PBX"""
-        if not self.is_connected():
-            if not self.connect():
-                return None, "Errore di connessione"
-        
-        try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(command)
-            
-            # Legge l'output
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            
-            # Verifica il codice di uscita
-            exit_code = stdout.channel.recv_exit_status()
+        """Esegue un comando sul centralino PBX (un canale sul trasporto condiviso)"""
+        for attempt in range(2):
+            if not self.is_connected():
+                if not self.connect():
+                    return None, "Errore di connessione"
             
-            if exit_code == 0:
-                self.logger.info(f"Comando eseguito: {command}")
-                return output, None
-            else:
-                self.logger.error(f"Errore comando: {error}")
-                return None, error
+            try:
+                stdin, stdout, stderr = self.ssh_client.exec_command(command)
                 
-        except Exception as e:
-            self.logger.error(f"Errore nell'esecuzione del comando: {e}")
-            return None, str(e)
+                # Legge l'output
+                output = stdout.read().decode('utf-8')
+                error = stderr.read().decode('utf-8')
+                
+                # Verifica il codice di uscita
+                exit_code = stdout.channel.recv_exit_status()
+                
+                if exit_code == 0:
+                    self.logger.info(f"Comando eseguito: {command}")
+                    return output, None
+                else:
+                    self.logger.error(f"Errore comando: {error}")
+                    return None, error
+                    
+            except paramiko.SSHException as e:
+                # Trasporto caduto tra il controllo e l'apertura del canale: riprova una volta
+                self.connected = False
+                if attempt == 0:
+                    self.logger.warning(f"Canale SSH non disponibile, riconnessione: {e}")
+                    continue
+                self.logger.error(f"Errore nell'esecuzione del comando: {e}")
+                return None, str(e)
+            except Exception as e:
+                self.logger.error(f"Errore nell'esecuzione del comando: {e}")
+                return None, str(e)
+    
+    def execute_cli_batch(self, cli_commands):
+        """
+        Esegue più comandi della CLI di Asterisk con un solo round-trip
+        (batch SSH o pipeline AMI, secondo il backend)
+        
+        Args:
+            cli_commands: lista di comandi CLI (es. ['core show uptime', ...])
+            
+        Returns:
+            lista di (output, error), nello stesso ordine dei comandi
+        """
+        return self.backend.command_batch(cli_commands)
     
     def make_call(self, phone_extension, audio_file_path=None):
         """Effettua una chiamata all'interno telefonico specificato con CallerID personalizzato"""
@@ -104,20 +260,14 @@ class PBXConnection:
             wake_callerid = self.config.get('wake_callerid', 'Servizio Sveglie')
             context = self.config.get('context', 'from-internal')
             
-            # Comando Asterisk con CallerID come variabile di canale
             # Usa syntax: Local/ext@context/n per no optimization
-            command = (
-                f"asterisk -rx 'channel originate Local/{phone_extension}@{context}/n "
-                f"exten {phone_extension}@{context} "
-                f"callerid \"{wake_callerid} <{wake_extension}>\"'"
-            )
-            
             self.logger.info(f"Chiamata a {phone_extension} come '{wake_callerid} <{wake_extension}>'")
-            self.logger.debug(f"Comando: {command}")
-            output, error = self.execute_command(command)
+            success, message = self.backend.originate(
+                f"Local/{phone_extension}@{context}/n", context, phone_extension,
+                f"{wake_callerid} <{wake_extension}>")
             
-            if error:
-                return False, f"Errore nella chiamata: {error}"
+            if not success:
+                return False, f"Errore nella chiamata: {message}"
             
             self.logger.info(f"Chiamata effettuata all'interno {phone_extension}")
             return True, "Chiamata effettuata con successo"
@@ -153,36 +303,30 @@ class PBXConnection:
             self.logger.info("Setup context wakeup-service nel dialplan...")
             
             # Context dedicato per sveglie con DTMF
-            # NOTA: L'audio viene passato come extension (wakeup-service/<nome_file>)
+            # NOTA: gli audio arrivano come variabili di canale impostate dall'originate
             context_config = """
 [wakeup-service]
 ; Context per gestione sveglie con DTMF
-; Chiamata: Local/130@from-internal extension <nome_file>@wakeup-service
-; Il CALL_ID identifica i file temporanei con i path degli audio di conferma
+; Chiamata: Local/130@from-internal extension <call_id>@wakeup-service
+; Variabili di canale impostate dall'originate (nessun file temporaneo):
+;   WAKE_AUDIO        audio di sveglia (es. custom/wakeup_it)
+;   SNOOZE_5_AUDIO    audio di conferma snooze 5 minuti (opzionale)
+;   SNOOZE_10_AUDIO   audio di conferma snooze 10 minuti (opzionale)
+;   WAKE_RESULT_FILE  1 = scrivi l'esito in /tmp/asterisk_dtmf_CALLID.txt
+;                     (tasto premuto, H = hangup, NOANSWER = non risposta) per il backend SSH
+;   WAKE_CALL_ID      call_id, per l'extension failed (dove EXTEN non è il call_id)
 
-; Extension dinamica: SOLO call_id numerico (es: 1234)
-; Tutti i path audio sono in file: /tmp/w_CALLID.txt, /tmp/s5_CALLID.txt, /tmp/s10_CALLID.txt
-; Pattern _X. matcha stringhe numeriche
+; Extension dinamica: SOLO call_id numerico (es: 1234), pattern _X.
 exten => _X.,1,NoOp(=== SVEGLIA ID: ${EXTEN} ===)
 exten => _X.,n,Set(CALL_ID=${EXTEN})
-; Leggi i path dai file temporanei usando SHELL()
-exten => _X.,n,Set(AUDIO_EXTEN=${SHELL(cat /tmp/w_${CALL_ID}.txt 2>/dev/null)})
-exten => _X.,n,Set(__SNOOZE_5_AUDIO=${SHELL(cat /tmp/s5_${CALL_ID}.txt 2>/dev/null)})
-exten => _X.,n,Set(__SNOOZE_10_AUDIO=${SHELL(cat /tmp/s10_${CALL_ID}.txt 2>/dev/null)})
-exten => _X.,n,NoOp(Wake-up: ${AUDIO_EXTEN})
+exten => _X.,n,NoOp(Wake-up: ${WAKE_AUDIO})
 exten => _X.,n,NoOp(Snooze 5: ${SNOOZE_5_AUDIO})
 exten => _X.,n,NoOp(Snooze 10: ${SNOOZE_10_AUDIO})
 exten => _X.,n,Answer()
 exten => _X.,n,Wait(1)
 exten => _X.,n,Set(TIMEOUT(digit)=5)
 exten => _X.,n,Set(TIMEOUT(response)=30)
-; Riconverti SOLO il PRIMO "-" in "/" (custom-audio diventa custom/audio)
-; Usa CUT per dividere e ricomporre
-exten => _X.,n,Set(AUDIO_DIR=${CUT(AUDIO_EXTEN,-,1)})
-exten => _X.,n,Set(AUDIO_NAME=${CUT(AUDIO_EXTEN,-,2-)})
-exten => _X.,n,Set(AUDIO_FILE=${AUDIO_DIR}/${AUDIO_NAME})
-exten => _X.,n,NoOp(Playing: ${AUDIO_FILE})
-exten => _X.,n,Background(${AUDIO_FILE})
+exten => _X.,n,Background(${WAKE_AUDIO})
 exten => _X.,n,WaitExten(30)
 exten => _X.,n,NoOp(Nessun DTMF - hangup)
 exten => _X.,n,Hangup()
@@ -190,30 +334,24 @@ exten => _X.,n,Hangup()
 ; DTMF 1 - Snooze 5 minuti + Riproduce conferma
 exten => 1,1,NoOp(DTMF 1 ricevuto - Snooze 5 min)
 exten => 1,n,Set(SNOOZE_CHOICE=1)
-exten => 1,n,System(echo "1" > /tmp/asterisk_dtmf_${UNIQUEID}.txt)
-exten => 1,n,NoOp(File DTMF creato: /tmp/asterisk_dtmf_${UNIQUEID}.txt)
-; Usa variabile già estratta dall'extension
-exten => 1,n,NoOp(Audio conferma 5min: ${SNOOZE_5_AUDIO})
+exten => 1,n,ExecIf($["${WAKE_RESULT_FILE}" = "1"]?System(echo "1" > /tmp/asterisk_dtmf_${CALL_ID}.txt))
 exten => 1,n,GotoIf($["${SNOOZE_5_AUDIO}" = ""]?noadio)
 exten => 1,n,NoOp(Riproduzione conferma: ${SNOOZE_5_AUDIO})
 exten => 1,n,Playback(${SNOOZE_5_AUDIO})
 exten => 1,n,Goto(fine)
-exten => 1,n(noadio),NoOp(Nessun audio conferma trovato)
+exten => 1,n(noadio),NoOp(Nessun audio conferma)
 exten => 1,n(fine),Wait(0.5)
 exten => 1,n,Hangup()
 
 ; DTMF 2 - Snooze 10 minuti + Riproduce conferma
 exten => 2,1,NoOp(DTMF 2 ricevuto - Snooze 10 min)
 exten => 2,n,Set(SNOOZE_CHOICE=2)
-exten => 2,n,System(echo "2" > /tmp/asterisk_dtmf_${UNIQUEID}.txt)
-exten => 2,n,NoOp(File DTMF creato: /tmp/asterisk_dtmf_${UNIQUEID}.txt)
-; Usa variabile già estratta dall'extension
-exten => 2,n,NoOp(Audio conferma 10min: ${SNOOZE_10_AUDIO})
+exten => 2,n,ExecIf($["${WAKE_RESULT_FILE}" = "1"]?System(echo "2" > /tmp/asterisk_dtmf_${CALL_ID}.txt))
 exten => 2,n,GotoIf($["${SNOOZE_10_AUDIO}" = ""]?noadio)
 exten => 2,n,NoOp(Riproduzione conferma: ${SNOOZE_10_AUDIO})
 exten => 2,n,Playback(${SNOOZE_10_AUDIO})
 exten => 2,n,Goto(fine)
-exten => 2,n(noadio),NoOp(Nessun audio conferma trovato)
+exten => 2,n(noadio),NoOp(Nessun audio conferma)
 exten => 2,n(fine),Wait(0.5)
 exten => 2,n,Hangup()
 
@@ -223,6 +361,37 @@ exten => t,n,Hangup()
 
 exten => i,1,NoOp(Input invalido)
 exten => i,n,Hangup()
+
+; Hangup: segnala la fine chiamata se non c'è già un esito DTMF. Dopo un
+; tasto il file è già stato scritto (e forse già letto e rimosso dal backend):
+; riscriverlo lascerebbe un file orfano sul PBX
+exten => h,1,ExecIf($["${WAKE_RESULT_FILE}" = "1" & "${SNOOZE_CHOICE}" = ""]?System(test -s /tmp/asterisk_dtmf_${CALL_ID}.txt || echo "H" > /tmp/asterisk_dtmf_${CALL_ID}.txt))
+
+; Chiamata non risposta (nessuna risposta, occupato, interno irraggiungibile):
+; Asterisk esegue 'failed' nel context dell'originate, con le stesse variabili
+exten => failed,1,NoOp(Sveglia ${WAKE_CALL_ID} non risposta - motivo ${REASON})
+exten => failed,n,ExecIf($["${WAKE_RESULT_FILE}" = "1"]?System(echo "NOANSWER" > /tmp/asterisk_dtmf_${WAKE_CALL_ID}.txt))
+exten => failed,n,Hangup()
+"""
+            
+            # Variante FastAGI: prompt, tasto ed esito gestiti dall'applicazione
+            fastagi_host = self.config.get('fastagi_host', '')
+            if fastagi_host:
+                fastagi_port = self.config.get('fastagi_port', 4573)
+                context_config += f"""
+[wakeup-agi]
+; Context per sveglie gestite dal server FastAGI dell'applicazione
+; Chiamata: Local/130@from-internal extension <call_id>@wakeup-agi
+; Nessun file temporaneo e nessuna shell: audio ed esito passano via AGI
+exten => _X.,1,NoOp(=== SVEGLIA AGI ID: ${{EXTEN}} ===)
+exten => _X.,n,Answer()
+exten => _X.,n,Wait(1)
+exten => _X.,n,AGI(agi://{fastagi_host}:{fastagi_port}/wakeup,${{EXTEN}})
+exten => _X.,n,Hangup()
+
+; Chiamata non risposta: esito consegnato subito al server FastAGI
+exten => failed,1,AGI(agi://{fastagi_host}:{fastagi_port}/wakeup-failed,${{WAKE_CALL_ID}})
+exten => failed,n,Hangup()
 """
             
             # Path del file di configurazione custom
@@ -263,7 +432,8 @@ exten => i,n,Hangup()
     
     def upload_audio_to_asterisk(self, local_audio_path):
         """
-        Carica un file audio sul server Asterisk via SCP
+        Carica un file audio sul server Asterisk via SFTP, solo se il suo
+        contenuto non è già presente sul PBX (vedi AudioUploadCache)
         
         Args:
             local_audio_path: Path locale del file audio
@@ -272,46 +442,138 @@ exten => i,n,Hangup()
             (success, remote_path): Successo e path remoto
         """
         try:
-            import os
-            
-            # Directory standard di Asterisk per audio custom
-            remote_dir = "/var/lib/asterisk/sounds/custom/"
-            
-            # Nome file
-            audio_filename = os.path.basename(local_audio_path)
-            remote_path = os.path.join(remote_dir, audio_filename)
-            
-            self.logger.info(f"Upload audio {audio_filename} su Asterisk...")
-            
             # Verifica che il file locale esista
             if not os.path.exists(local_audio_path):
                 return False, f"File locale non trovato: {local_audio_path}"
             
-            # Crea directory custom se non esiste
-            mkdir_command = f"mkdir -p {remote_dir}"
-            self.execute_command(mkdir_command)
+            cache = get_upload_cache()
+            host = self.config['host']
+            sha256 = cache.content_hash(local_audio_path)
+            
+            # Caso comune: contenuto già caricato e verificato di recente
+            entry, needs_verify = cache.lookup(host, sha256)
+            if entry and not needs_verify:
+                return True, self._asterisk_audio_name(entry['remote_path'])
             
-            # Upload via SCP usando lo stesso client SSH
-            # NOTA: paramiko supporta SCP via sftp
             if not self.is_connected():
                 if not self.connect():
                     return False, "Impossibile connettersi al server"
             
-            # Usa SFTP per il trasferimento
             sftp = self.ssh_client.open_sftp()
-            sftp.put(local_audio_path, remote_path)
-            sftp.close()
-            
-            self.logger.info(f"✓ Audio caricato: {remote_path}")
+            try:
+                if entry:
+                    try:
+                        attrs = sftp.stat(entry['remote_path'])
+                        if cache.matches(entry, attrs.st_size, attrs.st_mtime):
+                            cache.mark_verified(host, sha256)
+                            return True, self._asterisk_audio_name(entry['remote_path'])
+                    except IOError:
+                        pass
+                    # File remoto cancellato o modificato: va ricaricato
+                    cache.forget(host, sha256)
+                
+                remote_path = self._remote_audio_path(local_audio_path, sha256)
+                self._put_audio(sftp, cache, sha256, local_audio_path, remote_path)
+            finally:
+                sftp.close()
             
             # Restituisce il nome file senza estensione (per Asterisk)
-            audio_name = audio_filename.replace('.wav', '').replace('.mp3', '').replace('.ogg', '')
-            return True, f"custom/{audio_name}"
+            return True, self._asterisk_audio_name(remote_path)
             
         except Exception as e:
             self.logger.error(f"Errore upload audio: {e}")
             return False, str(e)
     
+    def sync_audio_files(self, local_audio_paths):
+        """
+        Allinea in blocco gli audio sul PBX (es. all'avvio) e popola la cache:
+        un solo elenco della directory remota, upload solo dei file mancanti
+        o modificati
+        
+        Args:
+            local_audio_paths: path locali dei file audio
+            
+        Returns:
+            (success, message)
+        """
+        try:
+            if not self.is_connected():
+                if not self.connect():
+                    return False, "Impossibile connettersi al server"
+            
+            cache = get_upload_cache()
+            host = self.config['host']
+            uploaded = unchanged = missing = 0
+            
+            sftp = self.ssh_client.open_sftp()
+            try:
+                try:
+                    remote_files = {attrs.filename: attrs for attrs in sftp.listdir_attr(ASTERISK_SOUNDS_DIR)}
+                except IOError:
+                    sftp.mkdir(ASTERISK_SOUNDS_DIR)
+                    remote_files = {}
+                
+                for local_path in local_audio_paths:
+                    if not local_path or not os.path.exists(local_path):
+                        missing += 1
+                        continue
+                    
+                    sha256 = cache.content_hash(local_path)
+                    entry, _ = cache.lookup(host, sha256)
+                    if entry:
+                        attrs = remote_files.get(entry['remote_path'].rsplit('/', 1)[-1])
+                        if attrs and cache.matches(entry, attrs.st_size, attrs.st_mtime):
+                            cache.mark_verified(host, sha256)
+                            unchanged += 1
+                            continue
+                        cache.forget(host, sha256)
+                    
+                    remote_path = self._remote_audio_path(local_path, sha256)
+                    self._put_audio(sftp, cache, sha256, local_path, remote_path)
+                    uploaded += 1
+            finally:
+                sftp.close()
+            
+            message = f"Audio sincronizzati: {uploaded} caricati, {unchanged} già presenti"
+            if missing:
+                message += f", {missing} file locali mancanti"
+            self.logger.info(message)
+            return True, message
+            
+        except Exception as e:
+            self.logger.error(f"Errore sincronizzazione audio: {e}")
+            return False, str(e)
+    
+    def _put_audio(self, sftp, cache, sha256, local_audio_path, remote_path):
+        """Trasferisce un audio e lo registra nel manifest"""
+        self.logger.info(f"Upload audio {os.path.basename(local_audio_path)} su Asterisk...")
+        try:
+            attrs = sftp.put(local_audio_path, remote_path)
+        except IOError:
+            # Directory custom non ancora presente
+            sftp.mkdir(ASTERISK_SOUNDS_DIR)
+            attrs = sftp.put(local_audio_path, remote_path)
+        
+        cache.record(self.config['host'], sha256, remote_path, attrs.st_size, attrs.st_mtime)
+        self.logger.info(f"✓ Audio caricato: {remote_path}")
+    
+    @staticmethod
+    def _remote_audio_path(local_audio_path, sha256):
+        """
+        Path remoto dell'audio con un suffisso dell'hash del contenuto: due
+        audio diversi con lo stesso nome file non si sovrascrivono sul PBX,
+        quindi una voce del manifest non può puntare al contenuto di un'altra
+        """
+        name, extension = os.path.splitext(os.path.basename(local_audio_path))
+        return f"{ASTERISK_SOUNDS_DIR}/{name}_{sha256[:12]}{extension}"
+    
+    @staticmethod
+    def _asterisk_audio_name(remote_path):
+        """Path remoto -> nome audio per Asterisk (es. custom/wakeup_it)"""
+        audio_filename = remote_path.rsplit('/', 1)[-1]
+        audio_name = audio_filename.replace('.wav', '').replace('.mp3', '').replace('.ogg', '')
+        return f"custom/{audio_name}"
+    
     def play_audio_with_dtmf(self, phone_extension, audio_file_path, snooze_5_audio=None, snooze_10_audio=None, timeout=30):
         """
         Chiama, riproduce audio e attende DTMF usando context wakeup-service
@@ -320,7 +582,9 @@ exten => i,n,Hangup()
         1. Upload file audio su Asterisk
         2. Upload audio di conferma snooze (se presenti)
         3. Usa context 'wakeup-service' che gestisce DTMF e riproduce conferma
-        4. Legge il risultato DTMF dal file temporaneo
+           (o 'wakeup-agi' se è attivo il server FastAGI integrato)
+        4. Attende l'esito di QUESTA chiamata (per call_id) e ritorna
+           appena arriva il DTMF o l'hangup
         
         Args:
             phone_extension: Interno telefonico
@@ -330,7 +594,8 @@ exten => i,n,Hangup()
             timeout: Secondi di attesa per input DTMF
             
         Returns:
-            (success, dtmf_digit): Tupla con successo e tasto premuto (1, 2, o None)
+            (success, dtmf_digit): Tupla con successo e tasto premuto (1, 2, o None);
+            success è False anche se la chiamata non viene risposta
         """
         try:
             # Ottiene configurazione CallerID
@@ -366,13 +631,8 @@ exten => i,n,Hangup()
                     snooze_10_path = path_10
                     self.logger.info(f"✓ Conferma 10min: {snooze_10_path}")
             
-            # 3. Genera un ID univoco BREVE per questa chiamata
-            import time
-            import random
-            call_id = f"{random.randint(1000,9999)}"  # ID breve a 4 cifre
-            
-            # 4. Nome audio brevissimo (solo basename senza path)
-            audio_basename = os.path.basename(audio_name)
+            # 3. Genera un ID univoco per questa chiamata (correla l'esito)
+            call_id = str(next(_call_ids))
             
             self.logger.info(f"Audio paths da passare ad Asterisk:")
             self.logger.info(f"  Wake-up: {audio_name}")
@@ -380,88 +640,117 @@ exten => i,n,Hangup()
             self.logger.info(f"  Snooze 10min: {snooze_10_path}")
             self.logger.info(f"  Call ID: {call_id}")
             
-            # 5. Crea file temporanei su Asterisk con i path degli audio
-            # Usa ID brevissimo per nomi file
-            try:
-                if snooze_5_path:
-                    cmd_5 = f"echo -n '{snooze_5_path}' > /tmp/s5_{call_id}.txt"
-                    self.execute_command(cmd_5)
-                    self.logger.info(f"✓ File snooze 5: /tmp/s5_{call_id}.txt")
-                
-                if snooze_10_path:
-                    cmd_10 = f"echo -n '{snooze_10_path}' > /tmp/s10_{call_id}.txt"
-                    self.execute_command(cmd_10)
-                    self.logger.info(f"✓ File snooze 10: /tmp/s10_{call_id}.txt")
-                
-                # Scrivi anche il path dell'audio principale
-                audio_path_asterisk = audio_name.replace('/', '-')
-                cmd_audio = f"echo -n '{audio_path_asterisk}' > /tmp/w_{call_id}.txt"
-                self.execute_command(cmd_audio)
-                self.logger.info(f"✓ File wake-up: /tmp/w_{call_id}.txt")
-                
-            except Exception as e:
-                self.logger.error(f"Errore creazione file temporanei: {e}")
+            callerid = f"{wake_callerid} <{wake_extension}>"
+            channel = f"Local/{phone_extension}@{context}/n"
             
-            # 6. Extension brevissima: solo call_id
-            command = (
-                f"asterisk -rx \"channel originate Local/{phone_extension}@{context}/n "
-                f"extension {call_id}@wakeup-service "
-                f"callerid '{wake_callerid} <{wake_extension}>'\" "
-            )
-            
-            self.logger.info(f"Chiamata con DTMF a {phone_extension}: {audio_name}")
-            self.logger.debug(f"Comando: {command}")
-            
-            output, error = self.execute_command(command)
+            if self.config.get('fastagi_enabled'):
+                success, result = self._call_via_fastagi(
+                    channel, callerid, call_id, audio_name, snooze_5_path, snooze_10_path, timeout)
+            else:
+                success, result = self._call_via_wakeup_service(
+                    channel, callerid, call_id, audio_name, snooze_5_path, snooze_10_path, timeout)
             
-            if error:
-                self.logger.error(f"Errore comando: {error}")
+            if not success:
                 return False, None
             
-            self.logger.info(f"✓ Chiamata avviata verso wakeup-service")
+            if result in ('1', '2'):
+                self.logger.info(f"✓ DTMF ricevuto: {result}")
+                return True, result
             
-            # 4. Aspetta che la chiamata finisca e leggi il risultato DTMF
-            # Il context scrive il digit in /tmp/asterisk_dtmf_*.txt
-            import time
-            time.sleep(timeout + 5)  # Attende che la chiamata finisca
+            if result == 'H':
+                self.logger.info("Chiamata chiusa senza DTMF")
+                return True, None
             
-            # 5. Cerca il file DTMF
-            # Pattern: /tmp/asterisk_dtmf_*
-            list_cmd = "ls -t /tmp/asterisk_dtmf_* 2>/dev/null | head -1"
-            dtmf_file_output, _ = self.execute_command(list_cmd)
-            
-            if dtmf_file_output and dtmf_file_output.strip():
-                dtmf_file = dtmf_file_output.strip()
-                
-                # Leggi il contenuto
-                read_cmd = f"cat {dtmf_file}"
-                dtmf_content, _ = self.execute_command(read_cmd)
-                
-                if dtmf_content:
-                    dtmf_digit = dtmf_content.strip()
-                    self.logger.info(f"✓ DTMF ricevuto: {dtmf_digit}")
-                    
-                    # Pulisci il file DTMF
-                    self.execute_command(f"rm -f {dtmf_file}")
-                    
-                    # Pulisci file audio paths (nomi brevi)
-                    self.execute_command(f"rm -f /tmp/w_{call_id}.txt /tmp/s5_{call_id}.txt /tmp/s10_{call_id}.txt")
-                    self.logger.info(f"✓ File temporanei puliti per ID {call_id}")
-                    
-                    return True, dtmf_digit if dtmf_digit in ['1', '2'] else None
-            
-            self.logger.info("Nessun DTMF ricevuto (timeout o no input)")
-            
-            # Pulisci file audio paths anche in caso di timeout
-            self.execute_command(f"rm -f /tmp/w_{call_id}.txt /tmp/s5_{call_id}.txt /tmp/s10_{call_id}.txt")
-            self.logger.info(f"✓ File temporanei puliti per ID {call_id}")
-            
-            return True, None
+            # Non risposta o nessun esito entro il timeout: la sveglia non è
+            # stata consegnata e segue il percorso dei retry
+            if result == NO_ANSWER:
+                self.logger.warning("Chiamata non risposta")
+            else:
+                self.logger.warning("Nessun esito entro il timeout, chiamata considerata non risposta")
+            return False, None
             
         except Exception as e:
             self.logger.error(f"Errore riproduzione audio con DTMF: {e}")
             return False, None
     
+    def _call_via_wakeup_service(self, channel, callerid, call_id, audio_name, snooze_5_path, snooze_10_path, timeout):
+        """
+        Chiamata nel context wakeup-service: gli audio viaggiano come variabili
+        di canale dell'originate (un solo round-trip verso il PBX) e l'esito
+        arriva dal backend
+        
+        Returns:
+            (success, esito di wait_call_result)
+        """
+        variables = {'WAKE_AUDIO': audio_name}
+        if snooze_5_path:
+            variables['SNOOZE_5_AUDIO'] = snooze_5_path
+        if snooze_10_path:
+            variables['SNOOZE_10_AUDIO'] = snooze_10_path
+        
+        # 5. Extension brevissima: solo call_id
+        self.logger.info(f"Chiamata con DTMF a {channel}: {audio_name}")
+        success, message = self.backend.originate(
+            channel, 'wakeup-service', call_id, callerid,
+            call_id=call_id, timeout=self.config.get('ring_timeout', 30), variables=variables)
+        
+        if not success:
+            self.logger.error(f"Errore originate: {message}")
+            return False, None
+        
+        self.logger.info(f"✓ Chiamata avviata verso wakeup-service")
+        
+        # 6. Attende l'esito di questa chiamata: squillo + audio + attesa DTMF al massimo,
+        # ma ritorna appena arriva il tasto o l'hangup
+        max_wait = self.config.get('ring_timeout', 30) + timeout + 30
+        return True, self.wait_call_result(call_id, max_wait)
+    
+    def _call_via_fastagi(self, channel, callerid, call_id, audio_name, snooze_5_path, snooze_10_path, timeout):
+        """
+        Chiamata nel context wakeup-agi: prompt, tasto ed esito gestiti dal
+        server FastAGI integrato, senza file temporanei né polling sul PBX
+        
+        Returns:
+            (success, esito del server FastAGI)
+        """
+        from fastagi_server import get_fastagi_server
+        
+        server = get_fastagi_server(self.config)
+        server.register_call(call_id, audio_name, snooze_5_path, snooze_10_path, digit_timeout=timeout)
+        
+        self.logger.info(f"Chiamata FastAGI a {channel}: {audio_name}")
+        # WAKE_CALL_ID per l'extension failed: la non risposta arriva subito al server
+        success, message = self.backend.originate(
+            channel, 'wakeup-agi', call_id, callerid, timeout=self.config.get('ring_timeout', 30),
+            variables={'WAKE_CALL_ID': call_id})
+        
+        if not success:
+            server.forget_call(call_id)
+            self.logger.error(f"Errore originate: {message}")
+            return False, None
+        
+        max_wait = self.config.get('ring_timeout', 30) + timeout + 30
+        return True, server.wait_call_result(call_id, max_wait)
+    
+    def wait_call_result(self, call_id, max_wait):
+        """
+        Attende l'esito di una chiamata wakeup-service
+        
+        Con il backend SSH il dialplan scrive l'esito in un file sul PBX, con
+        il backend AMI arriva dagli eventi della chiamata: in entrambi i casi
+        ritorna appena c'è un esito e chiamate contemporanee non leggono mai
+        l'esito di un'altra.
+        
+        Args:
+            call_id: ID univoco della chiamata
+            max_wait: Secondi massimi di attesa
+            
+        Returns:
+            '1', '2', 'H' (hangup senza tasto), NO_ANSWER (chiamata non
+            risposta) o None se scade il timeout
+        """
+        return self.backend.wait_call_result(call_id, max_wait)
+    
     def play_audio_simple(self, phone_extension, audio_file_path):
         """
         Riproduce un audio senza attendere DTMF (per messaggi di conferma)
@@ -475,16 +764,11 @@ exten => i,n,Hangup()
         """
         try:
             # Upload audio su Asterisk
-            audio_filename = os.path.splitext(os.path.basename(audio_file_path))[0]
-            
             self.logger.info(f"Upload audio conferma su Asterisk: {audio_file_path}")
-            success = self.upload_audio_to_asterisk(audio_file_path)
+            success, asterisk_audio_path = self.upload_audio_to_asterisk(audio_file_path)
             if not success:
                 return False, "Errore upload audio"
             
-            # Prepara path audio per Asterisk (senza estensione)
-            asterisk_audio_path = f"custom/{audio_filename}"
-            
             # Converti "/" in "-" per extension name
             audio_exten = asterisk_audio_path.replace('/', '-')
             
@@ -496,16 +780,12 @@ exten => i,n,Hangup()
             self.logger.info(f"Riproduzione audio semplice a {phone_extension}: {asterisk_audio_path}")
             
             # Chiamata SENZA DTMF usando context dedicato
-            command = (
-                f"asterisk -rx \"channel originate Local/{phone_extension}@{context}/n "
-                f"extension {audio_exten}@wakeup-service-simple "
-                f"callerid '{wake_callerid} <{wake_extension}>'\" "
-            )
-            
-            output, error = self.execute_command(command)
+            success, message = self.backend.originate(
+                f"Local/{phone_extension}@{context}/n", 'wakeup-service-simple', audio_exten,
+                f"{wake_callerid} <{wake_extension}>")
             
-            if error or "error" in output.lower():
-                self.logger.error(f"Errore chiamata: {output}")
+            if not success:
+                self.logger.error(f"Errore chiamata: {message}")
                 return False, "Errore chiamata"
             
             self.logger.info(f"✓ Audio semplice riprodotto")
@@ -538,9 +818,7 @@ exten => i,n,Hangup()
         """Termina la chiamata alla camera specificata"""
         try:
             # Comando per terminare la chiamata
-            command = f"asterisk -rx 'hangup {room_number}'"
-            
-            output, error = self.execute_command(command)
+            output, error = self.backend.command(f"hangup {room_number}")
             
             if error:
                 return False, f"Errore nella terminazione chiamata: {error}"
@@ -556,9 +834,7 @@ exten => i,n,Hangup()
         """Ottiene lo status della chiamata per una camera"""
         try:
             # Comando per verificare lo status della chiamata
-            command = f"asterisk -rx 'core show channels'"
-            
-            output, error = self.execute_command(command)
+            output, error = self.backend.command('core show channels')
             
             if error:
                 return None, f"Errore nel controllo status: {error}"
@@ -574,9 +850,9 @@ exten => i,n,Hangup()
             return None, str(e)
     
     def test_connection(self):
-        """Testa la connessione al centralino"""
+        """Testa la connessione al centralino (riusa il trasporto persistente se attivo)"""
         try:
-            if not self.connect():
+            if not self.is_connected() and not self.connect(force=True):
                 return False, "Impossibile connettersi al centralino"
             
             # Esegue un comando di test
@@ -585,14 +861,18 @@ exten => i,n,Hangup()
             if error:
                 return False, f"Errore nel test: {error}"
             
+            # Con il backend AMI le chiamate passano dalla sessione manager
+            if self.backend.name != 'ssh':
+                success, message = self.backend.test()
+                if not success:
+                    return False, message
+            
             self.logger.info("Test connessione PBX completato con successo")
             return True, "Connessione testata con successo"
             
         except Exception as e:
             self.logger.error(f"Errore nel test connessione: {e}")
             return False, str(e)
-        finally:
-            self.disconnect()
     
     def get_system_info(self):
         """Ottiene informazioni sul sistema PBX"""
@@ -601,17 +881,17 @@ exten => i,n,Hangup()
                 if not self.connect():
                     return None, "Errore di connessione"
             
-            # Comandi per ottenere informazioni di sistema
+            # Comandi per ottenere informazioni di sistema (un solo round-trip)
             commands = {
-                "version": "asterisk -rx 'core show version'",
-                "uptime": "asterisk -rx 'core show uptime'",
-                "channels": "asterisk -rx 'core show channels'",
-                "extensions": "asterisk -rx 'dialplan show'"
+                "version": "core show version",
+                "uptime": "core show uptime",
+                "channels": "core show channels",
+                "extensions": "dialplan show"
             }
             
             info = {}
-            for key, command in commands.items():
-                output, error = self.execute_command(command)
+            results = self.execute_cli_batch(list(commands.values()))
+            for key, (output, error) in zip(commands, results):
                 if not error:
                     info[key] = output
                 else:
@@ -628,27 +908,35 @@ exten => i,n,Hangup()
         try:
             self.logger.info("Lettura interni dal centralino...")
             
-            # Prova prima con SIP
-            command = "asterisk -rx 'sip show peers'"
-            output, error = self.execute_command(command)
-            
-            if error or not output or 'Unable to connect' in output:
-                # Prova con PJSIP (Asterisk 12+)
-                self.logger.info("SIP non disponibile, provo con PJSIP...")
-                command = "asterisk -rx 'pjsip show endpoints'"
-                output, error = self.execute_command(command)
-                
-                if error or not output:
-                    return None, "Impossibile leggere gli interni dal centralino"
-                
-                return self._parse_pjsip_output(output), None
-            
-            return self._parse_sip_output(output), None
+            # SIP e PJSIP (Asterisk 12+) letti insieme: un solo round-trip
+            sip_result, pjsip_result = self.execute_cli_batch(PEER_COMMANDS)
+            return self.parse_peers(sip_result, pjsip_result)
             
         except Exception as e:
             self.logger.error(f"Errore nella lettura interni: {e}")
             return None, str(e)
     
+    def parse_peers(self, sip_result, pjsip_result):
+        """
+        Interni dagli esiti (output, error) di 'sip show peers' e
+        'pjsip show endpoints': SIP se chan_sip è caricato, altrimenti PJSIP
+        
+        Returns:
+            (peers, error)
+        """
+        output, error = sip_result
+        pjsip_output, pjsip_error = pjsip_result
+        
+        if error or not output or 'Unable to connect' in output or 'No such command' in output:
+            self.logger.info("SIP non disponibile, uso PJSIP...")
+            
+            if pjsip_error or not pjsip_output:
+                return None, "Impossibile leggere gli interni dal centralino"
+            
+            return self._parse_pjsip_output(pjsip_output), None
+        
+        return self._parse_sip_output(output), None
+    
     def _parse_sip_output(self, output):
         """Parsa l'output di 'sip show peers'"""
         peers = []
@@ -675,16 +963,15 @@ exten => i,n,Hangup()
                 if peer_name.isdigit() or peer_name.startswith('SIP/'):
                     peer_name = peer_name.replace('SIP/', '')
                     
-                    # Determina lo stato (online/offline)
-                    status = 'offline'
-                    if 'OK' in line or 'Reachable' in line:
+                    # Determina lo stato (online/offline). Solo UNREACHABLE è
+                    # un esito di qualify negativo: UNKNOWN (qualify non ancora
+                    # risposto, es. dopo 'sip reload') e stati non riconosciuti
+                    # non dicono nulla sul telefono, come i contatti PJSIP Unknown
+                    status = 'unmonitored'
+                    if 'OK' in line or 'Reachable' in line or 'LAGGED' in line:
                         status = 'online'
-                    elif 'UNKNOWN' in line or 'Unspecified' in line or '(unspecified)' in line:
-                        status = 'offline'
                     elif 'Unreachable' in line or 'UNREACHABLE' in line:
                         status = 'offline'
-                    elif 'Unmonitored' in line:
-                        status = 'unmonitored'
                     
                     # Estrae latency se disponibile
                     latency = None
@@ -723,30 +1010,33 @@ exten => i,n,Hangup()
         self.logger.info(f"Parsing PJSIP output ({len(lines)} righe)...")
         
         for line in lines:
-            # Formato tipico: 101    Yes    No   Avail   10.0.0.15  5060
-            line = line.strip()
-            if not line or line.startswith('Endpoint') or line.startswith('===') or 'Objects found' in line:
+            # Formato tipico: " Endpoint:  101/101      Not in use    0 of inf"
+            # seguito da righe di dettaglio (InAuth, Aor, Contact, Transport) ignorate
+            parts = line.split()
+            if len(parts) < 2 or parts[0] != 'Endpoint:' or parts[1].startswith('<'):
                 continue
             
-            parts = line.split()
-            if len(parts) >= 1:
-                peer_name = parts[0].strip()
-                
-                # Verifica se è un numero (interno telefonico)
-                if peer_name.isdigit():
-                    # Determina lo stato
+            # Estrae il numero interno (prima dell'eventuale /CallerID)
+            peer_name = parts[1].split('/')[0]
+            
+            # Verifica se è un numero (interno telefonico)
+            if peer_name.isdigit():
+                # Determina lo stato dal device state dell'endpoint
+                state = ' '.join(parts[2:])
+                if state.startswith('Unavailable'):
                     status = 'offline'
-                    if 'Avail' in line or 'Online' in line:
-                        status = 'online'
-                    elif 'Unavail' in line or 'Offline' in line:
-                        status = 'offline'
-                    
-                    peers.append({
-                        'extension': peer_name,
-                        'status': status,
-                        'latency': None,
-                        'type': 'PJSIP'
-                    })
+                elif not state or state.startswith('Invalid') or state.startswith('Unknown'):
+                    status = 'unmonitored'
+                else:
+                    # Not in use, In use, Busy, Ringing, On Hold: telefono registrato
+                    status = 'online'
+                
+                peers.append({
+                    'extension': peer_name,
+                    'status': status,
+                    'latency': None,
+                    'type': 'PJSIP'
+                })
         
         self.logger.info(f"Trovati {len(peers)} interni PJSIP")
         return peers
@@ -754,14 +1044,13 @@ exten => i,n,Hangup()
     def get_extension_status(self, extension):
         """Ottiene lo stato di un singolo interno"""
         try:
-            # Prova SIP
-            command = f"asterisk -rx 'sip show peer {extension}'"
-            output, error = self.execute_command(command)
+            # SIP e PJSIP in un solo round-trip
+            (output, error), (pjsip_output, pjsip_error) = self.execute_cli_batch(
+                [f'sip show peer {extension}', f'pjsip show endpoint {extension}'])
             
-            if error or 'not found' in output.lower():
-                # Prova PJSIP
-                command = f"asterisk -rx 'pjsip show endpoint {extension}'"
-                output, error = self.execute_command(command)
+            if error or 'not found' in output.lower() or 'no such command' in output.lower():
+                # Usa PJSIP
+                output, error = pjsip_output, pjsip_error
                 
                 if error:
                     return 'unknown', None
@@ -0,0 +1,83 @@
+"""
+Cache in memoria delle camere
+"""
+import threading
+from logger import get_logger
+
+class RoomCache:
+    """
+    Copia in memoria della tabella rooms, indicizzata per numero camera e
+    per interno telefonico.
+
+    La tabella viene letta alla prima richiesta e riletta solo quando il
+    DatabaseManager segnala una modifica alle camere (get_data_version):
+    le letture successive non accedono al database.
+    """
+
+    TABLE = 'rooms'
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.logger = get_logger('room_cache')
+
+        self._lock = threading.Lock()
+        self._version = None
+        self._rooms = []          # camere ordinate per numero
+        self._by_number = {}      # room_number -> camera
+        self._by_extension = {}   # phone_extension -> prima camera con quell'interno
+
+    def _ensure_loaded(self):
+        """Ricarica la cache se il database è cambiato"""
+        version = self.db.get_data_version(self.TABLE)
+        with self._lock:
+            if version == self._version:
+                return
+
+        # Versione letta PRIMA delle righe: una modifica concorrente
+        # provoca al più una ricarica in più, mai dati vecchi
+        rooms = self.db.get_rooms()
+        by_number = {}
+        by_extension = {}
+        for room in rooms:
+            by_number[room.room_number] = room
+            if room.phone_extension:
+                by_extension.setdefault(room.phone_extension, room)
+
+        with self._lock:
+            self._rooms = rooms
+            self._by_number = by_number
+            self._by_extension = by_extension
+            self._version = version
+        self.logger.debug(f"Cache camere caricata: {len(rooms)} camere")
+
+    def version(self):
+        """Versione dei dati su cui è costruita la cache"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._version
+
+    def get(self, room_number):
+        """Camera (Room) per numero o None"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._by_number.get(room_number)
+
+    def get_by_extension(self, phone_extension):
+        """Camera (Room) per interno telefonico o None"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._by_extension.get(phone_extension)
+
+    def get_all(self, status=None):
+        """Camere ordinate per numero, eventualmente filtrate per status"""
+        self._ensure_loaded()
+        with self._lock:
+            if status:
+                return [room for room in self._rooms if room.status == status]
+            return list(self._rooms)
+
+    def get_labels(self):
+        """Etichette distinte delle camere, ordinate"""
+        self._ensure_loaded()
+        with self._lock:
+            return sorted({room.label for room in self._rooms if room.label})
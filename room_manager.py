@@ -4,15 +4,20 @@ Gestione avanzata delle camere dell'hotel con integrazione centralino PBX
 import tkinter as tk
 from tkinter import ttk, messagebox, colorchooser
 from database import DatabaseManager
-from pbx_connection import PBXConnection
+from room_cache import RoomCache
+from extension_status import get_extension_status_service
 import threading
 import logging
 from logger import get_logger
 
 class RoomManagerWindow:
-    def __init__(self, parent, db_manager, pbx_manager=None, on_save_callback=None):
+    def __init__(self, parent, db_manager, pbx_manager=None, on_save_callback=None, room_cache=None,
+                 extension_status=None):
         self.parent = parent
         self.db = db_manager
+        self.room_cache = room_cache or RoomCache(db_manager)
+        # Stato interni condiviso: le finestre aperte non interrogano il PBX ognuna per conto suo
+        self.extension_status = extension_status or get_extension_status_service()
         self.pbx_manager = pbx_manager
         self.on_save_callback = on_save_callback
         self.logger = get_logger('room_manager')
@@ -228,24 +233,10 @@ class RoomManagerWindow:
         
         def do_clean_import():
             try:
-                self.status_label.config(text="Pulizia in corso...")
-                self.logger.info("Pulizia database camere...")
-                
-                # Elimina tutte le camere
-                conn = self.db.get_connection()
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM rooms")
-                conn.commit()
-                conn.close()
-                
-                self.logger.info("Tutte le camere eliminate")
                 self.status_label.config(text="Import da PBX in corso...")
                 
-                # Connessione al PBX
-                pbx = PBXConnection()
-                
-                # Ottiene la lista degli interni
-                peers, error = pbx.get_sip_peers()
+                # Lista interni letta ora dal PBX (poll condiviso con le altre richieste)
+                peers, error = self.extension_status.get_peers(max_age=0)
                 
                 if error or not peers:
                     messagebox.showerror("Errore Import", 
@@ -255,33 +246,20 @@ class RoomManagerWindow:
                 
                 self.logger.info(f"Trovati {len(peers)} interni sul PBX")
                 
-                # Importa tutti gli interni
-                imported = 0
-                
-                for peer in peers:
-                    extension = peer['extension']
-                    ext_type = peer['type']
-                    
-                    # Crea nuova camera
-                    description = f"Interno {extension} ({ext_type})"
-                    self.db.add_room(
-                        room_number=extension,
-                        phone_extension=extension,
-                        description=description,
-                        status='available',
-                        color='#FFFFFF',
-                        label='Importato da PBX'
-                    )
-                    imported += 1
-                    
-                    if imported % 20 == 0:
-                        self.logger.info(f"Importati {imported}/{len(peers)}...")
+                # Elimina tutte le camere e importa gli interni in un'unica transazione:
+                # se l'import fallisce le camere esistenti restano
+                counts = self.db.bulk_upsert_rooms(peers, replace=True)
+                imported = counts['inserted']
                 
-                self.logger.info(f"Import completato: {imported} interni importati")
+                self.logger.info(f"Pulizia camere e import completati: {imported} interni importati")
                 
                 # Aggiorna stato e lista
                 self.refresh_extensions_status()
                 
+                # Notifica l'applicazione principale (nel thread della GUI)
+                if self.on_save_callback:
+                    self.window.after(0, self.on_save_callback)
+                
                 # Messaggio risultato
                 messagebox.showinfo("Pulizia e Import Completati", 
                                   f"✅ Operazione completata!\n\n"
@@ -306,11 +284,8 @@ class RoomManagerWindow:
                 self.status_label.config(text="Importazione in corso...")
                 self.logger.info("Avvio importazione interni da PBX...")
                 
-                # Connessione al PBX
-                pbx = PBXConnection()
-                
-                # Ottiene la lista degli interni
-                peers, error = pbx.get_sip_peers()
+                # Lista interni letta ora dal PBX (poll condiviso con le altre richieste)
+                peers, error = self.extension_status.get_peers(max_age=0)
                 
                 if error or not peers:
                     messagebox.showerror("Errore Import", 
@@ -320,46 +295,29 @@ class RoomManagerWindow:
                 
                 self.logger.info(f"Trovati {len(peers)} interni sul PBX")
                 
-                # Importa gli interni
-                imported = 0
-                skipped = 0
-                
-                for peer in peers:
-                    extension = peer['extension']
-                    status = peer['status']
-                    ext_type = peer['type']
-                    
-                    # Verifica se l'interno esiste già
-                    existing = self.db.get_room_by_extension(extension)
-                    
-                    if not existing:
-                        # Crea nuova camera
-                        description = f"Interno {extension} ({ext_type})"
-                        self.db.add_room(
-                            room_number=extension,
-                            phone_extension=extension,
-                            description=description,
-                            status='available',
-                            color='#FFFFFF',
-                            label=f'Importato da PBX'
-                        )
-                        imported += 1
-                        self.logger.info(f"Importato interno {extension}")
-                    else:
-                        skipped += 1
+                # Importa gli interni in un'unica transazione
+                counts = self.db.bulk_upsert_rooms(peers)
+                imported = counts['inserted']
+                updated = counts['updated']
+                skipped = counts['unchanged']
                 
                 # Aggiorna lista
                 self.load_rooms()
                 
+                # Notifica l'applicazione principale (nel thread della GUI)
+                if (imported or updated) and self.on_save_callback:
+                    self.window.after(0, self.on_save_callback)
+                
                 # Messaggio risultato
                 messagebox.showinfo("Import Completato", 
                                   f"Import completato!\n\n"
                                   f"Interni importati: {imported}\n"
+                                  f"Interni aggiornati: {updated}\n"
                                   f"Interni già esistenti: {skipped}\n"
                                   f"Totale interni PBX: {len(peers)}")
                 
                 self.status_label.config(text=f"✓ Importati {imported} interni")
-                self.logger.info(f"Import completato: {imported} importati, {skipped} saltati")
+                self.logger.info(f"Import completato: {imported} importati, {updated} aggiornati, {skipped} invariati")
                 
             except Exception as e:
                 self.logger.error(f"Errore nell'import da PBX: {e}")
@@ -370,14 +328,16 @@ class RoomManagerWindow:
         threading.Thread(target=do_import, daemon=True).start()
     
     def refresh_extensions_status(self):
-        """Aggiorna lo stato di tutti gli interni dal PBX"""
+        """
+        Aggiorna lo stato di tutti gli interni dalla fotografia condivisa
+        (il PBX viene interrogato solo se è più vecchia dell'intervallo)
+        """
         def do_refresh():
             try:
                 self.status_label.config(text="Aggiornamento stato interni...")
                 self.logger.info("Refresh stato interni PBX...")
                 
-                pbx = PBXConnection()
-                peers, error = pbx.get_sip_peers()
+                peers, error = self.extension_status.get_peers()
                 
                 if error or not peers:
                     self.status_label.config(text="✗ Errore aggiornamento")
@@ -418,18 +378,20 @@ class RoomManagerWindow:
         threading.Thread(target=do_refresh, daemon=True).start()
     
     def start_auto_refresh(self):
-        """Avvia il refresh automatico dello stato interni ogni 30 secondi"""
+        """Avvia il refresh automatico dello stato interni (ogni intervallo del servizio stato)"""
+        refresh_ms = int(self.extension_status.interval * 1000)
+        
         def auto_refresh_loop():
             # Primo refresh dopo 2 secondi
             self.window.after(2000, self.refresh_extensions_status)
             
-            # Poi ogni 30 secondi
+            # Poi a ogni intervallo
             def schedule_next():
                 if self.window.winfo_exists():
                     self.refresh_extensions_status()
-                    self.window.after(30000, schedule_next)
+                    self.window.after(refresh_ms, schedule_next)
             
-            self.window.after(30000, schedule_next)
+            self.window.after(refresh_ms, schedule_next)
         
         auto_refresh_loop()
     
@@ -453,27 +415,26 @@ class RoomManagerWindow:
                 sample = list(self.pbx_status_cache.items())[:3]
                 self.logger.info(f"  Campione cache: {sample}")
             
-            rooms = self.db.get_rooms()
+            rooms = self.room_cache.get_all()
             
             # Log prima camera per debug
             if len(rooms) > 0:
-                self.logger.info(f"  Prima camera dal DB (RAW): {rooms[0]}")
+                self.logger.info(f"  Prima camera dal DB: {rooms[0]}")
+            first_room_id = rooms[0].id if rooms else None
             
             for room in rooms:
-                # Estrae i dati (ordine corretto dal database)
-                # 0=id, 1=room_number, 2=phone_extension, 3=description, 
-                # 4=status, 5=color, 6=label, 7=created_at
-                room_id = room[0]
-                room_number = room[1]
-                phone_extension = room[2] if len(room) > 2 and room[2] else ""
-                description = room[3] if len(room) > 3 and room[3] else ""
-                status = room[4] if len(room) > 4 and room[4] else "available"
-                color = room[5] if len(room) > 5 and room[5] else "#FFFFFF"
-                label = room[6] if len(room) > 6 and room[6] else ""
-                created_date = room[7].split(' ')[0] if len(room) > 7 and room[7] else "N/A"
+                # Campi per nome: indipendenti dall'ordine fisico delle colonne
+                room_id = room.id
+                room_number = room.room_number
+                phone_extension = room.phone_extension or ""
+                description = room.description or ""
+                status = room.status or "available"
+                color = room.color or "#FFFFFF"
+                label = room.label or ""
+                created_date = room.created_at.split(' ')[0] if room.created_at else "N/A"
                 
                 # Log prima camera per debug
-                if room_id == rooms[0][0]:
+                if room_id == first_room_id:
                     self.logger.info(f"  Prima camera PARSED: num={room_number}, ext={phone_extension}, desc={description}")
                 
                 # Determina stato PBX
@@ -493,11 +454,11 @@ class RoomManagerWindow:
                         pbx_color = "orange"
                     
                     # Log solo primo match per vedere se funziona
-                    if room_id == rooms[0][0]:
+                    if room_id == first_room_id:
                         self.logger.info(f"  ✓ Primo interno: {phone_extension} -> {ext_status}")
                 elif phone_extension:
                     # Log solo primo mismatch
-                    if room_id == rooms[0][0]:
+                    if room_id == first_room_id:
                         self.logger.warning(f"  ✗ Interno {phone_extension} NON trovato in cache!")
                 
                 # Converte stato in italiano
@@ -592,7 +553,7 @@ class RoomManagerWindow:
         
         try:
             # Verifica se la camera esiste già
-            existing_room = self.db.get_room(room_number)
+            existing_room = self.room_cache.get(room_number)
             if existing_room:
                 messagebox.showerror("Errore", f"La camera {room_number} esiste già")
                 return
@@ -5,7 +5,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox, colorchooser, filedialog
 import json
 import os
-from config import PBX_CONFIG, AUDIO_CONFIG, ALARM_CONFIG, HOTEL_CONFIG
+from config import PBX_CONFIG, AUDIO_CONFIG, ALARM_CONFIG, HOTEL_CONFIG, ARCHIVE_CONFIG
 
 class SettingsWindow:
     def __init__(self, parent, on_save_callback=None):
@@ -42,6 +42,13 @@ class SettingsWindow:
         self.wake_extension = tk.StringVar()
         self.wake_callerid = tk.StringVar()
         self.pbx_context = tk.StringVar()
+        self.pbx_backend = tk.StringVar()
+        self.ami_port = tk.StringVar()
+        self.ami_username = tk.StringVar()
+        self.ami_secret = tk.StringVar()
+        self.fastagi_enabled = tk.BooleanVar()
+        self.fastagi_host = tk.StringVar()
+        self.fastagi_port = tk.StringVar()
         
         # Mail Settings
         self.mail_enabled = tk.BooleanVar()
@@ -71,6 +78,10 @@ class SettingsWindow:
         self.snooze_options = tk.StringVar()
         self.max_snooze_attempts = tk.StringVar()
         self.call_timeout = tk.StringVar()
+        self.max_concurrent_calls = tk.StringVar()
+        self.archive_enabled = tk.BooleanVar()
+        self.alarm_retention_days = tk.StringVar()
+        self.call_log_retention_days = tk.StringVar()
     
     def create_widgets(self):
         """Crea l'interfaccia delle impostazioni"""
@@ -161,9 +172,42 @@ class SettingsWindow:
         ttk.Label(fields_frame, text="(Di solito: from-internal)", 
                  font=("Arial", 8), foreground="gray").grid(row=9, column=2, sticky=tk.W, padx=(5, 0))
         
+        # Separatore
+        ttk.Separator(fields_frame, orient='horizontal').grid(row=10, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=15)
+        
+        # Sezione backend chiamate
+        ttk.Label(fields_frame, text="Controllo Chiamate:", 
+                 font=("Arial", 10, "bold")).grid(row=11, column=0, columnspan=2, sticky=tk.W, pady=(5, 10))
+        
+        ttk.Label(fields_frame, text="Backend:").grid(row=12, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(fields_frame, textvariable=self.pbx_backend, values=["ssh", "ami"],
+                     state="readonly", width=8).grid(row=12, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        ttk.Label(fields_frame, text="(ssh: asterisk -rx, ami: Asterisk Manager Interface)", 
+                 font=("Arial", 8), foreground="gray").grid(row=12, column=2, sticky=tk.W, padx=(5, 0))
+        
+        ttk.Label(fields_frame, text="Porta AMI:").grid(row=13, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.ami_port, width=10).grid(row=13, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        
+        ttk.Label(fields_frame, text="Utente AMI:").grid(row=14, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.ami_username, width=30).grid(row=14, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        
+        ttk.Label(fields_frame, text="Secret AMI:").grid(row=15, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.ami_secret, show="*", width=30).grid(row=15, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        
+        ttk.Checkbutton(fields_frame, text="Gestisci le sveglie con il server FastAGI integrato",
+                       variable=self.fastagi_enabled).grid(row=16, column=0, columnspan=3, sticky=tk.W, pady=5)
+        
+        ttk.Label(fields_frame, text="Indirizzo FastAGI:").grid(row=17, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.fastagi_host, width=30).grid(row=17, column=1, sticky=(tk.W, tk.E), pady=5, padx=(10, 0))
+        ttk.Label(fields_frame, text="(IP di questo PC visto dal PBX)", 
+                 font=("Arial", 8), foreground="gray").grid(row=17, column=2, sticky=tk.W, padx=(5, 0))
+        
+        ttk.Label(fields_frame, text="Porta FastAGI:").grid(row=18, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.fastagi_port, width=10).grid(row=18, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        
         # Pulsanti
         buttons_frame = ttk.Frame(fields_frame)
-        buttons_frame.grid(row=10, column=0, columnspan=3, pady=20)
+        buttons_frame.grid(row=19, column=0, columnspan=3, pady=20)
         
         ttk.Button(buttons_frame, text="Test Connessione", 
                   command=self.test_pbx_connection).pack(side=tk.LEFT, padx=5)
@@ -402,6 +446,20 @@ class SettingsWindow:
         ttk.Label(fields_frame, text="Timeout Chiamata (secondi):").grid(row=2, column=0, sticky=tk.W, pady=5)
         ttk.Entry(fields_frame, textvariable=self.call_timeout, width=10).grid(row=2, column=1, sticky=tk.W, pady=5, padx=(10, 0))
         
+        # Chiamate contemporanee (worker del dispatcher, applicato al riavvio)
+        ttk.Label(fields_frame, text="Chiamate Contemporanee Max:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.max_concurrent_calls, width=10).grid(row=3, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        
+        # Archiviazione sveglie concluse e log chiamate
+        ttk.Checkbutton(fields_frame, text="Archivia sveglie concluse e log chiamate",
+                       variable=self.archive_enabled).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=(15, 5))
+        
+        ttk.Label(fields_frame, text="Archivia sveglie dopo (giorni):").grid(row=5, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.alarm_retention_days, width=10).grid(row=5, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        
+        ttk.Label(fields_frame, text="Archivia log chiamate dopo (giorni):").grid(row=6, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(fields_frame, textvariable=self.call_log_retention_days, width=10).grid(row=6, column=1, sticky=tk.W, pady=5, padx=(10, 0))
+        
         fields_frame.columnconfigure(1, weight=1)
     
     def create_control_buttons(self, parent):
@@ -436,7 +494,8 @@ class SettingsWindow:
             },
             "rooms": HOTEL_CONFIG.copy(),
             "audio": AUDIO_CONFIG.copy(),
-            "alarms": ALARM_CONFIG.copy()
+            "alarms": ALARM_CONFIG.copy(),
+            "archive": ARCHIVE_CONFIG.copy()
         }
         
         if os.path.exists(self.settings_file):
@@ -469,6 +528,13 @@ class SettingsWindow:
         self.wake_extension.set(self.settings["pbx"].get("wake_extension", "999"))
         self.wake_callerid.set(self.settings["pbx"].get("wake_callerid", "Servizio Sveglie"))
         self.pbx_context.set(self.settings["pbx"].get("context", "from-internal"))
+        self.pbx_backend.set(self.settings["pbx"].get("backend", "ssh"))
+        self.ami_port.set(str(self.settings["pbx"].get("ami_port", 5038)))
+        self.ami_username.set(self.settings["pbx"].get("ami_username", ""))
+        self.ami_secret.set(self.settings["pbx"].get("ami_secret", ""))
+        self.fastagi_enabled.set(self.settings["pbx"].get("fastagi_enabled", False))
+        self.fastagi_host.set(self.settings["pbx"].get("fastagi_host", ""))
+        self.fastagi_port.set(str(self.settings["pbx"].get("fastagi_port", 4573)))
         
         # Mail Settings
         self.mail_enabled.set(self.settings["mail"]["enabled"])
@@ -498,6 +564,12 @@ class SettingsWindow:
         self.snooze_options.set("; ".join(map(str, self.settings["alarms"]["snooze_options"])))
         self.max_snooze_attempts.set(str(self.settings["alarms"]["max_snooze_attempts"]))
         self.call_timeout.set(str(self.settings["alarms"]["call_timeout"]))
+        self.max_concurrent_calls.set(str(self.settings["alarms"]["max_concurrent_calls"]))
+        
+        # Archive Settings
+        self.archive_enabled.set(self.settings["archive"]["enabled"])
+        self.alarm_retention_days.set(str(self.settings["archive"]["alarm_retention_days"]))
+        self.call_log_retention_days.set(str(self.settings["archive"]["call_log_retention_days"]))
     
     def save_settings(self):
         """Salva le impostazioni"""
@@ -511,6 +583,13 @@ class SettingsWindow:
             self.settings["pbx"]["wake_extension"] = self.wake_extension.get()
             self.settings["pbx"]["wake_callerid"] = self.wake_callerid.get()
             self.settings["pbx"]["context"] = self.pbx_context.get()
+            self.settings["pbx"]["backend"] = self.pbx_backend.get() or "ssh"
+            self.settings["pbx"]["ami_port"] = int(self.ami_port.get())
+            self.settings["pbx"]["ami_username"] = self.ami_username.get()
+            self.settings["pbx"]["ami_secret"] = self.ami_secret.get()
+            self.settings["pbx"]["fastagi_enabled"] = self.fastagi_enabled.get()
+            self.settings["pbx"]["fastagi_host"] = self.fastagi_host.get().strip()
+            self.settings["pbx"]["fastagi_port"] = int(self.fastagi_port.get())
             
             # Salva su file usando la funzione di config
             from config import save_user_config, PBX_CONFIG
@@ -540,6 +619,13 @@ class SettingsWindow:
             self.settings["alarms"]["snooze_options"] = [int(x.strip()) for x in self.snooze_options.get().split(";")]
             self.settings["alarms"]["max_snooze_attempts"] = int(self.max_snooze_attempts.get())
             self.settings["alarms"]["call_timeout"] = int(self.call_timeout.get())
+            self.settings["alarms"]["max_concurrent_calls"] = int(self.max_concurrent_calls.get())
+            
+            self.settings["archive"]["enabled"] = self.archive_enabled.get()
+            self.settings["archive"]["alarm_retention_days"] = float(self.alarm_retention_days.get())
+            self.settings["archive"]["call_log_retention_days"] = float(self.call_log_retention_days.get())
+            # L'archiviatore legge ARCHIVE_CONFIG a ogni passaggio
+            ARCHIVE_CONFIG.update(self.settings["archive"])
             
             # Salva su file
             with open(self.settings_file, 'w', encoding='utf-8') as f:
@@ -589,7 +675,10 @@ class SettingsWindow:
                     'port': int(self.pbx_port.get().strip()) if self.pbx_port.get().strip() else 22,
                     'username': self.pbx_username.get().strip(),
                     'password': self.pbx_password.get().strip(),
-                    'timeout': int(self.pbx_timeout.get().strip()) if self.pbx_timeout.get().strip() else 10
+                    'timeout': int(self.pbx_timeout.get().strip()) if self.pbx_timeout.get().strip() else 10,
+                    # Con l'indirizzo FastAGI viene scritto anche il context wakeup-agi
+                    'fastagi_host': self.fastagi_host.get().strip(),
+                    'fastagi_port': int(self.fastagi_port.get().strip()) if self.fastagi_port.get().strip() else 4573
                 }
                 
                 pbx = PBXConnection(config=pbx_config)
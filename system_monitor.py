@@ -204,7 +204,11 @@ class SystemMonitorWindow:
             ("Sveglie Posticipate:", "snoozed_alarms"),
             ("Sveglie Fallite:", "failed_alarms"),
             ("Prossima Sveglia:", "next_alarm"),
-            ("Ultima Esecuzione:", "last_execution")
+            ("Ultima Esecuzione:", "last_execution"),
+            ("Coda Chiamate PBX:", "dispatch_queue"),
+            ("Ritardo Stimato Coda:", "expected_lateness"),
+            ("Esiti Chiamate Oggi:", "kpi_today"),
+            ("Ritardo Medio Oggi:", "lateness_today")
         ]
         
         for i, (label, key) in enumerate(alarms_labels):
@@ -288,10 +292,12 @@ class SystemMonitorWindow:
     def update_all_info(self):
         """Aggiorna tutte le informazioni"""
         try:
+            # Contatori del database letti una volta per aggiornamento
+            stats = self.db.get_dashboard_stats()
             self.update_system_info()
-            self.update_database_info()
+            self.update_database_info(stats)
             self.update_pbx_info()
-            self.update_alarms_info()
+            self.update_alarms_info(stats)
             self.update_performance_info()
         except Exception as e:
             print(f"Errore nell'aggiornamento info: {e}")
@@ -329,8 +335,8 @@ class SystemMonitorWindow:
         except Exception as e:
             print(f"Errore aggiornamento info sistema: {e}")
     
-    def update_database_info(self):
-        """Aggiorna le informazioni del database"""
+    def update_database_info(self, stats=None):
+        """Aggiorna le informazioni del database (stats: risultato di get_dashboard_stats)"""
         try:
             # Test connessione
             conn = self.db.get_connection()
@@ -342,30 +348,22 @@ class SystemMonitorWindow:
                 size = os.path.getsize(self.db.db_path)
                 self.db_info["file_size"].config(text=f"{size // 1024} KB")
             
-            # Statistiche camere
-            rooms = self.db.get_rooms()
-            total_rooms = len(rooms)
-            available_rooms = len([r for r in rooms if r[2] == 'available'])
-            occupied_rooms = len([r for r in rooms if r[2] == 'occupied'])
+            stats = stats or self.db.get_dashboard_stats()
             
-            self.db_info["total_rooms"].config(text=str(total_rooms))
-            self.db_info["available_rooms"].config(text=str(available_rooms))
-            self.db_info["occupied_rooms"].config(text=str(occupied_rooms))
+            # Statistiche camere
+            rooms = stats['rooms_by_status']
+            self.db_info["total_rooms"].config(text=str(stats['total_rooms']))
+            self.db_info["available_rooms"].config(text=str(rooms.get('available', 0)))
+            self.db_info["occupied_rooms"].config(text=str(rooms.get('occupied', 0)))
             
             # Statistiche sveglie
-            alarms = self.db.get_alarms()
-            scheduled_alarms = len([a for a in alarms if a[4] == 'scheduled'])
-            completed_alarms = len([a for a in alarms if a[4] == 'completed'])
-            
-            self.db_info["scheduled_alarms"].config(text=str(scheduled_alarms))
-            self.db_info["completed_alarms"].config(text=str(completed_alarms))
-            
-            # Messaggi audio
-            audio_messages = self.db.get_audio_messages()
-            self.db_info["audio_messages"].config(text=str(len(audio_messages)))
+            alarms = stats['alarms_by_status']
+            self.db_info["scheduled_alarms"].config(text=str(alarms.get('scheduled', 0)))
+            self.db_info["completed_alarms"].config(text=str(alarms.get('completed', 0)))
             
-            # Log chiamate (approssimativo)
-            self.db_info["call_logs"].config(text="N/A")
+            # Messaggi audio e log chiamate
+            self.db_info["audio_messages"].config(text=str(stats['audio_messages']))
+            self.db_info["call_logs"].config(text=str(stats['call_logs']))
             
         except Exception as e:
             self.db_info["connection"].config(text="Errore", foreground="red")
@@ -399,37 +397,54 @@ class SystemMonitorWindow:
             self.pbx_info["connection"].config(text="Errore", foreground="red")
             print(f"Errore aggiornamento info PBX: {e}")
     
-    def update_alarms_info(self):
-        """Aggiorna le informazioni sveglie"""
+    def update_alarms_info(self, stats=None):
+        """Aggiorna le informazioni sveglie (stats: risultato di get_dashboard_stats)"""
         try:
             # Gestore attivo
             self.alarms_info["manager_active"].config(text="Sì", foreground="green")
             
             # Statistiche sveglie
-            alarms = self.db.get_alarms()
-            scheduled_alarms = [a for a in alarms if a[4] == 'scheduled']
-            executing_alarms = [a for a in alarms if a[4] == 'executing']
-            completed_today = [a for a in alarms if a[4] == 'completed']
-            snoozed_alarms = [a for a in alarms if a[4] == 'snoozed']
-            failed_alarms = [a for a in alarms if a[4] == 'failed']
+            stats = stats or self.db.get_dashboard_stats()
+            alarms = stats['alarms_by_status']
             
-            self.alarms_info["queued_alarms"].config(text=str(len(scheduled_alarms)))
-            self.alarms_info["executing_alarms"].config(text=str(len(executing_alarms)))
-            self.alarms_info["completed_today"].config(text=str(len(completed_today)))
-            self.alarms_info["snoozed_alarms"].config(text=str(len(snoozed_alarms)))
-            self.alarms_info["failed_alarms"].config(text=str(len(failed_alarms)))
+            self.alarms_info["queued_alarms"].config(text=str(alarms.get('scheduled', 0)))
+            self.alarms_info["executing_alarms"].config(text=str(alarms.get('executing', 0)))
+            self.alarms_info["completed_today"].config(text=str(stats['completed_today']))
+            self.alarms_info["snoozed_alarms"].config(text=str(alarms.get('snoozed', 0)))
+            self.alarms_info["failed_alarms"].config(text=str(alarms.get('failed', 0)))
             
             # Prossima sveglia
-            if scheduled_alarms:
-                next_alarm = min(scheduled_alarms, key=lambda x: x[2])
-                alarm_time = datetime.datetime.fromisoformat(next_alarm[2])
-                self.alarms_info["next_alarm"].config(text=alarm_time.strftime("%H:%M:%S"))
+            if stats['next_alarm']:
+                self.alarms_info["next_alarm"].config(text=stats['next_alarm'].strftime("%H:%M:%S"))
             else:
                 self.alarms_info["next_alarm"].config(text="Nessuna")
             
             # Ultima esecuzione
             self.alarms_info["last_execution"].config(text="N/A")
             
+            # Coda del dispatcher (dimensionamento per i picchi del mattino)
+            dispatch = self.alarm_manager.get_dispatch_stats()
+            self.alarms_info["dispatch_queue"].config(
+                text=f"{dispatch['queue_depth']} in coda ({dispatch['retry_depth']} retry) - "
+                     f"{dispatch['in_flight']}/{dispatch['max_concurrent']} canali, picco {dispatch['peak_in_flight']}")
+            self.alarms_info["expected_lateness"].config(
+                text=f"{dispatch['expected_lateness']:.0f}s (max osservato {dispatch['max_lateness']:.0f}s)")
+            
+            # KPI di oggi dal rollup orario (non dipende dallo storico)
+            today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            kpi = self.db.get_alarm_stats(since_ts=today.timestamp())
+            if kpi:
+                kpi = kpi[0]
+                self.alarms_info["kpi_today"].config(
+                    text=f"{kpi['calls']} chiamate - risposta {kpi['answer_rate']:.0%}, "
+                         f"rinvio {kpi['snooze_rate']:.0%}, fallite {kpi['failure_rate']:.0%}")
+                self.alarms_info["lateness_today"].config(
+                    text=f"{kpi['avg_lateness']:.0f}s (max {kpi['max_lateness']:.0f}s, "
+                         f"picco {kpi['peak_concurrent']} chiamate)")
+            else:
+                self.alarms_info["kpi_today"].config(text="Nessuna chiamata")
+                self.alarms_info["lateness_today"].config(text="N/A")
+            
         except Exception as e:
             print(f"Errore aggiornamento info sveglie: {e}")
     
@@ -539,6 +554,14 @@ class SystemMonitorWindow:
     
     def generate_system_report(self):
         """Genera un report del sistema"""
+        stats = self.db.get_dashboard_stats()
+        week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+        kpi_lines = "\n".join(
+            f"{day['period']}: {day['calls']} chiamate, risposta {day['answer_rate']:.0%}, "
+            f"rinvio {day['snooze_rate']:.0%}, fallite {day['failure_rate']:.0%}, "
+            f"ritardo medio {day['avg_lateness']:.0f}s, picco {day['peak_concurrent']}"
+            for day in self.db.get_alarm_stats(since_ts=week_ago.timestamp())
+        ) or "Nessuna chiamata"
         report = f"""
 REPORT SISTEMA - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
@@ -549,8 +572,9 @@ Memoria: {psutil.virtual_memory().percent}%
 
 === DATABASE ===
 Stato: Connesso
-Camere: {len(self.db.get_rooms())}
-Sveglie: {len(self.db.get_alarms())}
+Camere: {stats['total_rooms']}
+Sveglie: {stats['total_alarms']}
+Log Chiamate: {stats['call_logs']}
 
 === PBX ===
 Stato: {self.pbx_info['connection']['text']}
@@ -560,6 +584,9 @@ Chiamate Attive: {self.pbx_info['active_calls']['text']}
 Gestore: Attivo
 Sveglie Programmate: {self.alarms_info['queued_alarms']['text']}
 Sveglie in Esecuzione: {self.alarms_info['executing_alarms']['text']}
+
+=== ULTIMI 7 GIORNI ===
+{kpi_lines}
         """
         return report
     
@@ -0,0 +1,96 @@
+"""
+Test del controllo di ammissione delle chiamate (canali, originate al secondo, priorità)
+"""
+import threading
+import time
+
+from admission_controller import AdmissionController, AdmissionTicket
+
+
+def _acquire_all(controller, count):
+    """Acquisisce count ticket rilasciandoli subito: (alarm_id, istante di ammissione)"""
+    admitted = []
+    for _ in range(count):
+        ticket = controller.acquire()
+        admitted.append((ticket.alarm_id, ticket.admitted_at))
+        controller.release(ticket)
+    return admitted
+
+
+def test_first_attempts_before_retries_in_due_order():
+    controller = AdmissionController(max_concurrent=1, max_rate=0)
+    now = time.time()
+    controller.submit(AdmissionTicket('retry-old', now - 50, attempt=1, not_before=now - 40))
+    controller.submit(AdmissionTicket('late', now - 10))
+    controller.submit(AdmissionTicket('later', now - 5))
+    controller.submit(AdmissionTicket('oldest', now - 20))
+
+    assert [alarm_id for alarm_id, _ in _acquire_all(controller, 4)] == ['oldest', 'late', 'later', 'retry-old']
+    stats = controller.get_stats()
+    assert stats['admitted_total'] == 4 and stats['max_lateness'] >= 20
+
+
+def test_originate_rate_limit():
+    controller = AdmissionController(max_concurrent=10, max_rate=10.0)
+    now = time.time()
+    for i in range(5):
+        controller.submit(AdmissionTicket(i, now))
+
+    admitted = _acquire_all(controller, 5)
+    gaps = [second - first for (_, first), (_, second) in zip(admitted, admitted[1:])]
+    # Originate distanziate di almeno 1/max_rate secondi
+    assert all(gap >= 0.099 for gap in gaps), gaps
+
+
+def test_max_concurrent_and_not_before():
+    controller = AdmissionController(max_concurrent=2, max_rate=0)
+    now = time.time()
+    for i in range(3):
+        controller.submit(AdmissionTicket(i, now))
+
+    first, second = controller.acquire(), controller.acquire()
+    assert controller.get_stats()['in_flight'] == 2
+
+    # Il terzo attende che si liberi un canale
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(controller.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive() and not result
+    controller.release(first)
+    waiter.join(2)
+    assert result[0].alarm_id == 2
+    assert controller.get_stats()['peak_in_flight'] == 2
+    controller.release(second)
+    controller.release(result[0])
+
+    # Un retry non è ammesso prima di not_before
+    controller.submit(AdmissionTicket(3, now, attempt=1, not_before=time.time() + 0.2))
+    start = time.time()
+    ticket = controller.acquire()
+    assert ticket.alarm_id == 3 and time.time() - start >= 0.19
+    controller.release(ticket)
+
+
+def test_close_releases_waiting_workers():
+    controller = AdmissionController(max_concurrent=1, max_rate=0)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(controller.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    controller.close()
+    waiter.join(2)
+    assert result == [None]
+
+    # Dopo reopen le sveglie ancora in coda vengono ammesse
+    controller.submit(AdmissionTicket(1, time.time()))
+    assert controller.acquire() is None
+    controller.reopen()
+    assert controller.acquire().alarm_id == 1
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,201 @@
+"""
+Test dello scheduler delle sveglie (heap con resync) e dei percorsi di
+esecuzione (risposta, snooze, retry, cancellazione) con un PBX finto
+"""
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import call_dispatcher
+from alarm_manager import AlarmManager
+from call_dispatcher import CallDispatcher
+from database import DatabaseManager
+from extension_status import ExtensionStatusService
+from pbx_connection import PBXConnection, PBXManager
+
+
+class FakePBXConnection(PBXConnection):
+    """
+    PBXConnection senza centralino: ogni chiamata registra (interno, istante)
+    e restituisce il prossimo esito impostato per l'interno in outcomes
+    ((success, dtmf); default risposta senza tasto). Un Event in gates
+    trattiene la chiamata finché non viene impostato.
+    """
+
+    calls = []
+    outcomes = {}
+    gates = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config=None):
+        super().__init__({})
+
+    @classmethod
+    def reset(cls):
+        cls.calls = []
+        cls.outcomes = {}
+        cls.gates = {}
+
+    def play_audio_with_dtmf(self, phone_extension, audio_file_path, snooze_5_audio=None,
+                             snooze_10_audio=None, timeout=30):
+        with self._lock:
+            self.calls.append((phone_extension, time.time()))
+            pending = self.outcomes.get(phone_extension)
+            outcome = pending.pop(0) if pending else (True, None)
+        gate = self.gates.get(phone_extension)
+        if gate is not None:
+            gate.wait(5)
+        return outcome
+
+    def sync_audio_files(self, paths):
+        return True, "Nessun audio da caricare"
+
+    def execute_cli_batch(self, cli_commands):
+        raise ConnectionError("Centralino di test")
+
+
+def _setup(max_workers=1, max_retries=2, retry_delay=0.2):
+    """AlarmManager su un database temporaneo, con PBX finto e dispatcher veloce"""
+    FakePBXConnection.reset()
+    call_dispatcher.PBXConnection = FakePBXConnection
+
+    db = DatabaseManager(os.path.join(tempfile.mkdtemp(), "test_scheduler.db"))
+    for i in range(1, 6):
+        db.add_room(f"90{i}", phone_extension=f"20{i}")
+
+    pbx = PBXManager()
+    pbx.pbx = FakePBXConnection()
+    manager = AlarmManager(db, pbx)
+    manager.extension_status = ExtensionStatusService(FakePBXConnection(), interval=30)
+    manager.max_retries = max_retries
+    manager.dispatcher = CallDispatcher(manager._run_alarm, max_workers=max_workers, max_rate=0,
+                                        max_retries=max_retries, retry_delay=retry_delay, call_timeout=5)
+    return db, manager
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _teardown(manager):
+    manager.stop()
+    call_dispatcher.PBXConnection = PBXConnection
+
+
+def test_alarms_fire_in_due_order():
+    db, manager = _setup()
+    try:
+        now = datetime.now()
+        manager.start()
+        # Inserite in ordine diverso da quello di scadenza, una molto lontana
+        for room, delay in (("903", 0.6), ("901", 0.2), ("902", 0.4), ("904", 3600)):
+            manager.add_alarm(room, now + timedelta(seconds=delay))
+
+        assert _wait_for(lambda: len(FakePBXConnection.calls) == 3)
+        extensions = [extension for extension, _ in FakePBXConnection.calls]
+        assert extensions == ["201", "202", "203"]
+        # Nessuna chiamata prima dell'orario
+        for (extension, fired), delay in zip(FakePBXConnection.calls, (0.2, 0.4, 0.6)):
+            assert fired >= now.timestamp() + delay - 0.05
+        assert _wait_for(lambda: [a.status for a in db.get_alarms()][:3] == ['completed'] * 3)
+        assert db.get_alarm(4).status == 'scheduled'
+    finally:
+        _teardown(manager)
+
+
+def test_resync_keeps_alarms_changed_during_load():
+    db, manager = _setup()
+    now = datetime.now()
+    kept = manager.add_alarm("901", now + timedelta(minutes=5))
+    removed = manager.add_alarm("902", now + timedelta(minutes=6))
+
+    # Durante la lettura dal database arrivano una nuova sveglia e una cancellazione
+    get_due_alarms = db.get_due_alarms
+    added = []
+
+    def get_due_alarms_with_changes(until_ts, since_ts=None):
+        alarms = get_due_alarms(until_ts, since_ts)
+        added.append(manager.add_alarm("903", now + timedelta(minutes=7)))
+        manager.cancel_alarm(removed)
+        return alarms
+
+    db.get_due_alarms = get_due_alarms_with_changes
+    manager._load_schedule()
+
+    assert set(manager._scheduled_times) == {kept, added[0]}
+    assert sorted(alarm_id for _, alarm_id in manager._alarm_heap if alarm_id in manager._scheduled_times) == \
+        sorted([kept, added[0]])
+
+
+def test_snooze_and_retry_paths():
+    db, manager = _setup(max_workers=2)
+    FakePBXConnection.outcomes = {
+        "201": [(True, '1')],                                  # rinvio di 5 minuti
+        "202": [(False, None), (True, None)],                   # risposta al primo retry
+        "203": [(False, None), (False, None), (False, None)],   # mai risposta
+    }
+    try:
+        manager.start()
+        now = datetime.now()
+        snoozed = manager.add_alarm("901", now)
+        retried = manager.add_alarm("902", now)
+        failed = manager.add_alarm("903", now)
+
+        assert _wait_for(lambda: db.get_alarm(failed).status == 'failed')
+        assert db.get_alarm(snoozed).status == 'snoozed'
+        assert db.get_alarm(retried).status == 'completed'
+
+        times = {}
+        for extension, fired in FakePBXConnection.calls:
+            times.setdefault(extension, []).append(fired)
+        assert len(times["201"]) == 1
+        assert len(times["202"]) == 2
+        # Tentativo iniziale + max_retries, distanziati di almeno retry_delay
+        assert len(times["203"]) == 3
+        for first, second in zip(times["203"], times["203"][1:]):
+            assert second - first >= 0.2
+
+        # Il rinvio è una nuova sveglia programmata con snooze_count incrementato
+        new_alarm = [a for a in db.get_alarms('scheduled') if a.room_number == "901"]
+        assert len(new_alarm) == 1 and new_alarm[0].snooze_count == 1
+        assert new_alarm[0].id in manager._scheduled_times
+    finally:
+        _teardown(manager)
+
+
+def test_cancel_refused_while_call_in_progress():
+    db, manager = _setup()
+    FakePBXConnection.outcomes = {"201": [(False, None)]}
+    FakePBXConnection.gates = {"201": threading.Event()}
+    try:
+        manager.start()
+        alarm_id = manager.add_alarm("901", datetime.now())
+        assert _wait_for(lambda: db.get_alarm(alarm_id).status == 'executing')
+
+        success, message = manager.cancel_alarm(alarm_id)
+        assert not success and "in corso" in message
+
+        # La chiamata fallisce: la sveglia torna programmata per il retry, non resta cancellata
+        FakePBXConnection.gates["201"].set()
+        assert _wait_for(lambda: db.get_alarm(alarm_id).status == 'scheduled')
+
+        # Tra un tentativo e l'altro la cancellazione vale e il retry viene saltato
+        success, message = manager.cancel_alarm(alarm_id)
+        assert success, message
+        time.sleep(0.4)
+        assert db.get_alarm(alarm_id).status == 'cancelled'
+        assert len(FakePBXConnection.calls) == 1
+    finally:
+        _teardown(manager)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
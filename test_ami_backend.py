@@ -0,0 +1,514 @@
+"""
+Test del backend AMI contro un server AMI finto in locale e confronto
+con il backend SSH (latenza originate -> esito e processi avviati sul PBX)
+
+Uso: python test_ami_backend.py [--bench N]
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import resource
+
+import pbx_backend
+from ami_backend import AMIBackend, AMIParser, close_all_sessions
+from pbx_backend import SSHBackend, NO_ANSWER
+
+
+ANSWER_DELAY = 0.01  # secondi tra originate e risposta/tasto simulati
+
+
+class FakeAMIServer:
+    """
+    Server AMI minimo: Login, Ping, Command e Originate asincrono.
+
+    L'esito di ogni Originate (per Exten = call_id) si imposta in outcomes:
+    '1'/'2' tasto premuto, 'H' chiusura senza tasto, None nessuna risposta.
+    Gli eventi sono generati come da Asterisk 13+, con rumore di altre chiamate.
+    Le azioni che arrivano prima della risposta al Login (ritardata di
+    login_delay secondi) sono rifiutate come da Asterisk.
+    """
+
+    def __init__(self, secret='secret', follows=False, login_delay=0.0):
+        self.secret = secret
+        self.follows = follows
+        self.login_delay = login_delay
+        self.authenticated = set()
+        self.outcomes = {}
+        self.actions = []
+        self.originates = []
+        self.connections = 0
+        self.clients = []
+        self._lock = threading.Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def config(self, **overrides):
+        config = {'host': '127.0.0.1', 'ami_port': self.port, 'ami_username': 'sveglie',
+                  'ami_secret': self.secret, 'timeout': 5, 'keepalive_interval': 30}
+        config.update(overrides)
+        return config
+
+    def drop_clients(self):
+        for client in list(self.clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.drop_clients()
+        # shutdown sblocca accept() prima della chiusura del descrittore
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+            self.clients.append(client)
+            threading.Thread(target=self._client_loop, args=(client,), daemon=True).start()
+
+    def _send(self, client, fields):
+        data = ''.join(f"{key}: {value}\r\n" for key, value in fields) + '\r\n'
+        with self._lock:
+            try:
+                client.sendall(data.encode())
+            except OSError:
+                pass
+
+    def _client_loop(self, client):
+        client.sendall(b"Asterisk Call Manager/5.0.1\r\n")
+        parser = AMIParser()
+        while True:
+            try:
+                data = client.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                client.close()
+                return
+            if b'Action: Originate' in data:
+                self.originates.append(data.decode())
+            for action in parser.feed(data):
+                self.actions.append(action.get('Action'))
+                self._handle(client, action)
+
+    def _handle(self, client, action):
+        name = action.get('Action')
+        action_id = action.get('ActionID')
+        if name == 'Login':
+            if self.login_delay:
+                threading.Timer(self.login_delay, self._login, args=(client, action)).start()
+            else:
+                self._login(client, action)
+        elif client not in self.authenticated:
+            self._send(client, [('Response', 'Error'), ('ActionID', action_id),
+                                ('Message', 'Permission denied')])
+        elif name == 'Ping':
+            self._send(client, [('Response', 'Success'), ('ActionID', action_id), ('Ping', 'Pong')])
+        elif name == 'Command':
+            lines = [f"Eseguito: {action.get('Command')}", "Campo: valore", "", "fine"]
+            if self.follows:
+                body = (f"Response: Follows\r\nPrivilege: Command\r\nActionID: {action_id}\r\n"
+                        + '\r\n'.join(lines) + "\r\n--END COMMAND--\r\n\r\n")
+                with self._lock:
+                    client.sendall(body.encode())
+            else:
+                self._send(client, [('Response', 'Success'), ('ActionID', action_id),
+                                    ('Message', 'Command output follows')]
+                           + [('Output', line) for line in lines])
+        elif name == 'Originate':
+            self._send(client, [('Response', 'Success'), ('ActionID', action_id),
+                                ('Message', 'Originate successfully queued')])
+            threading.Timer(ANSWER_DELAY, self._play_call, args=(client, action)).start()
+
+    def _login(self, client, action):
+        if action.get('Secret') == self.secret:
+            self.authenticated.add(client)
+            self._send(client, [('Response', 'Success'), ('ActionID', action.get('ActionID')),
+                                ('Message', 'Authentication accepted')])
+        else:
+            self._send(client, [('Response', 'Error'), ('ActionID', action.get('ActionID')),
+                                ('Message', 'Authentication failed')])
+
+    def _play_call(self, client, action):
+        call_id = action.get('Exten')
+        channel_id = action.get('ChannelId') or f"local-{call_id}"
+        other_id = action.get('OtherChannelId') or f"{channel_id}-2"
+        phone_id = f"pjsip-{call_id}"
+        outcome = self.outcomes.get(call_id, 'H')
+
+        # Rumore di un'altra chiamata
+        self._send(client, [('Event', 'DTMFEnd'), ('Uniqueid', 'altro'), ('Linkedid', 'altro'),
+                            ('Digit', '1'), ('Direction', 'Received')])
+
+        if outcome is None:
+            self._send(client, [('Event', 'Hangup'), ('Uniqueid', channel_id), ('Linkedid', channel_id)])
+            self._send(client, [('Event', 'OriginateResponse'), ('ActionID', action.get('ActionID')),
+                                ('Response', 'Failure'), ('Uniqueid', '<null>'), ('Reason', '3')])
+            return
+
+        self._send(client, [('Event', 'OriginateResponse'), ('ActionID', action.get('ActionID')),
+                            ('Response', 'Success'), ('Channel', action.get('Channel')),
+                            ('Uniqueid', channel_id), ('Reason', '4')])
+        if outcome in ('1', '2'):
+            # Tasto inoltrato dal canale Local (Sent) e ricevuto dal telefono
+            self._send(client, [('Event', 'DTMFEnd'), ('Uniqueid', other_id), ('Linkedid', channel_id),
+                                ('Digit', outcome), ('Direction', 'Sent')])
+            self._send(client, [('Event', 'DTMFEnd'), ('Uniqueid', phone_id), ('Linkedid', channel_id),
+                                ('Digit', outcome), ('Direction', 'Received'), ('DurationMs', '120')])
+        for uniqueid in (phone_id, other_id, channel_id):
+            self._send(client, [('Event', 'Hangup'), ('Uniqueid', uniqueid), ('Linkedid', channel_id),
+                                ('Cause', '16')])
+
+
+def _originate(backend, call_id):
+    return backend.originate("Local/130@from-internal/n", 'wakeup-service', call_id,
+                             "Servizio Sveglie <999>", call_id=call_id, timeout=30,
+                             variables={'WAKE_AUDIO': 'custom/wakeup_it'})
+
+
+def test_parser_handles_both_command_formats():
+    parser = AMIParser()
+    stream = (b"Response: Follows\r\nPrivilege: Command\r\nActionID: 7\r\n"
+              b"Name: 130\r\n\r\nriga finale\r\n--END COMMAND--\r\n\r\n"
+              b"Response: Success\r\nActionID: 8\r\nOutput: a: b\r\nOutput: c\r\n\r\n"
+              b"Event: Hangup\r\nUniqueid: 1.2\r\n\r\n")
+    messages = []
+    # Consegna a pezzi: i messaggi non devono dipendere dai confini dei pacchetti
+    for i in range(0, len(stream), 5):
+        messages += parser.feed(stream[i:i + 5])
+    assert len(messages) == 3
+    assert messages[0]['ActionID'] == '7'
+    assert messages[0]['Output'] == "Name: 130\n\nriga finale"
+    assert messages[1]['Output'] == "a: b\nc"
+    assert messages[2] == {'Event': 'Hangup', 'Uniqueid': '1.2'}
+
+
+def test_commands_share_one_session():
+    for follows in (False, True):
+        server = FakeAMIServer(follows=follows)
+        try:
+            config = server.config()
+            first, second = AMIBackend(config), AMIBackend(dict(config))
+            assert first.test()[0]
+            output, error = first.command('core show channels')
+            assert error is None and output.startswith("Eseguito: core show channels")
+            output, error = second.command('core show uptime')
+            assert error is None and "\n\nfine" in output
+            assert server.connections == 1
+            assert server.actions.count('Login') == 1
+        finally:
+            close_all_sessions()
+            server.close()
+
+
+def test_command_batch_is_one_round_trip():
+    # AMI: azioni Command in pipeline, risposte nell'ordine dei comandi
+    server = FakeAMIServer()
+    try:
+        backend = AMIBackend(server.config())
+        commands = [f"core show uptime {i}" for i in range(10)]
+        results = backend.command_batch(commands)
+        assert [output.split('\n')[0] for output, error in results] == [f"Eseguito: {c}" for c in commands]
+        assert server.actions.count('Command') == 10
+    finally:
+        close_all_sessions()
+        server.close()
+
+    # SSH: un solo comando remoto, output separati dai marcatori
+    class ShellConnection:
+        def __init__(self):
+            self.commands = []
+
+        def execute_command(self, command):
+            self.commands.append(command)
+            fake_asterisk = ('asterisk() { case "$2" in fail*) echo "errore $2"; return 1;; '
+                             'empty*) ;; nonl*) printf "senza a capo";; *) printf "riga: %s\\n\\n" "$2";; esac; }; ')
+            result = subprocess.run(['sh', '-c', fake_asterisk + command], capture_output=True, text=True)
+            return result.stdout, None
+
+    connection = ShellConnection()
+    results = SSHBackend(connection).command_batch(
+        ["core show version", "fail now", "empty", "nonl", "sip show peer 'x'"])
+    assert len(connection.commands) == 1
+    assert results == [("riga: core show version\n\n", None), (None, "errore fail now"), ("", None),
+                       ("senza a capo\n", None), ("riga: sip show peer 'x'\n\n", None)]
+
+
+def test_concurrent_calls_get_their_own_result():
+    server = FakeAMIServer()
+    try:
+        backend = AMIBackend(server.config())
+        expected = {}
+        for i in range(30):
+            call_id = str(9000 + i)
+            expected[call_id] = ('1', '2', 'H', None)[i % 4]
+        server.outcomes.update(expected)
+        # OriginateResponse Failure: chiamata non risposta
+        expected = {call_id: NO_ANSWER if outcome is None else outcome for call_id, outcome in expected.items()}
+
+        results = {}
+
+        def run(call_id):
+            success, message = _originate(backend, call_id)
+            assert success, message
+            results[call_id] = backend.wait_call_result(call_id, 5)
+
+        threads = [threading.Thread(target=run, args=(call_id,)) for call_id in expected]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == expected
+        assert server.connections == 1
+        # Nessuna chiamata rimasta in memoria
+        assert not backend.session._calls and not backend.session._calls_by_channel
+    finally:
+        close_all_sessions()
+        server.close()
+
+
+def test_connection_loss_releases_waiting_calls():
+    server = FakeAMIServer()
+    try:
+        backend = AMIBackend(server.config())
+        server.outcomes['777'] = '1'
+        global ANSWER_DELAY
+        delay, ANSWER_DELAY = ANSWER_DELAY, 5
+        try:
+            assert _originate(backend, '777')[0]
+        finally:
+            ANSWER_DELAY = delay
+        server.drop_clients()
+        start = time.monotonic()
+        assert backend.wait_call_result('777', 10) is None
+        assert time.monotonic() - start < 2
+        assert not backend.is_connected()
+        # Nuova connessione alla richiesta successiva
+        assert backend.connect(force=True)
+        assert backend.command('core show uptime')[1] is None
+        assert server.connections == 2
+    finally:
+        close_all_sessions()
+        server.close()
+
+
+def test_login_rejected():
+    server = FakeAMIServer()
+    try:
+        backend = AMIBackend(server.config(ami_secret='sbagliato'))
+        assert not backend.connect(force=True)
+        success, message = backend.test()
+        assert not success and "Authentication failed" in message
+    finally:
+        close_all_sessions()
+        server.close()
+
+
+def test_actions_wait_for_login():
+    # Login lento: chi arriva durante il login attende la sessione autenticata
+    server = FakeAMIServer(login_delay=0.3)
+    try:
+        backend = AMIBackend(server.config())
+        results = []
+
+        def run(i):
+            results.append(backend.command(f"core show uptime {i}"))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 10
+        assert all(error is None for output, error in results), results
+        assert server.actions.count('Login') == 1
+        assert server.connections == 1
+    finally:
+        close_all_sessions()
+        server.close()
+
+
+class _LocalSSHConnection:
+    """
+    Connessione SSH simulata in locale per il confronto: i comandi sono
+    eseguiti dalla shell locale (un processo ciascuno, come sul PBX) con la
+    spool di Asterisk in una directory temporanea. Il finto Asterisk legge
+    i call file e fa scrivere al "dialplan" il file esito dopo ANSWER_DELAY.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.processes = 0
+        self.commands = []
+        self.outgoing = os.path.join(pbx_backend.ASTERISK_SPOOL_DIR, 'outgoing')
+        os.makedirs(self.outgoing, exist_ok=True)
+
+    def execute_command(self, command):
+        self.processes += 1
+        self.commands.append(command)
+        if command.startswith('asterisk -rx'):
+            subprocess.run(['sh', '-c', 'true'], check=True)
+            return "", None
+        result = subprocess.run(['sh', '-c', command], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr
+        for name in os.listdir(self.outgoing):
+            self._process_call_file(os.path.join(self.outgoing, name))
+        return result.stdout, None
+
+    def _process_call_file(self, path):
+        with open(path) as f:
+            fields = [line.rstrip('\n').split(': ', 1) for line in f if ': ' in line]
+        os.remove(path)
+        call_id = dict(fields)['Extension']
+        variables = dict(value.split('=', 1) for key, value in fields if key == 'Setvar')
+        outcome = self.outcomes.get(call_id, 'H')
+        if variables.get('WAKE_RESULT_FILE') == '1':
+            # Non risposta: l'extension failed scrive NOANSWER per WAKE_CALL_ID
+            if outcome is None:
+                call_id, outcome = variables['WAKE_CALL_ID'], NO_ANSWER
+            threading.Timer(ANSWER_DELAY, self._write_result, args=(call_id, outcome)).start()
+
+    @staticmethod
+    def _write_result(call_id, outcome):
+        with open(f"/tmp/asterisk_dtmf_{call_id}.txt", 'w') as f:
+            f.write(outcome)
+
+
+def _with_local_spool(function):
+    """Esegue function con la spool di Asterisk in una directory temporanea"""
+    spool_dir = pbx_backend.ASTERISK_SPOOL_DIR
+    pbx_backend.ASTERISK_SPOOL_DIR = tempfile.mkdtemp()
+    try:
+        return function()
+    finally:
+        pbx_backend.ASTERISK_SPOOL_DIR = spool_dir
+
+
+def test_originate_carries_channel_variables():
+    variables = {'WAKE_AUDIO': 'custom/wakeup_it', 'SNOOZE_5_AUDIO': "custom/l'hotel_5"}
+
+    # SSH: un solo comando remoto (call file) con le variabili
+    def run_ssh():
+        connection = _LocalSSHConnection({'8801': '2', '8803': None})
+        backend = SSHBackend(connection)
+        assert backend.originate("Local/130@from-internal/n", 'wakeup-service', '8801',
+                                 "L'Hotel <999>", call_id='8801', timeout=30, variables=variables)[0]
+        assert len(connection.commands) == 1
+        assert backend.wait_call_result('8801', 5) == '2'
+        # Non risposta: esito NOANSWER subito, senza attendere il timeout
+        assert backend.originate("Local/131@from-internal/n", 'wakeup-service', '8803',
+                                 "L'Hotel <999>", call_id='8803', timeout=30, variables=variables)[0]
+        start = time.monotonic()
+        assert backend.wait_call_result('8803', 5) == NO_ANSWER
+        assert time.monotonic() - start < 2
+        return connection.commands[0]
+
+    command = _with_local_spool(run_ssh)
+    assert "Setvar: SNOOZE_5_AUDIO=custom/l" in command and "WaitTime: 30" in command
+    assert "Setvar: WAKE_CALL_ID=8801" in command
+
+    # AMI: una riga Variable per variabile nella stessa azione Originate
+    server = FakeAMIServer()
+    try:
+        server.outcomes['8802'] = '1'
+        backend = AMIBackend(server.config())
+        assert backend.originate("Local/130@from-internal/n", 'wakeup-service', '8802',
+                                 "Servizio Sveglie <999>", call_id='8802', variables=variables)[0]
+        assert backend.wait_call_result('8802', 5) == '1'
+        assert "Variable: WAKE_AUDIO=custom/wakeup_it\r\n" in server.originates[0]
+        assert "Variable: SNOOZE_5_AUDIO=custom/l'hotel_5\r\n" in server.originates[0]
+    finally:
+        close_all_sessions()
+        server.close()
+
+
+def _measure(backend, call_ids, max_wait):
+    latencies = []
+    for call_id in call_ids:
+        start = time.perf_counter()
+        success, message = _originate(backend, call_id)
+        assert success, message
+        result = backend.wait_call_result(call_id, max_wait)
+        latencies.append(time.perf_counter() - start)
+        assert result == '1', result
+    latencies.sort()
+    return latencies
+
+
+def benchmark(calls=50):
+    """
+    Latenza originate -> esito (tasto 1) e processi avviati sul PBX per chiamata
+
+    Returns:
+        dict backend -> (media s, p95 s, processi per chiamata)
+    """
+    results = {}
+
+    server = FakeAMIServer()
+    try:
+        call_ids = [str(50000 + i) for i in range(calls)]
+        server.outcomes.update({call_id: '1' for call_id in call_ids})
+        backend = AMIBackend(server.config())
+        backend.connect()
+        latencies = _measure(backend, call_ids, 5)
+        # AMI: nessun processo sul PBX, solo azioni sulla sessione esistente
+        results['ami'] = (sum(latencies) / calls, latencies[int(calls * 0.95) - 1], 0.0)
+    finally:
+        close_all_sessions()
+        server.close()
+
+    call_ids = [str(60000 + i) for i in range(calls)]
+
+    def run_ssh():
+        connection = _LocalSSHConnection({call_id: '1' for call_id in call_ids})
+        return connection, _measure(SSHBackend(connection), call_ids, 5)
+
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    connection, latencies = _with_local_spool(run_ssh)
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results['ssh'] = (sum(latencies) / calls, latencies[int(calls * 0.95) - 1], connection.processes / calls)
+    ssh_cpu = (cpu_after.ru_utime + cpu_after.ru_stime) - (cpu_before.ru_utime + cpu_before.ru_stime)
+
+    for name, (mean, p95, processes) in results.items():
+        print(f"{name}: media {mean * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, "
+              f"processi PBX per chiamata {processes:.1f}")
+    print(f"ssh: CPU dei processi simulati {ssh_cpu * 1000 / calls:.2f} ms per chiamata")
+    return results
+
+
+def test_benchmark_runs():
+    results = benchmark(calls=5)
+    assert results['ami'][2] == 0
+    assert results['ssh'][2] >= 2
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--bench':
+        benchmark(int(sys.argv[2]))
+        sys.exit(0)
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
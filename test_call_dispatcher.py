@@ -0,0 +1,130 @@
+"""
+Test del pool di worker delle chiamate di sveglia (CallDispatcher)
+"""
+import threading
+import time
+
+import call_dispatcher
+from call_dispatcher import CallDispatcher
+from pbx_connection import PBXConnection
+
+
+class FakePBXConnection(PBXConnection):
+    """Sessione PBX del worker: nessuna connessione reale"""
+
+    def __init__(self, config=None):
+        super().__init__({})
+
+
+class Recorder:
+    """Callback dei worker: registra le esecuzioni e il picco di chiamate contemporanee"""
+
+    def __init__(self, duration=0.1, retries=None):
+        self.duration = duration
+        self.retries = retries or {}   # alarm_id -> esecuzioni da ritentare
+        self.runs = []
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, ticket, pbx):
+        assert isinstance(pbx, FakePBXConnection)
+        with self._lock:
+            self.runs.append((ticket.alarm_id, ticket.attempt, time.time()))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.duration)
+        with self._lock:
+            self.active -= 1
+            if self.retries.get(ticket.alarm_id, 0) > 0:
+                self.retries[ticket.alarm_id] -= 1
+                return True
+        return False
+
+
+def _dispatcher(recorder, **kwargs):
+    call_dispatcher.PBXConnection = FakePBXConnection
+    options = dict(max_workers=3, max_rate=0, max_retries=3, retry_delay=0.2, call_timeout=5)
+    options.update(kwargs)
+    return CallDispatcher(recorder, **options)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _workers():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("alarm-worker")]
+
+
+def test_max_concurrent_calls():
+    recorder = Recorder(duration=0.1)
+    dispatcher = _dispatcher(recorder)
+    dispatcher.start()
+    try:
+        for alarm_id in range(10):
+            assert dispatcher.submit(alarm_id)
+        # Una sveglia già in coda non viene accodata due volte
+        assert not dispatcher.submit(9)
+        assert _wait_for(lambda: len(recorder.runs) == 10 and not dispatcher.is_pending(9))
+        assert recorder.peak == 3
+        assert dispatcher.get_stats()['peak_in_flight'] == 3
+    finally:
+        dispatcher.stop()
+        call_dispatcher.PBXConnection = PBXConnection
+
+
+def test_retry_after_retry_delay():
+    recorder = Recorder(duration=0.01, retries={1: 2})
+    dispatcher = _dispatcher(recorder)
+    dispatcher.start()
+    try:
+        dispatcher.submit(1)
+        assert _wait_for(lambda: len(recorder.runs) == 3 and not dispatcher.is_pending(1))
+        assert [attempt for _, attempt, _ in recorder.runs] == [0, 1, 2]
+        for (_, _, first), (_, _, second) in zip(recorder.runs, recorder.runs[1:]):
+            assert second - first >= 0.2
+
+        # Oltre max_retries la sveglia non viene più ritentata
+        recorder.retries[2] = 10
+        dispatcher.submit(2)
+        assert _wait_for(lambda: not dispatcher.is_pending(2))
+        assert [attempt for alarm_id, attempt, _ in recorder.runs if alarm_id == 2] == [0, 1, 2, 3]
+    finally:
+        dispatcher.stop()
+        call_dispatcher.PBXConnection = PBXConnection
+
+
+def test_stop_waits_for_calls_and_restart_keeps_one_pool():
+    recorder = Recorder(duration=0.3)
+    dispatcher = _dispatcher(recorder)
+    dispatcher.start()
+    try:
+        dispatcher.submit(1)
+        assert _wait_for(lambda: recorder.active == 1)
+        dispatcher.stop()
+        # La chiamata in corso è terminata prima del ritorno di stop()
+        assert recorder.active == 0 and not _workers()
+
+        # Stop con attesa troppo breve: il riavvio attende i worker rimasti
+        dispatcher.start()
+        dispatcher.submit(2)
+        assert _wait_for(lambda: recorder.active == 1)
+        dispatcher.stop(timeout=0.01)
+        assert dispatcher._workers
+        dispatcher.start()
+        assert recorder.active == 0
+        assert len(_workers()) == 3
+    finally:
+        dispatcher.stop()
+        call_dispatcher.PBXConnection = PBXConnection
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,136 @@
+"""
+Verifica che le query di scheduler e interfaccia usino gli indici secondari
+(EXPLAIN QUERY PLAN sulle query realmente eseguite dal DatabaseManager)
+"""
+import os
+import tempfile
+import datetime
+from database import DatabaseManager, SCHEMA_VERSION
+
+
+def _setup_db():
+    """Database temporaneo con qualche riga in ogni tabella"""
+    db_path = os.path.join(tempfile.mkdtemp(), "test_indexes.db")
+    db = DatabaseManager(db_path)
+
+    now = datetime.datetime.now()
+    audio_id = db.add_audio_message("sveglia it", "audio_messages/wakeup_it.wav", language='it', action_type='wake_up')
+    for i in range(20):
+        alarm_time = (now + datetime.timedelta(minutes=i)).isoformat()
+        alarm_id = db.add_alarm(f"1{101 + i}", alarm_time, audio_id)
+        db.add_call_log(alarm_id, f"1{101 + i}", now, status='initiated')
+    return db
+
+
+def _query_plans(db, operation):
+    """
+    Esegue operation(db) registrando le query SELECT e ne restituisce il piano
+
+    Returns:
+        lista di (query, dettaglio piano)
+    """
+    conn = db.get_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        operation(db)
+    finally:
+        conn.set_trace_callback(None)
+
+    plans = []
+    for statement in statements:
+        if not statement.lstrip().upper().startswith("SELECT"):
+            continue
+        # Python < 3.11 non espande i parametri nel trace: vanno bene valori nulli
+        params = [None] * statement.count("?")
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {statement}", params).fetchall()
+        plans.append((statement, " | ".join(row[-1] for row in rows)))
+    return plans
+
+
+def _assert_uses_index(db, operation, index_name):
+    plans = _query_plans(db, operation)
+    assert plans, "nessuna query eseguita"
+    for statement, plan in plans:
+        assert index_name in plan, f"{statement!r} non usa {index_name}: {plan}"
+
+
+def test_index_version_recorded():
+    db = _setup_db()
+    conn = db.get_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for index_name in ("idx_alarms_status_epoch", "idx_alarms_room_status", "idx_rooms_extension",
+                       "idx_audio_action_language", "idx_call_logs_alarm", "idx_call_logs_time"):
+        assert index_name in names
+
+
+def test_scheduler_query_uses_status_epoch_index():
+    db = _setup_db()
+    _assert_uses_index(db, lambda d: d.get_alarms('scheduled'), "idx_alarms_status_epoch")
+    _assert_uses_index(db, lambda d: d.get_alarms(['scheduled', 'snoozed']), "idx_alarms_status_epoch")
+
+
+def test_due_window_query_is_index_range_scan():
+    db = _setup_db()
+    now_ts = datetime.datetime.now().timestamp()
+    plans = _query_plans(db, lambda d: d.get_due_alarms(now_ts + 300, now_ts - 60))
+    assert plans
+    for statement, plan in plans:
+        assert "idx_alarms_status_epoch (status=? AND alarm_epoch>? AND alarm_epoch<?)" in plan, plan
+    # Solo le sveglie nella finestra
+    assert len(db.get_due_alarms(now_ts + 270, now_ts - 60)) == 5
+
+
+def test_room_alarms_query_uses_room_status_index():
+    db = _setup_db()
+    _assert_uses_index(db, lambda d: d.get_alarms('scheduled', room_number='1101'), "idx_alarms_room_status")
+
+
+def test_extension_lookup_uses_index():
+    db = _setup_db()
+    _assert_uses_index(db, lambda d: d.get_room_by_extension('1101'), "idx_rooms_extension")
+
+
+def test_audio_lookup_uses_index():
+    db = _setup_db()
+    _assert_uses_index(db, lambda d: d.get_audio_message_by_action_and_language('wake_up', 'it'),
+                       "idx_audio_action_language")
+
+
+def test_call_log_queries_use_indexes():
+    db = _setup_db()
+    _assert_uses_index(db, lambda d: d.get_call_logs(alarm_id=1), "idx_call_logs_alarm")
+    since = datetime.datetime.now() - datetime.timedelta(hours=1)
+    _assert_uses_index(db, lambda d: d.get_call_logs(since=since), "idx_call_logs_time")
+
+
+def test_archive_queries_use_indexes():
+    db = _setup_db()
+    now = datetime.datetime.now()
+    _assert_uses_index(db, lambda d: d.archive_alarms(now.timestamp(), ['completed', 'cancelled']),
+                       "idx_alarms_status_epoch")
+    _assert_uses_index(db, lambda d: d.archive_call_logs(now - datetime.timedelta(days=1)), "idx_call_logs_time")
+
+
+def test_stale_executing_alarms_become_failed():
+    db = _setup_db()
+    now_ts = datetime.datetime.now().timestamp()
+    # Sveglie 1-3 prese da un worker; la 3 è partita da poco
+    for alarm_id in (1, 2, 3):
+        db.transition_alarm_status(alarm_id, 'scheduled', 'executing',
+                                   fired_epoch=now_ts - (10 if alarm_id == 3 else 3600))
+    _assert_uses_index(db, lambda d: d.fail_stale_alarms(now_ts - 90), "idx_alarms_status_epoch")
+
+    assert [db.get_alarm(alarm_id).status for alarm_id in (1, 2, 3, 4)] == ['failed', 'failed', 'executing', 'scheduled']
+    assert sum(row['failed'] for row in db.get_alarm_stats(group_by='hour')) == 2
+    # Ora archiviabili come le altre sveglie concluse
+    assert db.archive_alarms(now_ts + 3600, ['failed']) == 2
+    assert db.fail_stale_alarms(now_ts - 90) == 0
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
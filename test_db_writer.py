@@ -0,0 +1,104 @@
+"""
+Test dello scrittore in background (DatabaseWriter): group commit, flush e stop
+"""
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+from database import DatabaseManager
+from db_writer import DatabaseWriter
+
+
+def _setup_db():
+    db = DatabaseManager(os.path.join(tempfile.mkdtemp(), "test_writer.db"))
+    alarm_ids = [db.add_alarm("101", datetime.now().isoformat()) for _ in range(3)]
+    return db, alarm_ids
+
+
+class CountingDatabase:
+    """DatabaseManager con conteggio delle transazioni del writer"""
+
+    def __init__(self, db):
+        self.db = db
+        self.batches = []
+
+    def write_batch(self, call_logs=(), statuses=None, outcomes=()):
+        self.batches.append((len(call_logs), dict(statuses or {})))
+        self.db.write_batch(call_logs, statuses, outcomes)
+
+
+def test_flush_applies_queued_writes():
+    db, alarm_ids = _setup_db()
+    counting = CountingDatabase(db)
+    writer = DatabaseWriter(counting, commit_interval=0.05)
+    writer.start()
+    try:
+        for alarm_id in alarm_ids:
+            writer.add_call_log(alarm_id, "101", datetime.now(), status='initiated')
+            writer.update_alarm_status(alarm_id, 'executing')
+        # Prevale l'ultimo status accodato per la sveglia
+        writer.update_alarm_status(alarm_ids[0], 'completed')
+
+        assert writer.flush()
+        assert len(db.get_call_logs()) == 3
+        assert [db.get_alarm(alarm_id).status for alarm_id in alarm_ids] == ['completed', 'executing', 'executing']
+        # Scritture arrivate insieme: una sola transazione
+        assert len(counting.batches) == 1
+    finally:
+        writer.stop()
+
+
+def test_conditional_status_write():
+    db, alarm_ids = _setup_db()
+    writer = DatabaseWriter(db)
+    writer.start()
+    try:
+        db.transition_alarm_status(alarm_ids[0], 'scheduled', 'executing')
+        db.transition_alarm_status(alarm_ids[1], 'scheduled', 'cancelled')
+        # Esito del worker: vale solo se la sveglia è ancora in esecuzione
+        for alarm_id in alarm_ids[:2]:
+            writer.update_alarm_status(alarm_id, 'failed', from_status='executing')
+        assert writer.flush()
+        assert db.get_alarm(alarm_ids[0]).status == 'failed'
+        assert db.get_alarm(alarm_ids[1]).status == 'cancelled'
+    finally:
+        writer.stop()
+
+
+def test_stop_applies_writes_queued_before_stop():
+    db, alarm_ids = _setup_db()
+    writer = DatabaseWriter(db, commit_interval=0.05)
+    writer.start()
+
+    # Più thread accodano mentre un altro ferma il writer
+    barrier = threading.Barrier(5)
+
+    def producer(index):
+        barrier.wait()
+        for i in range(200):
+            writer.add_call_log(alarm_ids[0], "101", datetime.now(), response=f"{index}-{i}")
+
+    producers = [threading.Thread(target=producer, args=(index,)) for index in range(4)]
+    for thread in producers:
+        thread.start()
+    barrier.wait()
+    writer.stop()
+    for thread in producers:
+        thread.join()
+
+    assert not writer.running and not writer.writer_thread.is_alive()
+    # Nessuna scrittura persa: accodata prima dello stop o eseguita subito dopo
+    assert len(db.get_call_logs()) == 800
+
+    # Writer fermo: scritture immediate e flush senza attesa
+    writer.update_alarm_status(alarm_ids[2], 'cancelled')
+    assert writer.flush()
+    assert db.get_alarm(alarm_ids[2]).status == 'cancelled'
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,265 @@
+"""
+Test del servizio stato interni condiviso (ExtensionStatusService)
+"""
+import threading
+import time
+
+from extension_status import ExtensionStatusService, parse_pjsip_contacts
+from pbx_connection import PBXConnection
+
+SIP_PEERS = """Name/username             Host                                    Dyn Forcerport Comedia    ACL Port     Status      Description
+101/101                   10.0.0.15                                D  Auto (No)  No             5060     OK (15 ms)
+102/102                   (Unspecified)                            D  Auto (No)  No             0        UNKNOWN
+103/103                   10.0.0.17                                D  Auto (No)  No             5060     Unmonitored
+104/104                   10.0.0.18                                D  Auto (No)  No             5060     UNREACHABLE
+4 sip peers [Monitored: 1 online, 2 offline Unmonitored: 1 online, 0 offline]
+"""
+
+# Output reale di 'pjsip show endpoints' (Asterisk 16): riga Endpoint più righe di dettaglio
+PJSIP_ENDPOINTS = """
+ Endpoint:  <Endpoint/CID.....................................>  <State.....>  <Channels.>
+    I/OAuth:  <AuthId/UserName...........................................................>
+        Aor:  <Aor............................................>  <MaxContact>
+      Contact:  <Aor/ContactUri..........................> <Hash....> <Status> <RTT(ms)..>
+  Transport:  <TransportId........>  <Type>  <cos>  <tos>  <BindAddress..................>
+   Identify:  <Identify/Endpoint.........................................................>
+        Match:  <criteria.........................>
+    Channel:  <ChannelId......................................>  <State.....>  <Time.....>
+        Exten: <DialedExten...........>  CLCID: <ConnectedLineCID.......>
+==========================================================================================
+
+ Endpoint:  201/201                                              Not in use    0 of inf
+     InAuth:  201-auth/201
+        Aor:  201                                                1
+      Contact:  201/sip:201@10.0.0.21:5060                 a1b2c3d4e5 Avail        12.345
+  Transport:  transport-udp             udp      0      0  0.0.0.0:5060
+
+ Endpoint:  202                                                  Unavailable   0 of inf
+     InAuth:  202-auth/202
+        Aor:  202                                                1
+
+ Endpoint:  203/Camera 203                                       Not in use    0 of inf
+     InAuth:  203-auth/203
+        Aor:  203                                                1
+      Contact:  203/sip:203@10.0.0.23:5060                 b2c3d4e5f6 NonQual         nan
+
+ Endpoint:  204                                                  In use        1 of inf
+        Aor:  204                                                2
+      Contact:  204/sip:204@10.0.0.24:5060                 c3d4e5f6a7 Unavail         nan
+      Contact:  204/sip:204@10.0.0.34:5060;ob              d4e5f6a7b8 Avail         8.100
+
+ Endpoint:  205                                                  Not in use    0 of inf
+        Aor:  205                                                1
+      Contact:  205/sip:205@10.0.0.25:5060                 e5f6a7b8c9 Unknown         nan
+
+ Endpoint:  206                                                  Not in use    0 of inf
+        Aor:  206                                                1
+      Contact:  206/sip:206@10.0.0.26:5060                 f6a7b8c9d0 Created         nan
+
+ Endpoint:  trunk-provider                                       Not in use    0 of inf
+
+
+Objects found: 7
+"""
+
+PJSIP_CONTACTS = """
+  Contact:  <Aor/ContactUri..........................> <Hash....> <Status> <RTT(ms)..>
+==========================================================================================
+
+  Contact:  201/sip:201@10.0.0.21:5060                 a1b2c3d4e5 Avail        12.345
+  Contact:  203/sip:203@10.0.0.23:5060                 b2c3d4e5f6 NonQual         nan
+  Contact:  204/sip:204@10.0.0.24:5060                 c3d4e5f6a7 Unavail         nan
+  Contact:  204/sip:204@10.0.0.34:5060;ob              d4e5f6a7b8 Avail         8.100
+  Contact:  205/sip:205@10.0.0.25:5060                 e5f6a7b8c9 Unknown         nan
+  Contact:  206/sip:206@10.0.0.26:5060                 f6a7b8c9d0 Created         nan
+
+Objects found: 6
+"""
+
+NO_SIP = (None, "No such command 'sip show peers' (type 'core show help sip show' for other possible commands)")
+
+
+class FakePBXConnection(PBXConnection):
+    """PBXConnection con risposte CLI predefinite: conta i batch eseguiti"""
+
+    def __init__(self, results, delay=0.0):
+        super().__init__({})
+        self.results = results
+        self.delay = delay
+        self.batches = []
+        self._batch_lock = threading.Lock()
+
+    def execute_cli_batch(self, cli_commands):
+        with self._batch_lock:
+            self.batches.append(list(cli_commands))
+        time.sleep(self.delay)
+        if isinstance(self.results, Exception):
+            raise self.results
+        return [self.results[command] for command in cli_commands]
+
+
+def _pjsip_results():
+    return {
+        'sip show peers': NO_SIP,
+        'pjsip show endpoints': (PJSIP_ENDPOINTS, None),
+        'pjsip show contacts': (PJSIP_CONTACTS, None),
+    }
+
+
+def test_parse_pjsip_contacts():
+    contacts = parse_pjsip_contacts(PJSIP_CONTACTS)
+    assert contacts == {
+        '201': ('online', 12),
+        '203': ('unmonitored', None),
+        # Due contatti per lo stesso interno: vale il migliore
+        '204': ('online', 8),
+        # Qualify disattivato o non ancora eseguito: stato sconosciuto, non offline
+        '205': ('unmonitored', None),
+        '206': ('unmonitored', None),
+    }
+    assert parse_pjsip_contacts("  Contact:  207/sip:207@10.0.0.27:5060  a0b1c2d3e4 Unavail  nan\n") == {
+        '207': ('offline', None)}
+    assert parse_pjsip_contacts("No objects found.\n") == {}
+
+
+def test_parse_pjsip_endpoints():
+    peers = PBXConnection({})._parse_pjsip_output(PJSIP_ENDPOINTS)
+    assert [(peer['extension'], peer['status']) for peer in peers] == [
+        ('201', 'online'), ('202', 'offline'), ('203', 'online'),
+        ('204', 'online'), ('205', 'online'), ('206', 'online')]
+
+
+def test_pjsip_snapshot_uses_contacts():
+    pbx = FakePBXConnection(_pjsip_results())
+    service = ExtensionStatusService(pbx, interval=30)
+
+    snapshot = service.get_snapshot()
+    assert pbx.batches == [['sip show peers', 'pjsip show endpoints', 'pjsip show contacts']]
+    assert snapshot.error is None
+    assert [peer['extension'] for peer in snapshot.peers] == ['201', '202', '203', '204', '205', '206']
+    assert snapshot.get('201')['status'] == 'online' and snapshot.get('201')['latency'] == 12
+    # Endpoint senza contatti registrati
+    assert snapshot.get('202')['status'] == 'offline'
+    assert snapshot.get('203')['status'] == 'unmonitored'
+
+    assert service.is_reachable('201') is True
+    assert service.is_reachable('202') is False
+    assert service.is_reachable('203') is None
+    assert service.is_reachable('204') is True
+    # Contatti Unknown/Created: la chiamata di sveglia deve partire comunque
+    assert service.is_reachable('205') is None
+    assert service.is_reachable('206') is None
+    assert service.is_reachable('999') is None
+    assert len(pbx.batches) == 1
+
+
+def test_sip_snapshot():
+    results = _pjsip_results()
+    results['sip show peers'] = (SIP_PEERS, None)
+    service = ExtensionStatusService(FakePBXConnection(results), interval=30)
+
+    peers, error = service.get_peers()
+    assert error is None
+    assert [(peer['extension'], peer['status'], peer['type']) for peer in peers] == [
+        ('101', 'online', 'SIP'), ('102', 'unmonitored', 'SIP'), ('103', 'unmonitored', 'SIP'),
+        ('104', 'offline', 'SIP')]
+    # UNKNOWN (qualify non ancora risposto): la chiamata parte; solo UNREACHABLE la blocca
+    assert service.is_reachable('101') is True
+    assert service.is_reachable('102') is None
+    assert service.is_reachable('104') is False
+
+
+def test_concurrent_consumers_share_one_poll():
+    pbx = FakePBXConnection(_pjsip_results(), delay=0.1)
+    service = ExtensionStatusService(pbx, interval=30)
+
+    results = []
+    def consumer():
+        results.append(service.get_status('201'))
+
+    threads = [threading.Thread(target=consumer) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(pbx.batches) == 1
+    assert all(result['status'] == 'online' for result in results)
+
+    # Entro l'intervallo nessun nuovo poll; max_age=0 lo forza
+    service.get_peers()
+    service.is_reachable('202')
+    assert len(pbx.batches) == 1
+    service.get_peers(max_age=0)
+    assert len(pbx.batches) == 2
+
+
+def test_changed_at_follows_status_changes():
+    results = _pjsip_results()
+    pbx = FakePBXConnection(results)
+    service = ExtensionStatusService(pbx, interval=30)
+
+    first = service.get_snapshot()
+    time.sleep(0.01)
+    # 202 si registra, 201 resta online
+    results['pjsip show contacts'] = (PJSIP_CONTACTS + "  Contact:  202/sip:202@10.0.0.22:5060   e5f6a7b8c9 Avail   5.000\n", None)
+    second = service.get_snapshot(max_age=0)
+
+    assert second.get('201')['changed_at'] == first.get('201')['changed_at'] == first.taken_at
+    assert second.get('202')['status'] == 'online'
+    assert second.get('202')['changed_at'] == second.taken_at > first.taken_at
+
+
+def test_failed_poll_is_cached_and_keeps_last_peers():
+    results = _pjsip_results()
+    pbx = FakePBXConnection(results)
+    service = ExtensionStatusService(pbx, interval=30)
+    service.get_snapshot()
+
+    pbx.results = RuntimeError("Errore di connessione")
+    snapshot = service.get_snapshot(max_age=0)
+    assert snapshot.error == "Errore di connessione"
+    assert len(snapshot.peers) == 6
+    assert service.get_peers() == (None, "Errore di connessione")
+    # Poll fallito: raggiungibilità sconosciuta, nessun nuovo tentativo entro l'intervallo
+    assert service.is_reachable('202') is None
+    assert len(pbx.batches) == 2
+
+    pbx.results = {
+        'sip show peers': NO_SIP,
+        'pjsip show endpoints': (None, "Unable to connect to remote asterisk"),
+        'pjsip show contacts': (None, "Unable to connect to remote asterisk"),
+    }
+    peers, error = service.get_peers(max_age=0)
+    assert peers is None and error == "Impossibile leggere gli interni dal centralino"
+
+
+def test_cached_reachability_never_polls():
+    pbx = FakePBXConnection(_pjsip_results(), delay=0.2)
+    service = ExtensionStatusService(pbx, interval=30)
+
+    # Nessuna fotografia: stato sconosciuto, subito e senza poll
+    started = time.time()
+    assert service.cached_reachability('202') is None
+    assert time.time() - started < 0.1 and not pbx.batches
+
+    service.start()
+    try:
+        deadline = time.time() + 2
+        while service.get_cached() is None and time.time() < deadline:
+            time.sleep(0.01)
+        assert service.cached_reachability('202') is False
+        assert service.cached_reachability('201') is True
+        # Fotografia più vecchia di max_age: non affidabile, si chiama
+        assert service.cached_reachability('202', max_age=0) is None
+        assert len(pbx.batches) == 1
+    finally:
+        service.stop()
+    assert not service.running
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
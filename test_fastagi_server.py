@@ -0,0 +1,190 @@
+"""
+Test del server FastAGI con un simulatore locale del client AGI di Asterisk
+"""
+import socket
+import threading
+import time
+
+from fastagi_server import FastAGIServer
+from pbx_backend import NO_ANSWER
+
+
+class AGIClientSimulator:
+    """
+    Simula Asterisk che esegue AGI(agi://.../wakeup,<call_id>)
+
+    behaviour:
+        ('stream', d)  tasto d premuto durante l'audio di sveglia
+        ('wait', d)    tasto d premuto dopo l'audio (WAIT FOR DIGIT)
+        ('silence',)   nessun tasto
+        ('hangup',)    l'ospite chiude durante l'audio
+    """
+
+    def __init__(self, port, call_id, behaviour):
+        self.port = port
+        self.call_id = call_id
+        self.behaviour = behaviour
+        self.commands = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def join(self, timeout=5):
+        self.thread.join(timeout)
+        assert not self.thread.is_alive()
+
+    def _run(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        env = (f"agi_network: yes\nagi_network_script: wakeup\nagi_request: agi://127.0.0.1/wakeup\n"
+               f"agi_channel: Local/130@from-internal-00000001;1\nagi_context: wakeup-agi\n"
+               f"agi_extension: {self.call_id}\nagi_priority: 4\nagi_arg_1: {self.call_id}\n\n")
+        sock.sendall(env.encode())
+        reader = sock.makefile('r')
+        kind = self.behaviour[0]
+        digit = self.behaviour[1] if len(self.behaviour) > 1 else None
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            command = line.strip()
+            self.commands.append(command)
+
+            if command == 'HANGUP':
+                sock.sendall(b"200 result=1\n")
+                break
+            if command.startswith('STREAM FILE') and len(self.commands) == 1:
+                if kind == 'hangup':
+                    sock.sendall(b"HANGUP\n511 Command Not Permitted on a dead channel or intercept routine\n")
+                    break
+                if kind == 'stream':
+                    sock.sendall(f"200 result={ord(digit)} endpos=8000\n".encode())
+                    continue
+                sock.sendall(b"200 result=0 endpos=16000\n")
+            elif command.startswith('WAIT FOR DIGIT') and kind == 'wait' and len(self.commands) == 2:
+                sock.sendall(f"200 result={ord(digit)}\n".encode())
+            elif command.startswith('STREAM FILE'):
+                sock.sendall(b"200 result=0 endpos=4000\n")
+            else:
+                sock.sendall(b"200 result=0\n")
+        sock.close()
+
+
+def _server():
+    server = FastAGIServer('127.0.0.1', 0)
+    server.start()
+    return server
+
+
+def _call(server, call_id, behaviour, digit_timeout=30):
+    server.register_call(call_id, 'custom/wakeup_it', 'custom/snooze5_it', 'custom/snooze10_it',
+                         digit_timeout=digit_timeout)
+    client = AGIClientSimulator(server.port, call_id, behaviour).start()
+    result = server.wait_call_result(call_id, 5)
+    client.join()
+    return result, client.commands
+
+
+def test_digit_during_prompt():
+    server = _server()
+    try:
+        result, commands = _call(server, '1001', ('stream', '1'))
+        assert result == '1'
+        assert commands == ['STREAM FILE custom/wakeup_it "12"', 'STREAM FILE custom/snooze5_it ""',
+                            'WAIT FOR DIGIT 500', 'HANGUP']
+    finally:
+        server.stop()
+
+
+def test_digit_after_prompt():
+    server = _server()
+    try:
+        result, commands = _call(server, '1002', ('wait', '2'), digit_timeout=20)
+        assert result == '2'
+        assert commands[:3] == ['STREAM FILE custom/wakeup_it "12"', 'WAIT FOR DIGIT 20000',
+                                'STREAM FILE custom/snooze10_it ""']
+        assert commands[-1] == 'HANGUP'
+    finally:
+        server.stop()
+
+
+def test_no_digit_invalid_digit_and_hangup():
+    server = _server()
+    try:
+        result, commands = _call(server, '1003', ('silence',))
+        assert result == 'H' and commands[-1] == 'HANGUP'
+        result, commands = _call(server, '1004', ('wait', '5'))
+        assert result == 'H' and commands[-1] == 'HANGUP'
+        result, commands = _call(server, '1005', ('hangup',))
+        assert result == 'H' and commands == ['STREAM FILE custom/wakeup_it "12"']
+    finally:
+        server.stop()
+
+
+def test_unknown_call_is_hung_up():
+    server = _server()
+    try:
+        client = AGIClientSimulator(server.port, '4242', ('stream', '1')).start()
+        client.join()
+        assert client.commands == ['HANGUP']
+        # Nessuna connessione AGI: scade il timeout
+        server.register_call('4243', 'custom/wakeup_it')
+        assert server.wait_call_result('4243', 0.1) is None
+        assert not server._calls
+    finally:
+        server.stop()
+
+
+def test_concurrent_calls():
+    server = _server()
+    try:
+        behaviours = {str(2000 + i): (('stream', '1'), ('wait', '2'), ('silence',), ('hangup',))[i % 4]
+                      for i in range(40)}
+        expected = {call_id: behaviour[1] if len(behaviour) > 1 else 'H'
+                    for call_id, behaviour in behaviours.items()}
+        results = {}
+
+        def run(call_id):
+            results[call_id] = _call(server, call_id, behaviours[call_id])[0]
+
+        threads = [threading.Thread(target=run, args=(call_id,)) for call_id in behaviours]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == expected
+        assert not server._calls
+    finally:
+        server.stop()
+
+
+def test_failed_extension_reports_no_answer():
+    server = _server()
+    try:
+        server.register_call('3101', 'custom/wakeup_it')
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock.sendall(b"agi_network: yes\nagi_network_script: wakeup-failed\n"
+                     b"agi_channel: OutgoingSpoolFailed\nagi_extension: failed\nagi_arg_1: 3101\n\n")
+        start = time.monotonic()
+        assert server.wait_call_result('3101', 5) == NO_ANSWER
+        assert time.monotonic() - start < 1
+        # Nessun comando AGI inviato al canale failed
+        assert sock.recv(100) == b""
+        sock.close()
+    finally:
+        server.stop()
+
+def test_stop_releases_waiting_calls():
+    server = _server()
+    server.register_call('3001', 'custom/wakeup_it')
+    threading.Timer(0.1, server.stop).start()
+    assert server.wait_call_result('3001', 5) is None
+    assert not server.running
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")